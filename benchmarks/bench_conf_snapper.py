@@ -0,0 +1,237 @@
+#!/usr/bin/python
+
+# Microbenchmarks of BtrfsStorage and conf_snapper hot paths.
+# Runs on any Linux box: subvolumes are plain folders of a scratch directory, no Btrfs and no root needed
+# (createSymbolicLink is measured only when run as root).
+#
+#   python benchmarks/bench_conf_snapper.py -o results.json
+#   python benchmarks/bench_conf_snapper.py -b baseline.json      # compares with a previous run
+
+import argparse
+import json
+import logging
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+import BtrfsStorage
+import RetentionPolicy
+import SnapshotConfiguration
+import StatusPublisher
+
+# BtrfsStorage whose subvolumes are folders of a scratch directory.
+class ScratchStorage(BtrfsStorage.BtrfsStorage):
+
+    useNativeBackend = False
+
+    def __init__(self):
+        BtrfsStorage.BtrfsStorage.__init__(self)
+        self.currentTime = datetime(2030, 1, 1)
+
+    # Snapshot names have one second resolution, every snapshot gets the next second.
+    def getCurrentTime(self):
+        self.currentTime += timedelta(seconds=1)
+        return self.currentTime
+
+    def checkRepository(self, path):
+        return True
+
+    def createSnapshotSubvolume(self, snapshot, snapshot_folder, snapshotName):
+        os.mkdir(os.path.join(snapshot_folder, snapshotName))
+        return True
+
+    def deleteSubvolumes(self, snapshot_folder, snapshotNames):
+        for snapshotName in snapshotNames:
+            os.rmdir(os.path.join(snapshot_folder, snapshotName))
+        return list(snapshotNames)
+
+    def isRepositoryUnchanged(self, snapshot):
+        return False
+
+    def getCleanerBacklog(self, path):
+        return 0
+
+# Runs fn(state) repeat times after setup() returned state, returns seconds per operation
+# (fn performs 'ops' operations).
+def measure(setup, fn, ops, repeat):
+    timings = []
+    for idx in range(repeat):
+        state = setup()
+        start_time = time.time()
+        fn(state)
+        timings.append((time.time() - start_time) / ops)
+    timings.sort()
+    return {'ops': ops, 'repeat': repeat, 'median': timings[len(timings) // 2], 'min': timings[0]}
+
+def createSnapshotFolders(snapshot_folder, count):
+    start = datetime(2020, 1, 1)
+    for idx in range(count):
+        os.mkdir(os.path.join(snapshot_folder, 'snapshot-' + (start + timedelta(seconds=idx)).strftime("%Y-%m-%d_%H-%M-%S")))
+
+def benchDeleteSnapshot(scratch, results, sizes, repeat):
+    for size in sizes:
+        repository = os.path.join(scratch, 'delete-%d' % size)
+        snapshot = SnapshotConfiguration.SnapshotConfiguration('bench', repository, 'level', 1, repository + '/link',
+                                                               retention=RetentionPolicy.RetentionPolicy(keep=size, maxDeletesPerTick=1))
+        storage = ScratchStorage()
+        snapshot_folder = storage.getSnapshotFolder(snapshot)
+        createSnapshotFolders(snapshot_folder, size)
+
+        # Startup / invalidated index: listing, parsing and sorting all snapshots of the level.
+        results['loadSnapshotIndex[%d]' % size] = measure(lambda: None,
+                                                          lambda state: storage.loadSnapshotIndex(snapshot),
+                                                          1, repeat)
+
+        # Steady state ticks: 100 snapshots more than retention keeps, every tick prunes one of them.
+        def setup():
+            storage.loadSnapshotIndex(snapshot)
+            for idx in range(100):
+                storage.takeSnapshot(snapshot)
+
+        def run(state):
+            for idx in range(100):
+                storage.deleteSnapshot(snapshot)
+        results['deleteSnapshot[%d]' % size] = measure(setup, run, 100, repeat)
+
+        shutil.rmtree(repository)
+
+def benchSnapshotCreatingTime(results, repeat):
+    storage = BtrfsStorage.BtrfsStorage()
+    names = ['snapshot-2020-01-01_00-00-%02d' % (idx % 60) for idx in range(1000)]
+
+    def run(state):
+        for snapshotName in names:
+            storage.getSnapshotCreatingTime(snapshotName)
+    results['getSnapshotCreatingTime'] = measure(lambda: None, run, len(names), repeat)
+
+def benchSnapshotFolder(scratch, results, repeat):
+    snapshots = [SnapshotConfiguration.SnapshotConfiguration('bench', os.path.join(scratch, 'folder'), 'level-%d' % idx, 1, 'link')
+                 for idx in range(1000)]
+
+    def run(state):
+        for snapshot in snapshots:
+            state.getSnapshotFolder(snapshot)
+    results['getSnapshotFolder[uncached]'] = measure(ScratchStorage, run, len(snapshots), repeat)
+
+    storage = ScratchStorage()
+    run(storage)
+    results['getSnapshotFolder[cached]'] = measure(lambda: storage, run, len(snapshots), repeat)
+
+def benchSymbolicLink(scratch, results, repeat):
+    import conf_snapper
+
+    if os.geteuid() != 0:
+        logging.getLogger().warning("createSymbolicLink is measured only when run as root.")
+        return
+
+    repository = os.path.join(scratch, 'link')
+    snapshot = SnapshotConfiguration.SnapshotConfiguration('bench', repository, 'level', 1, repository + '/link')
+    storage = ScratchStorage()
+    conf_snapper.btrfs = storage
+    snapshot_folder = storage.getSnapshotFolder(snapshot)
+    createSnapshotFolders(snapshot_folder, 2)
+    snapshots = sorted(os.listdir(snapshot_folder))
+
+    def run(state):
+        for idx in range(100):
+            conf_snapper.createSymbolicLink(snapshot, snapshots[idx % 2])
+    results['createSymbolicLink'] = measure(lambda: None, run, 100, repeat)
+
+def benchWriteStatus(scratch, results, repeat):
+    import conf_snapper
+
+    conf_snapper.status_publisher = StatusPublisher.StatusPublisher(os.path.join(scratch, 'snapper_status.json'))
+    state = conf_snapper.State()
+
+    def run(unused):
+        for idx in range(100):
+            # Status alternates, so every call writes the file.
+            state.hasRuntimeError = idx % 2 == 0
+            state.writeStatusJson(True)
+    results['writeStatusJson'] = measure(lambda: None, run, 100, repeat)
+
+def benchConfig(scratch, results, repositories, repeat):
+    import conf_snapper
+
+    conf_snapper.btrfs = ScratchStorage()
+    conf_snapper.log_file = os.path.join(scratch, 'conf_snapper.log')
+    conf_file = os.path.join(scratch, 'snapper_conf.json')
+    levels = [('LongTerm', 24, 'hour'), ('MedTerm', 1, 'hour'), ('ShortTerm', 10, 'min')]
+    with open(conf_file, 'w') as outfile:
+        json.dump({'snapper_configuration': {
+                      'repositories': [{'name': 'repository-%d' % idx,
+                                        'path': '/var/snapper/repository-%d' % idx,
+                                        'stoppers': ['/var/log/conf_snapper/stopper-%d.txt' % idx],
+                                        'snapshot_levels': [{'name': name, 'frequency': frequency, 'unit': unit,
+                                                             'link': '/var/snapper/repository-%d/%s' % (idx, name)}
+                                                            for name, frequency, unit in levels]}
+                                       for idx in range(repositories)],
+                      'stoppers': ['/var/log/conf_snapper/snapper_stopper.txt']}}, outfile)
+
+    snapper = conf_snapper.Snapper()
+    snapper.logger.setLevel(logging.WARNING)
+    results['Snapper.config[%d repositories]' % repositories] = measure(lambda: None, lambda state: snapper.config(conf_file), 1, repeat)
+
+# Prints ratio to the baseline per benchmark, returns names of benchmarks slower than threshold.
+# Fastest runs are compared, they are the least disturbed by the rest of the system.
+def compare(results, baseline, threshold):
+    regressions = []
+    for name in sorted(results):
+        if name not in baseline:
+            print "%-40s %12.3f us  (new)" % (name, results[name]['min'] * 1e6)
+            continue
+
+        ratio = results[name]['min'] / baseline[name]['min'] if baseline[name]['min'] > 0 else 1.0
+        marker = ''
+        if ratio > threshold:
+            marker = '  REGRESSION'
+            regressions.append(name)
+        print "%-40s %12.3f us  %6.2fx%s" % (name, results[name]['min'] * 1e6, ratio, marker)
+    return regressions
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Microbenchmarks of conf_snapper hot paths')
+    parser.add_argument('-o', '--output', help='Write results to the JSON file.', dest='output')
+    parser.add_argument('-b', '--baseline', help='Compare with results of a previous run (JSON file).', dest='baseline')
+    parser.add_argument('-t', '--threshold', help='Slowdown ratio reported as regression (default 1.2).', type=float, default=1.2, dest='threshold')
+    parser.add_argument('-r', '--repeat', help='Repetitions of each benchmark (default 5).', type=int, default=5, dest='repeat')
+    parser.add_argument('-q', '--quick', help='Skip the largest sizes.', action='store_true', dest='is_quick')
+    args = parser.parse_args()
+
+    logging.getLogger().setLevel(logging.WARNING)
+
+    scratch = tempfile.mkdtemp(prefix='conf_snapper_bench_')
+    results = {}
+    try:
+        benchDeleteSnapshot(scratch, results, [10, 1000] if args.is_quick else [10, 1000, 100000], args.repeat)
+        benchSnapshotCreatingTime(results, args.repeat)
+        benchSnapshotFolder(scratch, results, args.repeat)
+        benchSymbolicLink(scratch, results, args.repeat)
+        benchWriteStatus(scratch, results, args.repeat)
+        benchConfig(scratch, results, 1000 if args.is_quick else 5000, args.repeat)
+    finally:
+        shutil.rmtree(scratch, True)
+
+    report = {'python': platform.python_version(),
+              'host': platform.node(),
+              'time': time.time(),
+              'benchmarks': results}
+
+    if args.output != None:
+        with open(args.output, 'w') as outfile:
+            json.dump(report, outfile, indent=1, sort_keys=True)
+
+    if args.baseline != None:
+        with open(args.baseline) as infile:
+            baseline = json.load(infile)['benchmarks']
+        regressions = compare(results, baseline, args.threshold)
+        sys.exit(1 if len(regressions) > 0 else 0)
+
+    if args.output == None:
+        print json.dumps(report, indent=1, sort_keys=True)
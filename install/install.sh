@@ -53,7 +53,7 @@ echo "Installing confsnapper service watchdog..."
 # Install confsnapper watchdog
 cat > /etc/cron.d/monitor_confsnapper <<'EOF'  
 MAILTO=""
-* * * * * root /opt/conf_snapper/curr/scripts/service_watcher.sh confsnapper >> /var/log/conf_snapper/monitor_confsnapper.log 2>&1
+* * * * * root /opt/conf_snapper/curr/scripts/service_watcher.sh -b /var/log/conf_snapper/snapper_heartbeat.json confsnapper >> /var/log/conf_snapper/monitor_confsnapper.log 2>&1
 
 EOF
 echo "Watchdog installed."
@@ -3,6 +3,63 @@
 # are unexpectedly down. If a service was stopped explicitly the watcher
 # will not try to restart it. The script accepts a list of service names,
 # for example: service_watcher.sh conf_snapper
+#
+# With -b <heartbeat file> a running service is also restarted when its
+# heartbeat is older than -a <seconds> (default 120), or when a tick of a
+# snapshot level is overdue by more than -l <seconds> (default 600), e.g.
+# service_watcher.sh -b /var/log/conf_snapper/snapper_heartbeat.json confsnapper
+
+HEARTBEAT_FILE=""
+MAX_HEARTBEAT_AGE=120
+MAX_TICK_LAG=600
+
+while getopts "b:a:l:" OPTION; do
+        case $OPTION in
+                b) HEARTBEAT_FILE=$OPTARG ;;
+                a) MAX_HEARTBEAT_AGE=$OPTARG ;;
+                l) MAX_TICK_LAG=$OPTARG ;;
+                *) echo "Usage: $0 [-b heartbeat_file] [-a max_heartbeat_age] [-l max_tick_lag] service..."; exit 1 ;;
+        esac
+done
+shift $((OPTIND - 1))
+
+# Interpreter of the heartbeat check, the snippet runs on Python 2 and 3.
+PYTHON=`command -v python || command -v python3`
+
+# Prints the reason the heartbeat is unhealthy, nothing when it is healthy.
+# The heartbeat time is seconds since boot (CLOCK_BOOTTIME), compared with /proc/uptime.
+# A check that fails to run counts as unhealthy, so a stall is never missed silently.
+check_heartbeat() {
+        if [ ! -f "$HEARTBEAT_FILE" ]; then
+                echo "heartbeat file $HEARTBEAT_FILE does not exist"
+                return
+        fi
+
+        local OUTPUT RC
+        OUTPUT=$("$PYTHON" - "$HEARTBEAT_FILE" "$MAX_HEARTBEAT_AGE" "$MAX_TICK_LAG" 2>&1 <<'EOF'
+import json, sys
+try:
+    heartbeat = json.load(open(sys.argv[1]))
+except Exception as err:
+    print("heartbeat file can not be read (%s)" % err)
+    sys.exit(0)
+uptime = float(open('/proc/uptime').read().split()[0])
+age = uptime - heartbeat['bootTime']
+if age < 0 or age > float(sys.argv[2]):
+    print("heartbeat is stale (%.0f sec old)" % age)
+elif heartbeat['maxLag'] > float(sys.argv[3]):
+    in_flight = heartbeat.get('oldestInFlight')
+    print("tick of %s is overdue by %.0f sec%s" % (heartbeat['maxLagLevel'], heartbeat['maxLag'],
+        ", oldest operation in flight: %s of %s for %.0f sec" % (in_flight['stage'], in_flight['level'], in_flight['age']) if in_flight else ""))
+EOF
+)
+        RC=$?
+        if [ $RC -ne 0 ]; then
+                echo "heartbeat check failed (rc=$RC): $(echo "$OUTPUT" | tail -n 1)"
+        else
+                echo "$OUTPUT"
+        fi
+}
 
 TIME_FOR_LOG=`date "+%F %H:%M"`
 SERVICES=$*
@@ -11,11 +68,20 @@ for SERVICE in $SERVICES; do
         service $SERVICE status >> /dev/null
         RC=$?
         if [ $RC -eq 0 ]; then
-                echo " - $SERVICE is alive (rc=$RC)"
+                REASON=""
+                if [ -n "$HEARTBEAT_FILE" ]; then
+                        REASON=`check_heartbeat`
+                fi
+                if [ -n "$REASON" ]; then
+                        echo " - $SERVICE is alive but $REASON, restarting"
+                        service $SERVICE restart
+                else
+                        echo " - $SERVICE is alive (rc=$RC)"
+                fi
         elif [ $RC -eq 3 ] || [ $RC -eq 4 ]; then
                 echo " - $SERVICE was stopped by admin, not restarting (rc=$RC)"
         else
                 echo " - $SERVICE is not alive, restarting (rc=$RC)"
                 service $SERVICE restart
         fi
-done
\ No newline at end of file
+done
@@ -0,0 +1,233 @@
+#!/usr/bin/python
+
+"""
+    Thin wrapper over the Btrfs ioctl interface (see linux/btrfs.h).
+    Used by BtrfsStorage to create and delete subvolume snapshots in-process
+    instead of forking 'btrfs' command line tool, to check whether a subvolume
+    has changed since its last snapshot and by SpaceMonitor to read space usage.
+    All functions raise EnvironmentError (OSError / IOError) with a real errno on failure.
+"""
+
+import errno
+import fcntl
+import os
+import struct
+import sys
+from array import array
+
+BTRFS_IOCTL_MAGIC = 0x94
+
+# Sizes of name buffers in the kernel argument structures.
+BTRFS_PATH_NAME_MAX = 4087
+BTRFS_SUBVOL_NAME_MAX = 4039
+
+# Errors meaning the native interface is not usable here (not Btrfs, old kernel, etc.)
+# and the caller should fall back to the command line tool. Permission errors (EPERM, EACCES)
+# are not among them, they are failures of the single operation on its path.
+NOT_SUPPORTED_ERRORS = (errno.ENOTTY, errno.EOPNOTSUPP, errno.ENOSYS)
+
+def _IOC(direction, nr, size):
+    return (direction << 30) | (size << 16) | (BTRFS_IOCTL_MAGIC << 8) | nr
+
+def _IOW(nr, size):
+    return _IOC(1, nr, size)
+
+def _IOWR(nr, size):
+    return _IOC(3, nr, size)
+
+# struct btrfs_ioctl_vol_args { __s64 fd; char name[BTRFS_PATH_NAME_MAX + 1]; }
+VOL_ARGS_FORMAT = '=q%ds' % (BTRFS_PATH_NAME_MAX + 1)
+
+# struct btrfs_ioctl_vol_args_v2 { __s64 fd; __u64 transid; __u64 flags; __u64 unused[4]; char name[BTRFS_SUBVOL_NAME_MAX + 1]; }
+VOL_ARGS_V2_FORMAT = '=qQQ32x%ds' % (BTRFS_SUBVOL_NAME_MAX + 1)
+
+# struct btrfs_ioctl_ino_lookup_args { __u64 treeid; __u64 objectid; char name[BTRFS_INO_LOOKUP_PATH_MAX]; }
+INO_LOOKUP_ARGS_FORMAT = '=QQ4080x'
+
+# struct btrfs_ioctl_search_key { __u64 tree_id, min_objectid, max_objectid, min_offset, max_offset, min_transid, max_transid;
+#                                 __u32 min_type, max_type, nr_items, unused; __u64 unused1..4; }
+# followed by char buf[4096 - sizeof(struct btrfs_ioctl_search_key)]
+SEARCH_KEY_FORMAT = '=QQQQQQQIIII32x'
+SEARCH_ARGS_SIZE = 4096
+
+# struct btrfs_ioctl_search_header { __u64 transid, objectid, offset; __u32 type, len; }
+SEARCH_HEADER_FORMAT = '=QQQII'
+
+# struct btrfs_ioctl_space_args { __u64 space_slots; __u64 total_spaces; struct btrfs_ioctl_space_info spaces[]; }
+# struct btrfs_ioctl_space_info { __u64 flags; __u64 total_bytes; __u64 used_bytes; }
+SPACE_ARGS_FORMAT = '=QQ'
+SPACE_INFO_FORMAT = '=QQQ'
+
+BTRFS_IOC_SNAP_DESTROY = _IOW(15, struct.calcsize(VOL_ARGS_FORMAT))
+BTRFS_IOC_TREE_SEARCH = _IOWR(17, SEARCH_ARGS_SIZE)
+BTRFS_IOC_INO_LOOKUP = _IOWR(18, struct.calcsize(INO_LOOKUP_ARGS_FORMAT))
+BTRFS_IOC_SPACE_INFO = _IOWR(20, struct.calcsize(SPACE_ARGS_FORMAT))
+BTRFS_IOC_SNAP_CREATE_V2 = _IOW(23, struct.calcsize(VOL_ARGS_V2_FORMAT))
+BTRFS_IOC_SUBVOL_GETFLAGS = _IOC(2, 25, 8)
+
+# Flags of SNAP_CREATE_V2 and SUBVOL_GETFLAGS.
+BTRFS_SUBVOL_RDONLY = 1 << 1
+
+BTRFS_BLOCK_GROUP_DATA = 1 << 0
+BTRFS_BLOCK_GROUP_SYSTEM = 1 << 1
+BTRFS_BLOCK_GROUP_METADATA = 1 << 2
+
+BTRFS_ROOT_TREE_OBJECTID = 1
+BTRFS_FIRST_FREE_OBJECTID = 256
+BTRFS_INODE_ITEM_KEY = 1
+BTRFS_ROOT_ITEM_KEY = 132
+U64_MAX = 2 ** 64 - 1
+
+# Offset of otransid (transaction the subvolume/snapshot was created in) in struct btrfs_root_item.
+ROOT_ITEM_OTRANSID_OFFSET = 303
+
+# Offset of transid (transaction the inode was last changed in) in struct btrfs_inode_item.
+INODE_ITEM_TRANSID_OFFSET = 8
+
+def isNotSupportedError(err):
+    return getattr(err, 'errno', None) in NOT_SUPPORTED_ERRORS
+
+# Returns name as bytes of the filesystem encoding (names listed from a unicode path are unicode),
+# raises EINVAL when it is not a valid subvolume name.
+def _checkName(name, maxLength):
+    if isinstance(name, unicode):
+        name = name.encode(sys.getfilesystemencoding())
+    if len(name) == 0 or len(name) > maxLength or '/' in name:
+        raise OSError(errno.EINVAL, os.strerror(errno.EINVAL), name)
+    return name
+
+# Creates snapshot of sourcePath subvolume as destFolder/name, read-only snapshots can be sent by 'btrfs send'.
+def snapshotCreate(sourcePath, destFolder, name, readOnly = False):
+    name = _checkName(name, BTRFS_SUBVOL_NAME_MAX)
+
+    source_fd = os.open(sourcePath, os.O_RDONLY | os.O_DIRECTORY)
+    try:
+        dest_fd = os.open(destFolder, os.O_RDONLY | os.O_DIRECTORY)
+        try:
+            flags = BTRFS_SUBVOL_RDONLY if readOnly else 0
+            args = array('B', struct.pack(VOL_ARGS_V2_FORMAT, source_fd, 0, flags, name))
+            fcntl.ioctl(dest_fd, BTRFS_IOC_SNAP_CREATE_V2, args, True)
+        finally:
+            os.close(dest_fd)
+    finally:
+        os.close(source_fd)
+
+# Deletes subvolume parentFolder/name.
+def snapshotDestroy(parentFolder, name):
+    name = _checkName(name, BTRFS_PATH_NAME_MAX)
+
+    parent_fd = os.open(parentFolder, os.O_RDONLY | os.O_DIRECTORY)
+    try:
+        args = array('B', struct.pack(VOL_ARGS_FORMAT, 0, name))
+        fcntl.ioctl(parent_fd, BTRFS_IOC_SNAP_DESTROY, args, True)
+    finally:
+        os.close(parent_fd)
+
+# Returns id of the subvolume (tree) holding path.
+def getSubvolumeId(path):
+    fd = os.open(path, os.O_RDONLY | os.O_DIRECTORY)
+    try:
+        args = array('B', struct.pack(INO_LOOKUP_ARGS_FORMAT, 0, BTRFS_FIRST_FREE_OBJECTID))
+        fcntl.ioctl(fd, BTRFS_IOC_INO_LOOKUP, args, True)
+    finally:
+        os.close(fd)
+
+    return struct.unpack_from('=Q', args)[0]
+
+# Searches tree treeId of the filesystem holding path, yields items as (header, data) in key order.
+# Only tree blocks written in transaction minTransid or later are searched, all items of such a block are
+# returned, also those not changed since. Keys are compared as a whole (objectid, type, offset), so items
+# of other types between the min and max key are returned as well.
+def _searchItems(path, treeId, minObjectId, maxObjectId, minType, maxType, minTransid = 0, nrItems = 4096):
+    header_size = struct.calcsize(SEARCH_HEADER_FORMAT)
+    min_offset = 0
+
+    fd = os.open(path, os.O_RDONLY | os.O_DIRECTORY)
+    try:
+        while True:
+            key = struct.pack(SEARCH_KEY_FORMAT, treeId, minObjectId, maxObjectId, min_offset, U64_MAX,
+                              minTransid, U64_MAX, minType, maxType, nrItems, 0)
+            args = array('B', key + '\0' * (SEARCH_ARGS_SIZE - len(key)))
+            fcntl.ioctl(fd, BTRFS_IOC_TREE_SEARCH, args, True)
+
+            nr_items = struct.unpack_from('=I', args, struct.calcsize('=QQQQQQQII'))[0]
+            if nr_items == 0:
+                return
+
+            header_offset = len(key)
+            for idx in range(nr_items):
+                header = struct.unpack_from(SEARCH_HEADER_FORMAT, args, header_offset)
+                data_offset = header_offset + header_size
+                yield header, args[data_offset:data_offset + header[4]].tostring()
+                header_offset = data_offset + header[4]
+
+            # The next search starts right after the last returned key.
+            minObjectId, min_offset, minType = header[1], header[2], header[3]
+            if min_offset < U64_MAX:
+                min_offset += 1
+            elif minType < 255:
+                minType, min_offset = minType + 1, 0
+            elif minObjectId < maxObjectId:
+                minObjectId, minType, min_offset = minObjectId + 1, 0, 0
+            else:
+                return
+    finally:
+        os.close(fd)
+
+# Searches tree treeId of the filesystem holding path, returns the first item as (header, data) or None.
+def _searchFirstItem(path, treeId, minObjectId, maxObjectId, minType, maxType, minTransid = 0):
+    for item in _searchItems(path, treeId, minObjectId, maxObjectId, minType, maxType, minTransid, 1):
+        return item
+    return None
+
+# Returns transaction id in which subvolume at path was created (for a snapshot, the one it was taken in).
+def getSubvolumeCreationTransid(path):
+    subvolume_id = getSubvolumeId(path)
+    item = _searchFirstItem(path, BTRFS_ROOT_TREE_OBJECTID, subvolume_id, subvolume_id, BTRFS_ROOT_ITEM_KEY, BTRFS_ROOT_ITEM_KEY)
+    if item == None or len(item[1]) < ROOT_ITEM_OTRANSID_OFFSET + 8:
+        # Root item written by an old kernel, it does not have the transid.
+        raise OSError(errno.EOPNOTSUPP, os.strerror(errno.EOPNOTSUPP), path)
+
+    return struct.unpack_from('=Q', item[1], ROOT_ITEM_OTRANSID_OFFSET)[0]
+
+# Yields inode numbers of subvolume at path changed after transaction transid (as 'btrfs subvolume find-new'
+# does): content or metadata of the inode, for a directory also its entries. A deleted inode is not reported,
+# its directory is. Changes of the running transaction are found once they are written to the tree, at the
+# latest when the transaction commits.
+def getChangedInodes(path, transid):
+    subvolume_id = getSubvolumeId(path)
+    for header, data in _searchItems(path, subvolume_id, 0, U64_MAX, 0, 255, transid + 1):
+        if header[3] != BTRFS_INODE_ITEM_KEY:
+            continue
+        # Other inodes of a rewritten tree block come along, the inode item tells when it was changed.
+        if len(data) < INODE_ITEM_TRANSID_OFFSET + 8 or struct.unpack_from('=Q', data, INODE_ITEM_TRANSID_OFFSET)[0] > transid:
+            yield header[1]
+
+# Returns allocated space of the filesystem holding path as list of (block group flags, total bytes, used bytes).
+def getSpaceInfo(path):
+    fd = os.open(path, os.O_RDONLY | os.O_DIRECTORY)
+    try:
+        # The first call only reports how many slots are needed.
+        args = array('B', struct.pack(SPACE_ARGS_FORMAT, 0, 0))
+        fcntl.ioctl(fd, BTRFS_IOC_SPACE_INFO, args, True)
+        total_spaces = struct.unpack_from(SPACE_ARGS_FORMAT, args)[1]
+
+        args = array('B', struct.pack(SPACE_ARGS_FORMAT, total_spaces, 0) + '\0' * (total_spaces * struct.calcsize(SPACE_INFO_FORMAT)))
+        fcntl.ioctl(fd, BTRFS_IOC_SPACE_INFO, args, True)
+    finally:
+        os.close(fd)
+
+    total_spaces = struct.unpack_from(SPACE_ARGS_FORMAT, args)[1]
+    offset = struct.calcsize(SPACE_ARGS_FORMAT)
+    size = struct.calcsize(SPACE_INFO_FORMAT)
+    return [struct.unpack_from(SPACE_INFO_FORMAT, args, offset + idx * size) for idx in range(total_spaces)]
+
+def isSubvolumeReadOnly(path):
+    fd = os.open(path, os.O_RDONLY | os.O_DIRECTORY)
+    try:
+        args = array('B', struct.pack('=Q', 0))
+        fcntl.ioctl(fd, BTRFS_IOC_SUBVOL_GETFLAGS, args, True)
+    finally:
+        os.close(fd)
+
+    return struct.unpack_from('=Q', args)[0] & BTRFS_SUBVOL_RDONLY != 0
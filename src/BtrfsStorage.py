@@ -1,30 +1,56 @@
 #!/usr/bin/python
 
+import bisect
+import errno
 import logging
 import subprocess
+import threading
 from datetime import datetime
 import os
 
+import BtrfsIoctl
+import MountTable
+import RetentionPolicy
 import SnapshotConfiguration
+from Profiler import profiler
 
 class BtrfsStorage:
     
     genSnapshotPathSubFolder = '/snapshots/'
     snapshotPrefix = 'snapshot-'
+    
+    # Snapshots are created/deleted by ioctl calls, 'btrfs' command line tool is used as a fallback.
+    useNativeBackend = True
+    # Max number of subvolumes deleted by a single 'btrfs' command line tool invocation.
+    cliBatchSize = 256
+    
+    def __init__(self):
+        # Ordered (oldest first) snapshot names per snapshot level, keyed by SnapshotConfiguration full name.
+        self.snapshotIndex = {}
+        # RetentionState per snapshot level, kept in step with the index.
+        self.retentionStates = {}
+        # Snapshot names handed to the reaper and not deleted yet, keyed as the index.
+        self.pendingDeletes = {}
+        self.indexLock = threading.Lock()
+        # Background SnapshotReaper, when None expired snapshots are deleted inline.
+        self.reaper = None
+        self.mountTable = MountTable.MountTable()
+        # Snapshot folders known to exist, keyed by SnapshotConfiguration full name.
+        self.snapshotFolders = {}
+        # (snapshot name, creation transid) of the latest snapshot per snapshot level.
+        self.snapshotTransids = {}
+        # Links of the snapshot levels per repository path, {level full name: link path}.
+        self.repositoryLinks = {}
         
     def checkRepository(self, path):
         logger = logging.getLogger();
         
         logger.debug("started") 
         
-        check_btrfs_command = 'stat -f --format=%T ' + path;
-        
-        logger.debug("Running '%s'", check_btrfs_command) 
-        
-        output = subprocess.Popen(check_btrfs_command.split(), stdout=subprocess.PIPE).communicate()[0]
-        logger.debug("The path %s is %s", path, output) 
+        fs_type = self.mountTable.getFilesystemType(path)
+        logger.debug("The path %s is %s", path, fs_type) 
         
-        if output.strip() == 'btrfs':
+        if fs_type == 'btrfs':
             return True;
         
         return False;
@@ -32,32 +58,82 @@ class BtrfsStorage:
     def getSnapshotFolder(self, snapshot):
         logger = logging.getLogger();
         
+        snapshotFolder = self.snapshotFolders.get(snapshot.getFullName())
+        if snapshotFolder != None:
+            return snapshotFolder;
+        
         snapshotRootFolder = snapshot.repositoryPath + self.genSnapshotPathSubFolder 
         snapshotFolder = snapshotRootFolder + snapshot.snapshotName
         
-        if os.path.exists(snapshotRootFolder) == False:
-            logger.debug("Folder '%s' does not exist, creating...", snapshotRootFolder)
-            create_folder_command = 'sudo mkdir ' + snapshotRootFolder
-            os.system(create_folder_command)
-        
-        if os.path.exists(snapshotFolder) == False:
-            logger.debug("Folder '%s' does not exist, creating...", snapshotFolder)
-            create_folder_command = 'sudo mkdir ' + snapshotFolder
-            os.system(create_folder_command)
+        try:
+            os.makedirs(snapshotFolder)
+            logger.debug("Folder '%s' did not exist, created.", snapshotFolder)
+        except OSError, err:
+            if err.errno != errno.EEXIST:
+                logger.error("Failed to create folder '%s': [errno %d] %s", snapshotFolder, err.errno, os.strerror(err.errno))
+                return snapshotFolder;
         
+        self.snapshotFolders[snapshot.getFullName()] = snapshotFolder
         return snapshotFolder;
     
+    # Forgets snapshot folder after an operation failed with ENOENT, it is recreated on next access.
+    def invalidateSnapshotFolder(self, snapshot_folder):
+        logger = logging.getLogger();
+        
+        logger.debug("Folder '%s' has disappeared.", snapshot_folder)
+        for fullName, snapshotFolder in self.snapshotFolders.items():
+            if snapshotFolder == snapshot_folder:
+                del self.snapshotFolders[fullName]
+    
     def takeSnapshot(self, snapshot):
         logger = logging.getLogger();
         
         logger.debug("started") 
         
-        time_now = datetime.now()
+        time_now = self.getCurrentTime()
         snapshotName = self.snapshotPrefix + time_now.strftime("%Y-%m-%d_%H-%M-%S")
         
-        snapshot_folder = self.getSnapshotFolder(snapshot)
-        snapshot_path = snapshot_folder + '/' + snapshotName
-        create_snapshot_command = 'sudo btrfs subvolume snapshot ' + snapshot.repositoryPath + ' ' + snapshot_path;
+        with profiler.span('snapshot_folder', snapshot.getFullName()):
+            snapshot_folder = self.getSnapshotFolder(snapshot)
+        
+        with profiler.span('create_subvolume', snapshot.getFullName()):
+            is_created = self.createSnapshotSubvolume(snapshot, snapshot_folder, snapshotName)
+        
+        if is_created == False:
+            # Disk state is not what the index expects, recheck it on next access.
+            self.invalidateSnapshotIndex(snapshot)
+            return False
+        
+        self.addToSnapshotIndex(snapshot, snapshotName, time_now.replace(microsecond=0))
+        return True;
+    
+    # Creates snapshot subvolume snapshot_folder/snapshotName of the repository.
+    # Snapshots of exported levels are read-only, 'btrfs send' accepts only those.
+    def createSnapshotSubvolume(self, snapshot, snapshot_folder, snapshotName):
+        logger = logging.getLogger();
+        
+        if self.useNativeBackend == True:
+            try:
+                BtrfsIoctl.snapshotCreate(snapshot.repositoryPath, snapshot_folder, snapshotName, snapshot.exportTarget != None)
+                logger.debug("Snapshot %s/%s was created.", snapshot_folder, snapshotName)
+                return True;
+            except EnvironmentError, err:
+                if BtrfsIoctl.isNotSupportedError(err):
+                    self.disableNativeBackend(err)
+                else:
+                    if err.errno == errno.ENOENT:
+                        self.invalidateSnapshotFolder(snapshot_folder)
+                    logger.error("Failed to create (%s/%s) snapshot: [errno %d] %s", snapshot_folder, snapshotName, err.errno, os.strerror(err.errno))
+                    return False
+        
+        return self.takeSnapshotCli(snapshot, snapshot_folder + '/' + snapshotName)
+    
+    # Creates snapshot by 'btrfs' command line tool.
+    def takeSnapshotCli(self, snapshot, snapshot_path):
+        logger = logging.getLogger();
+        
+        read_only_option = '-r ' if snapshot.exportTarget != None else ''
+        create_snapshot_command = 'sudo btrfs subvolume snapshot ' + read_only_option + snapshot.repositoryPath + ' ' + snapshot_path;
         
         logger.debug("command is '%s' ", create_snapshot_command) 
         
@@ -65,11 +141,198 @@ class BtrfsStorage:
         logger.debug("The output is '%s'",output) 
         
         if('ERROR' in output or 'usage' in output):
-            logger.error('Failed to create (%s) snapshot.')
+            logger.error('Failed to create (%s) snapshot.', snapshot_path)
             return False
         
         return True;
+    
+    # Deletes snapshot subvolumes snapshot_folder/<name>, returns names which were deleted.
+    def deleteSubvolumes(self, snapshot_folder, snapshotNames):
+        logger = logging.getLogger();
+        
+        deleted_snapshot_list = []
+        remaining_snapshot_list = list(snapshotNames)
+        
+        while self.useNativeBackend == True and len(remaining_snapshot_list) > 0:
+            snapshotName = remaining_snapshot_list[0]
+            try:
+                BtrfsIoctl.snapshotDestroy(snapshot_folder, snapshotName)
+                logger.debug("Snapshot %s/%s was deleted.", snapshot_folder, snapshotName)
+                deleted_snapshot_list.append(snapshotName)
+            except EnvironmentError, err:
+                if BtrfsIoctl.isNotSupportedError(err):
+                    self.disableNativeBackend(err)
+                    break
+                if err.errno == errno.ENOENT:
+                    self.invalidateSnapshotFolder(snapshot_folder)
+                logger.error("Failed to delete (%s/%s) snapshot: [errno %d] %s", snapshot_folder, snapshotName, err.errno, os.strerror(err.errno))
+            remaining_snapshot_list.pop(0)
+        
+        for idx in range(0, len(remaining_snapshot_list), self.cliBatchSize):
+            deleted_snapshot_list.extend(self.deleteSubvolumesCli(snapshot_folder, remaining_snapshot_list[idx:idx + self.cliBatchSize]))
+        
+        return deleted_snapshot_list
+    
+    # Deletes snapshot subvolumes by single 'btrfs' command line tool invocation.
+    def deleteSubvolumesCli(self, snapshot_folder, snapshotNames):
+        logger = logging.getLogger();
+        
+        full_snapshot_paths = [snapshot_folder + '/' + snapshotName for snapshotName in snapshotNames]
+        delete_snapshot_command = ['sudo', 'btrfs', 'subvolume', 'del'] + full_snapshot_paths;
+    
+        logger.debug("command is '%s' ", ' '.join(delete_snapshot_command)) 
+        
+        output = subprocess.Popen(delete_snapshot_command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT).communicate()[0]
+        logger.debug("The output is '%s'",output) 
+        
+        if 'usage' in output:
+            logger.error('Failed to delete (%s) snapshots.', full_snapshot_paths)
+            return []
+        
+        # btrfs reports each failed path in its own ERROR line and continues with the rest.
+        error_lines = [line for line in output.splitlines() if 'ERROR' in line]
+        is_path_reported = any(full_snapshot_path in line for line in error_lines for full_snapshot_path in full_snapshot_paths)
+        
+        deleted_snapshot_list = []
+        for snapshotName, full_snapshot_path in zip(snapshotNames, full_snapshot_paths):
+            if any(full_snapshot_path in line for line in error_lines) or (len(error_lines) > 0 and is_path_reported == False):
+                logger.error('Failed to delete (%s) snapshot.', full_snapshot_path)
+            else:
+                deleted_snapshot_list.append(snapshotName)
+        
+        return deleted_snapshot_list
+    
+    # Returns number of deleted subvolumes the Btrfs cleaner has not processed yet, 0 if unknown.
+    def getCleanerBacklog(self, path):
+        logger = logging.getLogger();
+        
+        list_deleted_command = ['btrfs', 'subvolume', 'list', '-d', path]
+        
+        try:
+            output = subprocess.Popen(list_deleted_command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT).communicate()[0]
+        except OSError, err:
+            logger.debug("Failed to run '%s': %s", ' '.join(list_deleted_command), err)
+            return 0
+        
+        if('ERROR' in output or 'usage' in output):
+            logger.debug("Failed to get cleaner backlog for %s: %s", path, output)
+            return 0
+        
+        return len([line for line in output.splitlines() if line.startswith('ID ')])
+
+
+    # Waits until the Btrfs cleaner has removed all deleted subvolumes of the filesystem, returns False on failure.
+    def syncDeletedSubvolumes(self, path):
+        logger = logging.getLogger();
+        
+        sync_command = ['btrfs', 'subvolume', 'sync', path]
+        logger.debug("command is '%s' ", ' '.join(sync_command))
+        
+        try:
+            process = subprocess.Popen(sync_command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+            output = process.communicate()[0]
+        except OSError, err:
+            logger.error("Failed to run '%s': %s", ' '.join(sync_command), err)
+            return False
+        
+        if process.returncode != 0:
+            logger.error("Failed to wait for Btrfs cleaner of %s: %s", path, output.strip())
+            return False
+        
+        return True
+    
+    # True when the repository subvolume has not changed since the latest snapshot of the level was taken.
+    # Changes made by the service itself are not counted: snapshots created and deleted in the snapshot
+    # folders and links of the levels replaced in the repository.
+    # Any failure (no ioctl interface, no snapshot yet) returns False, so the snapshot is taken.
+    def isRepositoryUnchanged(self, snapshot):
+        logger = logging.getLogger();
         
+        if self.useNativeBackend == False:
+            return False
+        
+        snapshots = self.getSnapshots(snapshot)
+        if len(snapshots) == 0:
+            return False
+        
+        latest_snapshot = snapshots[-1]
+        latest_snapshot_path = self.getSnapshotFolder(snapshot) + '/' + latest_snapshot
+        try:
+            cached = self.snapshotTransids.get(snapshot.getFullName())
+            if cached != None and cached[0] == latest_snapshot:
+                transid = cached[1]
+            else:
+                transid = BtrfsIoctl.getSubvolumeCreationTransid(latest_snapshot_path)
+                self.snapshotTransids[snapshot.getFullName()] = (latest_snapshot, transid)
+            
+            ignored_inodes, link_folders = self.getServiceInodes(snapshot.repositoryPath)
+            for inode in BtrfsIoctl.getChangedInodes(snapshot.repositoryPath, transid):
+                if inode in ignored_inodes:
+                    continue
+                if inode in link_folders and self.isFolderSizeUnchanged(snapshot.repositoryPath, latest_snapshot_path, link_folders[inode]):
+                    continue
+                logger.debug("Inode %d of %s has changed since %s.", inode, snapshot.repositoryPath, latest_snapshot)
+                return False
+            
+            return True
+        except EnvironmentError, err:
+            logger.debug("Failed to check changes of %s since %s: [errno %d] %s", snapshot.repositoryPath, latest_snapshot, err.errno, os.strerror(err.errno))
+            return False
+    
+    # Returns inodes of the repository changed by the service on every tick, as (inode numbers of the snapshot
+    # folders and of the links, {inode number: relative path} of folders holding links).
+    # A link is replaced by a rename, its folder changes as well but it keeps its entries.
+    def getServiceInodes(self, repositoryPath):
+        repository_device = os.lstat(repositoryPath).st_dev
+        snapshot_root_folder = repositoryPath + self.genSnapshotPathSubFolder
+        
+        ignored_inodes = set([os.lstat(snapshot_root_folder).st_ino])
+        for name in os.listdir(snapshot_root_folder):
+            ignored_inodes.add(os.lstat(snapshot_root_folder + name).st_ino)
+        
+        link_folders = {}
+        with self.indexLock:
+            links = self.repositoryLinks.get(repositoryPath, {}).values()
+        for link in links:
+            relative_folder = os.path.relpath(os.path.dirname(link), repositoryPath)
+            if relative_folder == os.pardir or relative_folder.startswith(os.pardir + os.sep):
+                continue
+            
+            folder_stat = os.lstat(os.path.dirname(link))
+            if folder_stat.st_dev != repository_device:
+                #Another subvolume or filesystem, its changes are not seen in the repository.
+                continue
+            link_folders[folder_stat.st_ino] = relative_folder
+            
+            try:
+                ignored_inodes.add(os.lstat(link).st_ino)
+            except OSError, err:
+                if err.errno != errno.ENOENT:
+                    raise
+        
+        return ignored_inodes, link_folders
+    
+    # True when a folder of the repository has the size it had in the snapshot. Size of a Btrfs directory
+    # is the total length of its entry names, a removed or added entry changes it, a replaced link does not.
+    def isFolderSizeUnchanged(self, repositoryPath, snapshotPath, relativeFolder):
+        return self.getFolderSize(os.path.join(repositoryPath, relativeFolder)) == self.getFolderSize(os.path.join(snapshotPath, relativeFolder))
+    
+    def getFolderSize(self, path):
+        return os.lstat(path).st_size
+    
+    def disableNativeBackend(self, err):
+        logger = logging.getLogger();
+        
+        logger.warning("Btrfs ioctl interface is not available ([errno %d] %s), falling back to 'btrfs' command line tool.", err.errno, os.strerror(err.errno))
+        self.useNativeBackend = False
+        
+    # Current time snapshot names are made of, replaced by the virtual clock of the simulation.
+    def getCurrentTime(self):
+        return datetime.now()
+    
+    def listSnapshotFolder(self, snapshot_folder):
+        return os.listdir(snapshot_folder)
+    
     def getSnapshotCreatingTime(self, snapshotName):
         logger = logging.getLogger();
         snapshotTime = snapshotName[len(self.snapshotPrefix):]
@@ -79,52 +342,179 @@ class BtrfsStorage:
         
         return date_object;    
     
-    def deleteSnapshot(self, snapshot, forceDelete = False):
+    # Reads snapshot folder of the snapshot level and rebuilds its index.
+    def loadSnapshotIndex(self, snapshot):
         logger = logging.getLogger();
         
-        logger.debug("started") 
-        
         snapshot_folder = self.getSnapshotFolder(snapshot)
         
-        def sorted_ls(path):
-            mtime = lambda f: self.getSnapshotCreatingTime(os.path.basename(f))
-            return list(sorted(os.listdir(path), key=mtime))
+        with profiler.span('list_snapshots', snapshot.getFullName()):
+            try:
+                snapshot_folder_list = self.listSnapshotFolder(snapshot_folder)
+            except OSError, err:
+                if err.errno != errno.ENOENT:
+                    raise
+                self.invalidateSnapshotFolder(snapshot_folder)
+                snapshot_folder = self.getSnapshotFolder(snapshot)
+                snapshot_folder_list = self.listSnapshotFolder(snapshot_folder)
+        
+        snapshots = []
+        for snapshotName in snapshot_folder_list:
+            try:
+                snapshots.append((self.getSnapshotCreatingTime(snapshotName), snapshotName))
+            except ValueError:
+                logger.warning("Unexpected entry '%s' in %s, ignoring.", snapshotName, snapshot_folder)
+        
+        with self.indexLock:
+            pending = set(self.pendingDeletes.get(snapshot.getFullName(), ()))
+        
+        sorted_snapshots = []
+        retention = RetentionPolicy.RetentionState(snapshot.retention)
+        for creatingTime, snapshotName in sorted(snapshots):
+            if snapshotName in pending:
+                continue
+            sorted_snapshots.append(snapshotName)
+            retention.add(snapshotName, creatingTime)
+        
+        logger.debug("Loaded %d snapshots for %s: %s", len(sorted_snapshots), snapshot.getFullName(), sorted_snapshots)
+        
+        with self.indexLock:
+            self.snapshotIndex[snapshot.getFullName()] = sorted_snapshots
+            self.retentionStates[snapshot.getFullName()] = retention
+            self.repositoryLinks.setdefault(snapshot.repositoryPath, {})[snapshot.getFullName()] = snapshot.snapshotLink
+        
+        return list(sorted_snapshots)
+    
+    # Returns age in seconds of the latest snapshot of the level, None if there is none.
+    def getLatestSnapshotAge(self, snapshot):
+        snapshots = self.getSnapshots(snapshot)
+        if len(snapshots) == 0:
+            return None
+        
+        age = self.getCurrentTime() - self.getSnapshotCreatingTime(snapshots[-1])
+        return age.days * 24 * 60 * 60 + age.seconds
+    
+    # Returns time sorted (oldest first) snapshot names of the snapshot level.
+    def getSnapshots(self, snapshot):
+        with self.indexLock:
+            snapshots = self.snapshotIndex.get(snapshot.getFullName())
+            if snapshots != None:
+                return list(snapshots)
+        
+        return self.loadSnapshotIndex(snapshot)
+    
+    def addToSnapshotIndex(self, snapshot, snapshotName, creatingTime):
+        with self.indexLock:
+            snapshots = self.snapshotIndex.get(snapshot.getFullName())
+            if snapshots != None and snapshotName not in snapshots:
+                # Names are formatted so that lexical order is the creation time order.
+                bisect.insort(snapshots, snapshotName)
+                self.retentionStates[snapshot.getFullName()].add(snapshotName, creatingTime)
+    
+    def removeFromSnapshotIndex(self, snapshot, snapshotNames):
+        removed = set(snapshotNames)
+        with self.indexLock:
+            snapshots = self.snapshotIndex.get(snapshot.getFullName())
+            if snapshots != None:
+                snapshots[:] = [snapshotName for snapshotName in snapshots if snapshotName not in removed]
+    
+    def markSnapshotDeletePending(self, snapshot, snapshotNames):
+        self.removeFromSnapshotIndex(snapshot, snapshotNames)
+        with self.indexLock:
+            self.pendingDeletes.setdefault(snapshot.getFullName(), set()).update(snapshotNames)
+    
+    # Called when deletion of snapshotNames has been finished, deleted_snapshot_list holds the succeeded ones.
+    def completeSnapshotDelete(self, snapshot, snapshotNames, deleted_snapshot_list):
+        with self.indexLock:
+            pending = self.pendingDeletes.get(snapshot.getFullName())
+            if pending != None:
+                pending.difference_update(snapshotNames)
+        
+        self.removeFromSnapshotIndex(snapshot, deleted_snapshot_list)
+        if len(deleted_snapshot_list) < len(snapshotNames):
+            self.invalidateSnapshotIndex(snapshot)
+    
+    # Drops everything known about the snapshot level (it was removed or changed by configuration reload).
+    def forgetSnapshotLevel(self, snapshot):
+        self.snapshotFolders.pop(snapshot.getFullName(), None)
+        self.snapshotTransids.pop(snapshot.getFullName(), None)
+        with self.indexLock:
+            self.repositoryLinks.get(snapshot.repositoryPath, {}).pop(snapshot.getFullName(), None)
+        self.invalidateSnapshotIndex(snapshot)
+    
+    def invalidateSnapshotIndex(self, snapshot):
+        logger = logging.getLogger();
         
-        sorted_folders = sorted_ls(snapshot_folder)
-        sorted_folders_len = len(sorted_folders)
+        logger.debug("Snapshot index of %s will be reloaded from disk.", snapshot.getFullName())
+        with self.indexLock:
+            self.snapshotIndex.pop(snapshot.getFullName(), None)
+            self.retentionStates.pop(snapshot.getFullName(), None)
+    
+    # Returns snapshots expired by the retention policy of the level which are to be deleted by this tick.
+    def takeExpiredSnapshots(self, snapshot):
+        # Makes sure the index and the retention state are loaded.
+        self.getSnapshots(snapshot)
+        
+        with self.indexLock:
+            retention = self.retentionStates.get(snapshot.getFullName())
+            if retention == None:
+                return []
+            
+            expired_snapshot_list = retention.takeExpired()
+            if retention.getExpiredCount() > 0:
+                logging.getLogger().debug("%d expired snapshots of %s are left for next ticks.", retention.getExpiredCount(), snapshot.getFullName())
+            
+            return expired_snapshot_list
+    
+    # Deletes all but the retention's keep most recent snapshots of the level right away, also those kept
+    # by the hourly/daily/weekly rules, bypassing the reaper and max_deletes_per_tick.
+    # Used when the filesystem is low on space, returns the snapshots left.
+    def deleteSnapshotsToMinimum(self, snapshot):
+        logger = logging.getLogger();
         
-        if forceDelete == False and sorted_folders_len < 3:
-            logger.debug("There is less than 3 snapshots, nothing to delete.")
-            return sorted_folders;
+        snapshots = self.getSnapshots(snapshot)
+        excess_snapshot_list = snapshots[:-snapshot.retention.keep]
+        if len(excess_snapshot_list) == 0:
+            return snapshots
         
-        logger.debug(sorted_ls(snapshot_folder))
+        logger.info("%d snapshots of %s will be deleted to free space: %s", len(excess_snapshot_list), snapshot.getFullName(), excess_snapshot_list)
         
-        actual_number_of_will_be_delete_snapshot = sorted_folders_len;
-        if forceDelete == False :
-            actual_number_of_will_be_delete_snapshot = sorted_folders_len-2
+        snapshot_folder = self.getSnapshotFolder(snapshot)
+        with profiler.span('delete_subvolumes', snapshot.getFullName()):
+            deleted_snapshot_list = self.deleteSubvolumes(snapshot_folder, excess_snapshot_list)
+        self.completeSnapshotDelete(snapshot, excess_snapshot_list, deleted_snapshot_list)
+        #Retention state still holds the deleted snapshots, it is rebuilt with the index.
+        self.invalidateSnapshotIndex(snapshot)
         
-        logger.debug("There %d snapshots, %d will be deleted.", sorted_folders_len, actual_number_of_will_be_delete_snapshot)
+        return self.getSnapshots(snapshot)
     
-        current_snapshot_list = []
-        for idx, snapshotName in enumerate(sorted_folders):
-            full_snapshot_path = snapshot_folder + '/' + snapshotName;
-            
-            if((idx + 1) > (actual_number_of_will_be_delete_snapshot)):
-                logger.debug("Snapshot %s has left.", snapshotName)
-                current_snapshot_list.append(snapshotName)
-                continue;
-#           
-            create_snapshot_command = 'sudo btrfs subvolume del ' + full_snapshot_path;
-        
-            logger.debug("command is '%s' ", create_snapshot_command) 
-            
-            output = subprocess.Popen(create_snapshot_command.split(), stdout=subprocess.PIPE, stderr=subprocess.STDOUT).communicate()[0]
-            logger.debug("The output is '%s'",output) 
-            
-            if('ERROR' in output or 'usage' in output):
-                logger.error('Failed to delete (%s) snapshot.', full_snapshot_path)
-            
+    def deleteSnapshot(self, snapshot, forceDelete = False):
+        logger = logging.getLogger();
+        
+        logger.debug("started") 
+        
+        snapshot_folder = self.getSnapshotFolder(snapshot)
+        
+        if forceDelete == True:
+            expired_snapshot_list = self.getSnapshots(snapshot)
+        else:
+            expired_snapshot_list = self.takeExpiredSnapshots(snapshot)
+        
+        if len(expired_snapshot_list) == 0:
+            logger.debug("Nothing to delete.")
+            return self.getSnapshots(snapshot);
+        
+        logger.debug("%d snapshots will be deleted: %s", len(expired_snapshot_list), expired_snapshot_list)
+        
+        if self.reaper != None and forceDelete == False:
+            # Subvolumes are deleted in background, the index forgets them right away.
+            self.markSnapshotDeletePending(snapshot, expired_snapshot_list)
+            self.reaper.enqueue(snapshot, snapshot_folder, expired_snapshot_list)
+        else:
+            with profiler.span('delete_subvolumes', snapshot.getFullName()):
+                deleted_snapshot_list = self.deleteSubvolumes(snapshot_folder, expired_snapshot_list)
+            self.completeSnapshotDelete(snapshot, expired_snapshot_list, deleted_snapshot_list)
         
-        return current_snapshot_list;
+        return self.getSnapshots(snapshot);
         
         
\ No newline at end of file
@@ -0,0 +1,266 @@
+#!/usr/bin/python
+
+import collections
+import errno
+import fcntl
+import heapq
+import itertools
+import logging
+import os
+import select
+import signal
+import threading
+import time
+
+# Single-threaded event loop: epoll for file descriptors, a heap of timers and signals delivered through
+# a wakeup pipe, so a signal is handled right away even when it arrives outside of epoll.
+# Other threads hand work over to the loop with callFromThread. Callbacks run on the loop thread one at
+# a time, a callback must not block: blocking work (Btrfs ioctls) stays on the FilesystemExecutor.
+class EventEngine:
+
+    def __init__(self):
+        self.epoll = select.epoll()
+        # fd -> callback()
+        self.readers = {}
+        # (due time, sequence, timer), a timer is [callback, args, cancelled]
+        self.timers = []
+        self.sequence = itertools.count()
+        # TimerQueues driven by the loop instead of their own threads.
+        self.timerQueues = []
+        # signal number -> callback(signal number, None)
+        self.signalHandlers = {}
+        self.pendingSignals = collections.deque()
+        self.pendingCalls = collections.deque()
+        self.lock = threading.Lock()
+        self.running = False
+        self.thread = None
+
+        self.wakeupRead, self.wakeupWrite = os.pipe()
+        for fd in (self.wakeupRead, self.wakeupWrite):
+            fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+            fcntl.fcntl(fd, fcntl.F_SETFD, fcntl.FD_CLOEXEC)
+        self.addReader(self.wakeupRead, self.drainWakeup)
+
+    # Runs callback(*args) at due time (epoch seconds), returns the timer to be passed to cancel().
+    # Expected to be called on the loop thread, other threads use callFromThread.
+    def callAt(self, due, callback, *args):
+        timer = [callback, args, False]
+        heapq.heappush(self.timers, (due, next(self.sequence), timer))
+        return timer
+
+    def callLater(self, delay, callback, *args):
+        return self.callAt(time.time() + delay, callback, *args)
+
+    # Runs callback(*args) every interval seconds.
+    def callEvery(self, interval, callback, *args):
+        def repeat():
+            self.callLater(interval, repeat)
+            callback(*args)
+        return self.callLater(interval, repeat)
+
+    def cancel(self, timer):
+        timer[2] = True
+
+    # Runs callback(*args) on the loop thread as soon as possible, safe to call from any thread.
+    def callFromThread(self, callback, *args):
+        with self.lock:
+            self.pendingCalls.append((callback, args))
+        self.wakeup()
+
+    def wakeup(self):
+        try:
+            os.write(self.wakeupWrite, '\0')
+        except OSError, err:
+            # Pipe is full, the loop is woken anyway.
+            if err.errno != errno.EAGAIN:
+                raise
+
+    def drainWakeup(self):
+        try:
+            while len(os.read(self.wakeupRead, 4096)) > 0:
+                pass
+        except OSError, err:
+            if err.errno != errno.EAGAIN:
+                raise
+
+    # Calls callback() on the loop thread whenever fd is readable.
+    def addReader(self, fd, callback):
+        self.readers[fd] = callback
+        self.epoll.register(fd, select.EPOLLIN)
+
+    def removeReader(self, fd):
+        if self.readers.pop(fd, None) != None:
+            self.epoll.unregister(fd)
+
+    # Handles the signal on the loop thread with callback(signal number, None), as signal.signal handlers
+    # are called. Must be called on the main thread.
+    def addSignalHandler(self, sig, callback):
+        self.signalHandlers[sig] = callback
+        signal.signal(sig, self.onSignal)
+        signal.set_wakeup_fd(self.wakeupWrite)
+
+    # Python level signal handler, only records the signal.
+    def onSignal(self, sig, frame):
+        self.pendingSignals.append(sig)
+
+    # Serves timers of the TimerQueue on the loop, the queue wakes the loop when a timer is scheduled.
+    def addTimerQueue(self, timerQueue):
+        timerQueue.wakeup = self.wakeup
+        self.timerQueues.append(timerQueue)
+
+    def stop(self):
+        self.running = False
+        self.wakeup()
+
+    # True on the loop thread, or before the loop is run.
+    def isLoopThread(self):
+        return self.thread == None or self.thread == threading.current_thread()
+
+    # Returns seconds until the next timer (of the heap or the timer queues), None when there is none.
+    def getTimeout(self, now):
+        while len(self.timers) > 0 and self.timers[0][2][2] == True:
+            heapq.heappop(self.timers)
+
+        next_due = self.timers[0][0] if len(self.timers) > 0 else None
+        for timerQueue in self.timerQueues:
+            with timerQueue.condition:
+                due = timerQueue.getNextDue()
+            if due != None and (next_due == None or due < next_due):
+                next_due = due
+
+        if next_due == None:
+            return None
+        return max(0, next_due - now)
+
+    def runCallback(self, callback, *args):
+        logger = logging.getLogger();
+
+        try:
+            callback(*args)
+        except Exception:
+            logger.exception("Callback %s has failed.", getattr(callback, '__name__', callback))
+
+    def runDueTimers(self):
+        now = time.time()
+        while len(self.timers) > 0 and self.timers[0][0] <= now:
+            timer = heapq.heappop(self.timers)[2]
+            if timer[2] == False:
+                self.runCallback(timer[0], *timer[1])
+
+        for timerQueue in self.timerQueues:
+            while True:
+                with timerQueue.condition:
+                    due_timer = timerQueue.popDue(now)
+                if due_timer == None:
+                    break
+                self.runCallback(due_timer[1], *due_timer[2])
+
+    def runPendingCalls(self):
+        with self.lock:
+            calls = list(self.pendingCalls)
+            self.pendingCalls.clear()
+
+        for callback, args in calls:
+            self.runCallback(callback, *args)
+
+    def runPendingSignals(self):
+        while len(self.pendingSignals) > 0:
+            sig = self.pendingSignals.popleft()
+            callback = self.signalHandlers.get(sig)
+            if callback != None:
+                self.runCallback(callback, sig, None)
+
+    # Runs the loop until stop() is called.
+    def run(self):
+        logger = logging.getLogger();
+
+        logger.info("Event engine is running.")
+        self.thread = threading.current_thread()
+        self.running = True
+        while self.running:
+            timeout = self.getTimeout(time.time())
+            try:
+                events = self.epoll.poll(-1 if timeout == None else timeout)
+            except IOError, err:
+                if err.errno != errno.EINTR:
+                    raise
+                events = []
+
+            for fd, mask in events:
+                callback = self.readers.get(fd)
+                if callback != None:
+                    self.runCallback(callback)
+
+            self.runPendingSignals()
+            self.runPendingCalls()
+            self.runDueTimers()
+
+        logger.info("Event engine has stopped.")
+
+    def close(self):
+        signal.set_wakeup_fd(-1)
+        self.epoll.close()
+        os.close(self.wakeupRead)
+        os.close(self.wakeupWrite)
+
+# Scheduler of cron jobs on the EventEngine, in place of APScheduler's BlockingScheduler (same add_job
+# interface for cron jobs). Fire times come from APScheduler's CronTrigger, jobs run on the loop thread.
+class EngineScheduler:
+
+    def __init__(self, engine):
+        from apscheduler.triggers.cron import CronTrigger
+        self.CronTrigger = CronTrigger
+        self.engine = engine
+        # job id -> (trigger, func, args, engine timer)
+        self.jobs = {}
+
+    def add_job(self, func, trigger, args = None, name = None, id = None, **fields):
+        if self.engine.isLoopThread() == False:
+            # Jobs are changed on the loop thread only (the heap is not locked).
+            self.engine.callFromThread(lambda: self.add_job(func, trigger, args, name, id, **fields))
+            return
+
+        self.remove_job(id)
+        self.jobs[id] = [self.CronTrigger(**fields), func, args or [], None]
+        self.scheduleNextFire(id, None)
+
+    def scheduleNextFire(self, jobId, previousFireTime):
+        from datetime import datetime
+
+        job = self.jobs[jobId]
+        trigger = job[0]
+        now = datetime.now(trigger.timezone)
+        next_fire_time = trigger.get_next_fire_time(previousFireTime, now)
+        if next_fire_time != None:
+            job[3] = self.engine.callAt(time.mktime(next_fire_time.timetuple()), self.fire, jobId, next_fire_time)
+
+    def fire(self, jobId, fireTime):
+        job = self.jobs.get(jobId)
+        if job == None:
+            return
+
+        self.scheduleNextFire(jobId, fireTime)
+        job[1](*job[2])
+
+    def get_job(self, id):
+        return self.jobs.get(id)
+
+    def remove_job(self, id):
+        if self.engine.isLoopThread() == False:
+            self.engine.callFromThread(self.remove_job, id)
+            return
+
+        job = self.jobs.pop(id, None)
+        if job != None and job[3] != None:
+            self.engine.cancel(job[3])
+
+    def remove_all_jobs(self):
+        for jobId in self.jobs.keys():
+            self.remove_job(jobId)
+
+    # Runs the engine until shutdown(), as BlockingScheduler.start() does.
+    def start(self):
+        self.engine.run()
+
+    def shutdown(self):
+        self.engine.stop()
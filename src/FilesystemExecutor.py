@@ -0,0 +1,84 @@
+#!/usr/bin/python
+
+import logging
+import os
+import threading
+# requires installation of futures (concurrent.futures backport)
+# sudo pip install futures
+from concurrent.futures import ThreadPoolExecutor
+
+from Profiler import profiler
+
+# Execution layer for snapshot jobs.
+# Jobs are grouped by the filesystem (device) backing their repository. Filesystems are served
+# in parallel, each by its own pool of 'width' threads, so jobs of one filesystem do not race on
+# Btrfs transaction commits while a burst over many filesystems still finishes in one job time.
+# A snapshot level has a single job running or waiting at a time.
+class FilesystemExecutor:
+
+    def __init__(self, mountTable, width = 1):
+        self.mountTable = mountTable
+        self.width = max(1, width)
+        # filesystem id -> ThreadPoolExecutor
+        self.pools = {}
+        # snapshot level full name -> Lock, serializes everything touching the level.
+        self.levelLocks = {}
+        # snapshot level full names with a submitted, not finished job.
+        self.inFlight = set()
+        self.lock = threading.Lock()
+
+    # Returns id of the filesystem backing the repository of the snapshot level.
+    def getFilesystemId(self, snapshot):
+        return self.mountTable.getFilesystemId(snapshot.repositoryPath)
+
+    def getPool(self, filesystemId):
+        pool = self.pools.get(filesystemId)
+        if pool == None:
+            pool = ThreadPoolExecutor(max_workers=self.width)
+            self.pools[filesystemId] = pool
+        return pool
+
+    def getLevelLock(self, snapshot):
+        with self.lock:
+            return self.levelLocks.setdefault(snapshot.getFullName(), threading.Lock())
+
+    # Queues fn(*args) on the pool of the snapshot's filesystem. Returns a Future, or None when
+    # the previous job of the snapshot level has not finished yet and this one is dropped.
+    def submit(self, snapshot, fn, *args):
+        logger = logging.getLogger();
+
+        filesystemId = self.getFilesystemId(snapshot)
+        with self.lock:
+            if snapshot.getFullName() in self.inFlight:
+                logger.warning("Previous job of %s is still running, skipping.", snapshot.getFullName())
+                return None
+            self.inFlight.add(snapshot.getFullName())
+            pool = self.getPool(filesystemId)
+
+        logger.debug("Submitting %s on filesystem %s.", snapshot.getFullName(), filesystemId)
+        return pool.submit(self.runJob, snapshot, fn, args)
+
+    def runJob(self, snapshot, fn, args):
+        logger = logging.getLogger();
+
+        try:
+            with self.getLevelLock(snapshot):
+                with profiler.span('job', snapshot.getFullName()):
+                    return fn(*args)
+        except Exception:
+            logger.exception("Job of %s has failed.", snapshot.getFullName())
+        finally:
+            with self.lock:
+                self.inFlight.discard(snapshot.getFullName())
+
+    def getInFlightCount(self):
+        with self.lock:
+            return len(self.inFlight)
+
+    def shutdown(self, wait = False):
+        with self.lock:
+            pools = self.pools.values()
+            self.pools = {}
+
+        for pool in pools:
+            pool.shutdown(wait)
@@ -0,0 +1,109 @@
+#!/usr/bin/python
+
+import ctypes
+import ctypes.util
+import json
+import logging
+import os
+import threading
+import time
+
+from Profiler import profiler
+
+CLOCK_BOOTTIME = 7
+
+# struct timespec { time_t tv_sec; long tv_nsec; }
+class Timespec(ctypes.Structure):
+    _fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+
+libc = None
+
+# Returns seconds since boot (CLOCK_BOOTTIME), the clock of /proc/uptime: monotonic, not changed by
+# setting the wall clock, and counting suspended time.
+def getBootTime():
+    global libc
+
+    if libc == None:
+        try:
+            libc = ctypes.CDLL('libc.so.6', use_errno=True)
+        except OSError:
+            libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+
+    timespec = Timespec()
+    if libc.clock_gettime(CLOCK_BOOTTIME, ctypes.byref(timespec)) != 0:
+        with open('/proc/uptime') as infile:
+            return float(infile.read().split()[0])
+    return timespec.tv_sec + timespec.tv_nsec / 1e9
+
+# Liveness file of the service, rewritten every interval seconds: boot time of the write, last completed
+# scheduled tick and tick lag per snapshot level, and the oldest operation in flight.
+# A stale file means the service does not run anymore, a growing lag means ticks do not complete
+# (e.g. a job hangs in a Btrfs call). scripts/service_watcher.sh restarts the service in both cases.
+class Heartbeat(threading.Thread):
+
+    def __init__(self, path, interval = 10):
+        threading.Thread.__init__(self, name="heartbeat_thread")
+        self.daemon = True
+        self.path = path
+        self.interval = interval
+        # snapshot level full name -> [interval seconds, boot time of the last completed tick]
+        self.levels = {}
+        self.lock = threading.Lock()
+        self.stopEvent = threading.Event()
+
+    # Starts tracking ticks of the snapshot level, the first tick is expected within its interval from now.
+    def addLevel(self, snapshot):
+        with self.lock:
+            self.levels[snapshot.getFullName()] = [snapshot.getIntervalSeconds(), getBootTime()]
+
+    def removeLevel(self, snapshot):
+        with self.lock:
+            self.levels.pop(snapshot.getFullName(), None)
+
+    # Records a completed scheduled tick of the snapshot level (taken, skipped or failed).
+    def recordTick(self, snapshot):
+        with self.lock:
+            level = self.levels.get(snapshot.getFullName())
+            if level != None:
+                level[1] = getBootTime()
+
+    def getHeartbeat(self):
+        now = getBootTime()
+        with self.lock:
+            levels = dict((name, {'interval': interval, 'lastTick': lastTick, 'lag': max(0.0, now - lastTick - interval)})
+                          for name, (interval, lastTick) in self.levels.items())
+
+        max_lag_level = max(levels, key=lambda name: levels[name]['lag']) if len(levels) > 0 else None
+        oldest_in_flight = profiler.getOldestInFlight()
+
+        return {'bootTime': now,
+                'time': time.time(),
+                'pid': os.getpid(),
+                'interval': self.interval,
+                'maxLag': levels[max_lag_level]['lag'] if max_lag_level != None else 0.0,
+                'maxLagLevel': max_lag_level,
+                'oldestInFlight': {'stage': oldest_in_flight[0], 'level': oldest_in_flight[1], 'age': oldest_in_flight[2]} if oldest_in_flight != None else None,
+                'levels': levels}
+
+    # Writes the heartbeat file through a temporary file, so readers never see a truncated one.
+    def beat(self):
+        logger = logging.getLogger();
+
+        temporaryPath = self.path + '.tmp'
+        try:
+            with open(temporaryPath, 'w') as outfile:
+                json.dump(self.getHeartbeat(), outfile)
+            os.rename(temporaryPath, self.path)
+        except EnvironmentError, err:
+            logger.error("Failed to write heartbeat file %s: %s", self.path, err)
+
+    def stop(self):
+        self.stopEvent.set()
+
+    def run(self):
+        logger = logging.getLogger();
+
+        logger.info("Writing heartbeat to %s every %d sec.", self.path, self.interval)
+        while not self.stopEvent.is_set():
+            self.beat()
+            self.stopEvent.wait(self.interval)
@@ -0,0 +1,105 @@
+#!/usr/bin/python
+
+import errno
+import logging
+import socket
+import threading
+
+# Read-only metrics endpoint on an abstract Unix domain socket (as the instance lock, nothing on disk).
+# Every connection gets the current metrics in Prometheus text format and is closed. Clients sending
+# an HTTP request get an HTTP response, so the socket can be scraped directly, e.g.
+#   socat - ABSTRACT-CONNECT:conf_snapper_metrics
+class MetricsServer(threading.Thread):
+
+    # Seconds a client is given to send its (optional) request.
+    requestTimeout = 0.2
+    # Seconds a client is given to read the metrics, a client that stops reading does not block the endpoint.
+    sendTimeout = 2.0
+
+    # collect() returns the metrics as a list of MetricFamily.
+    def __init__(self, name, collect):
+        threading.Thread.__init__(self, name="metrics_thread")
+        self.daemon = True
+        self.socketName = name
+        self.collect = collect
+        self.serverSocket = None
+
+    def bind(self):
+        self.serverSocket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.serverSocket.bind('\0' + self.socketName)
+        self.serverSocket.listen(8)
+
+    def run(self):
+        logger = logging.getLogger();
+
+        logger.info("Serving metrics on abstract socket @%s", self.socketName)
+        while True:
+            try:
+                connection = self.serverSocket.accept()[0]
+            except socket.error, err:
+                if err.args[0] == errno.EINTR:
+                    continue
+                raise
+
+            try:
+                self.serve(connection)
+            except Exception:
+                logger.exception("Failed to serve metrics.")
+            finally:
+                connection.close()
+
+    def serve(self, connection):
+        connection.settimeout(self.requestTimeout)
+        try:
+            request = connection.recv(4096)
+        except socket.timeout:
+            request = ''
+
+        # Level names may be non-ASCII, the text format is UTF-8.
+        body = u''.join(family.format() for family in self.collect()).encode('utf-8')
+        connection.settimeout(self.sendTimeout)
+        if request.startswith('GET '):
+            connection.sendall("HTTP/1.0 200 OK\r\n"
+                               "Content-Type: text/plain; version=0.0.4; charset=utf-8\r\n"
+                               "Content-Length: %d\r\n\r\n" % len(body))
+        connection.sendall(body)
+
+# A metric with its samples: (labels dictionary, value) or (name suffix, labels dictionary, value).
+class MetricFamily:
+
+    def __init__(self, name, metricType, help):
+        self.name = name
+        self.metricType = metricType
+        self.help = help
+        self.samples = []
+
+    def add(self, labels, value, suffix = ''):
+        self.samples.append((suffix, labels, value))
+        return self
+
+    # Adds histogram from bucket upper bounds, per bucket (not cumulative) counts, count and sum.
+    def addHistogram(self, labels, bounds, counts, count, total):
+        cumulative = 0
+        for bound, bucketCount in zip(list(bounds) + ['+Inf'], counts):
+            cumulative += bucketCount
+            bucket_labels = dict(labels)
+            bucket_labels['le'] = str(bound)
+            self.add(bucket_labels, cumulative, '_bucket')
+        self.add(labels, count, '_count')
+        self.add(labels, total, '_sum')
+        return self
+
+    @staticmethod
+    def escape(value):
+        if isinstance(value, str):
+            value = value.decode('utf-8', 'replace')
+        return unicode(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+    def format(self):
+        lines = ["# HELP %s %s" % (self.name, self.help), "# TYPE %s %s" % (self.name, self.metricType)]
+        for suffix, labels, value in self.samples:
+            label_text = ','.join('%s="%s"' % (key, self.escape(labels[key])) for key in sorted(labels))
+            if label_text != '':
+                label_text = '{' + label_text + '}'
+            lines.append("%s%s%s %s" % (self.name, suffix, label_text, repr(float(value)) if isinstance(value, float) else value))
+        return '\n'.join(lines) + '\n'
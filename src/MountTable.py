@@ -0,0 +1,134 @@
+#!/usr/bin/python
+
+import logging
+import os
+import re
+import threading
+
+# Filesystem type resolver based on /proc/self/mountinfo.
+# The mount table is read once and the resolved type is cached per device and per path,
+# so checking a repository does not fork any process.
+class MountTable:
+
+    mountInfoFile = '/proc/self/mountinfo'
+
+    def __init__(self):
+        # 'major:minor' -> filesystem type of mounted devices.
+        self.deviceTypes = {}
+        # (mount point, device, filesystem type), longest mount point first.
+        self.mounts = []
+        self.pathTypes = {}
+        self.pathFilesystemIds = {}
+        self.isLoaded = False
+        self.lock = threading.Lock()
+
+    # mountinfo escapes space, tab, newline and backslash as octal sequences.
+    @staticmethod
+    def unescape(field):
+        return re.sub(r'\\([0-7]{3})', lambda match: chr(int(match.group(1), 8)), field)
+
+    def load(self):
+        logger = logging.getLogger();
+
+        deviceTypes = {}
+        mounts = []
+        with open(self.mountInfoFile) as fh:
+            for line in fh:
+                # <id> <parent id> <major:minor> <root> <mount point> <options> [optional fields] - <type> <source> <super options>
+                fields = line.split()
+                if '-' not in fields:
+                    continue
+
+                separator = fields.index('-')
+                device = fields[2]
+                mountPoint = self.unescape(fields[4])
+                fsType = fields[separator + 1]
+
+                deviceTypes[device] = fsType
+                mounts.append((mountPoint, device, fsType))
+
+        mounts.sort(key=lambda mount: len(mount[0]), reverse=True)
+
+        with self.lock:
+            self.deviceTypes = deviceTypes
+            self.mounts = mounts
+            self.isLoaded = True
+
+        logger.debug("Loaded %d mounts from %s", len(mounts), self.mountInfoFile)
+
+    # Drops everything cached, mount table is read again on next lookup.
+    def invalidate(self):
+        with self.lock:
+            self.isLoaded = False
+            self.pathTypes = {}
+            self.pathFilesystemIds = {}
+
+    def getDevice(self, path):
+        st_dev = os.stat(path).st_dev
+        return "%d:%d" % (os.major(st_dev), os.minor(st_dev))
+
+    # Returns mount table entry (mount point, device, type) holding the path.
+    def getMount(self, path):
+        realPath = os.path.realpath(path)
+        for mount in self.mounts:
+            mountPoint = mount[0]
+            if realPath == mountPoint or realPath.startswith(mountPoint.rstrip('/') + '/'):
+                return mount
+        return None
+
+    # Returns device ('major:minor') of the mount holding the path, all subvolumes of a Btrfs filesystem share it.
+    def getFilesystemId(self, path):
+        filesystemId = self.pathFilesystemIds.get(path)
+        if filesystemId != None:
+            return filesystemId
+
+        if self.isLoaded == False:
+            self.load()
+
+        mount = self.getMount(path)
+        if mount != None:
+            filesystemId = mount[1]
+        else:
+            filesystemId = self.getDevice(path)
+
+        self.pathFilesystemIds[path] = filesystemId
+        return filesystemId
+
+    # Returns filesystem type of the path (as 'stat -f --format=%T' does) or None if path is not accessible.
+    def getFilesystemType(self, path):
+        logger = logging.getLogger();
+
+        with self.lock:
+            if self.isLoaded and path in self.pathTypes:
+                return self.pathTypes[path]
+
+        isReloaded = False
+        if self.isLoaded == False:
+            self.load()
+            isReloaded = True
+
+        try:
+            device = self.getDevice(path)
+        except OSError, err:
+            logger.debug("Failed to stat %s: %s", path, err)
+            return None
+
+        fsType = self.deviceTypes.get(device)
+        if fsType == None:
+            # Btrfs subvolumes have own anonymous devices which are not listed in mount table,
+            # the type is taken from the mount holding the path. The table is read again only when
+            # no mount holds the path, filesystems mounted later are seen after invalidate().
+            mount = self.getMount(path)
+            if mount == None and isReloaded == False:
+                self.load()
+                mount = self.getMount(path)
+            if mount != None:
+                fsType = mount[2]
+
+        with self.lock:
+            if fsType != None:
+                self.deviceTypes.setdefault(device, fsType)
+            self.pathTypes[path] = fsType
+
+        logger.debug("The path %s (device %s) is %s", path, device, fsType)
+        return fsType
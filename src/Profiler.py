@@ -0,0 +1,128 @@
+#!/usr/bin/python
+
+import bisect
+import contextlib
+import itertools
+import json
+import logging
+import Queue
+import threading
+import time
+
+# Timing spans of snapshot operations.
+# Every span is added to the latency histogram of its stage, with --profile it is also written
+# to the trace file as a JSON line tagged with the snapshot level. The file is written by its own
+# thread, so timed threads never wait for disk I/O. Spans being run are tracked, so the age of the
+# oldest operation in flight is known.
+class Profiler:
+
+    # Upper bounds of histogram buckets in seconds, the last bucket is unbounded.
+    buckets = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 10.0, 60.0)
+
+    def __init__(self):
+        # stage -> [bucket counts, count, sum of durations]
+        self.histograms = {}
+        # (stage, tag) -> duration of the last span
+        self.lastDurations = {}
+        # span id -> (stage, tag, start time)
+        self.inFlight = {}
+        self.spanIds = itertools.count()
+        # Trace lines to be written by the trace writer thread, None when tracing is off.
+        self.traceQueue = None
+        self.traceWriter = None
+        self.lock = threading.Lock()
+
+    # Starts writing every span to path as JSON lines.
+    def enableTrace(self, path):
+        trace_file = open(path, 'a')
+        trace_queue = Queue.Queue()
+        self.traceWriter = threading.Thread(target=self.writeTrace, args=[trace_file, trace_queue], name="trace_writer_thread")
+        self.traceWriter.daemon = True
+        self.traceWriter.start()
+        with self.lock:
+            self.traceQueue = trace_queue
+
+    # Writes queued trace lines until None is queued, flushed whenever the queue runs empty.
+    def writeTrace(self, traceFile, traceQueue):
+        try:
+            while True:
+                line = traceQueue.get()
+                if line == None:
+                    break
+                traceFile.write(line)
+                if traceQueue.empty():
+                    traceFile.flush()
+        finally:
+            traceFile.close()
+
+    # Stops tracing, lines queued so far are written first.
+    def closeTrace(self):
+        with self.lock:
+            trace_queue = self.traceQueue
+            self.traceQueue = None
+        if trace_queue != None:
+            trace_queue.put(None)
+            self.traceWriter.join()
+
+    # Times the enclosed block as stage, tag is the snapshot level full name (or None).
+    @contextlib.contextmanager
+    def span(self, stage, tag = None):
+        start_time = time.time()
+        span_id = next(self.spanIds)
+        with self.lock:
+            self.inFlight[span_id] = (stage, tag, start_time)
+        try:
+            yield
+        finally:
+            self.record(span_id, stage, tag, start_time, time.time() - start_time)
+
+    def record(self, spanId, stage, tag, startTime, duration):
+        line = None
+        with self.lock:
+            self.inFlight.pop(spanId, None)
+
+            histogram = self.histograms.get(stage)
+            if histogram == None:
+                histogram = self.histograms[stage] = [[0] * (len(self.buckets) + 1), 0, 0.0]
+            histogram[0][bisect.bisect_left(self.buckets, duration)] += 1
+            histogram[1] += 1
+            histogram[2] += duration
+            self.lastDurations[(stage, tag)] = duration
+
+            trace_queue = self.traceQueue
+            if trace_queue != None:
+                line = json.dumps({"ts": startTime,
+                                   "stage": stage,
+                                   "level": tag,
+                                   "duration": duration,
+                                   "thread": threading.current_thread().name}) + '\n'
+
+        if line != None:
+            trace_queue.put(line)
+
+    # Returns copy of the histograms: stage -> (bucket counts, count, sum of durations).
+    def getHistograms(self):
+        with self.lock:
+            return dict((stage, (list(histogram[0]), histogram[1], histogram[2])) for stage, histogram in self.histograms.items())
+
+    # Returns duration of the last span of the stage per tag.
+    def getLastDurations(self, stage):
+        with self.lock:
+            return dict((tag, duration) for (spanStage, tag), duration in self.lastDurations.items() if spanStage == stage)
+
+    # Returns (stage, tag, age in seconds) of the oldest span in flight, None if nothing runs.
+    def getOldestInFlight(self):
+        with self.lock:
+            if len(self.inFlight) == 0:
+                return None
+            stage, tag, start_time = min(self.inFlight.values(), key=lambda span: span[2])
+
+        return stage, tag, time.time() - start_time
+
+    def logSummary(self):
+        logger = logging.getLogger();
+
+        for stage, (counts, count, total) in sorted(self.getHistograms().items()):
+            logger.info("Stage %s: %d spans, %.3f sec average, buckets %s", stage, count, total / count, counts)
+
+profiler = Profiler()
@@ -0,0 +1,57 @@
+#!/usr/bin/python
+
+import glob
+import os
+
+# Repository template of the configuration file: every directory matching the path glob is a repository
+# with the template's stoppers and snapshot levels. {name} (directory name) and {path} (directory path)
+# are replaced in the repository name, stoppers, links and export targets, e.g.
+#   {"name": "tenant_{name}", "path": "/var/snapper/*",
+#    "snapshot_levels": [{"name": "ShortTerm", "frequency": 10, "unit": "min", "link": "{path}/ShortTerm"}]}
+class RepositoryTemplate:
+
+    def __init__(self, name, pathGlob, stoppers = None, snapshotLevels = None):
+        self.name = name
+        self.pathGlob = pathGlob
+        self.stoppers = stoppers if stoppers != None else []
+        self.snapshotLevels = snapshotLevels if snapshotLevels != None else []
+        # Directories matched by the last expansion.
+        self.matches = ()
+
+    # Creates template from its configuration file section.
+    @classmethod
+    def fromConfiguration(cls, section):
+        return cls(section.get('name', '{name}'), section['path'], section.get('stoppers', []), section.get('snapshot_levels', []))
+
+    # Returns sorted directories currently matching the path glob.
+    def match(self):
+        return tuple(sorted(path.rstrip('/') for path in glob.glob(self.pathGlob) if os.path.isdir(path)))
+
+    # True when directories were added or removed since the last expansion.
+    def isExpansionChanged(self):
+        return self.match() != self.matches
+
+    # Returns repository sections (as in 'repositories' of the configuration file) of all matching directories.
+    def expand(self):
+        self.matches = self.match()
+        return [self.expandRepository(path) for path in self.matches]
+
+    def expandRepository(self, path):
+        placeholders = {'name': os.path.basename(path), 'path': path}
+
+        snapshot_levels = []
+        for level in self.snapshotLevels:
+            level = dict(level)
+            level['link'] = level['link'].format(**placeholders)
+            level['stoppers'] = [stopper.format(**placeholders) for stopper in level.get('stoppers', [])]
+            if 'export' in level:
+                level['export'] = dict(level['export'], target=level['export']['target'].format(**placeholders))
+            snapshot_levels.append(level)
+
+        return {'name': self.name.format(**placeholders),
+                'path': path,
+                'stoppers': [stopper.format(**placeholders) for stopper in self.stoppers],
+                'snapshot_levels': snapshot_levels}
+
+    def __str__(self):
+        return "%s (%s, %d snapshot levels, %d repositories)" % (self.name, self.pathGlob, len(self.snapshotLevels), len(self.matches))
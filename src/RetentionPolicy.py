@@ -0,0 +1,106 @@
+#!/usr/bin/python
+
+import collections
+
+# Snapshot retention of a snapshot level, configured by the optional "retention" section of a level:
+#   keep                  - number of the most recent snapshots kept (default 2)
+#   hourly/daily/weekly   - number of hours/days/weeks for which the first snapshot is kept as well
+#                           (grandfather-father-son)
+#   max_deletes_per_tick  - max number of snapshots deleted by a single tick, 0 is unlimited.
+#                           The rest is deleted by the following ticks.
+class RetentionPolicy:
+
+    rules = ('hourly', 'daily', 'weekly')
+
+    def __init__(self, keep = 2, hourly = 0, daily = 0, weekly = 0, maxDeletesPerTick = 0):
+        # At least the latest snapshot is always kept, links point to it.
+        self.keep = max(1, keep)
+        self.counts = {'hourly': hourly, 'daily': daily, 'weekly': weekly}
+        self.maxDeletesPerTick = maxDeletesPerTick
+
+    @classmethod
+    def fromConfiguration(cls, retention):
+        if retention == None:
+            return cls()
+
+        return cls(int(retention.get('keep', 2)),
+                   int(retention.get('hourly', 0)),
+                   int(retention.get('daily', 0)),
+                   int(retention.get('weekly', 0)),
+                   int(retention.get('max_deletes_per_tick', 0)))
+
+    # Returns period (bucket) of the rule the creation time belongs to.
+    @staticmethod
+    def getBucket(rule, creatingTime):
+        if rule == 'hourly':
+            return (creatingTime.year, creatingTime.month, creatingTime.day, creatingTime.hour)
+        if rule == 'daily':
+            return (creatingTime.year, creatingTime.month, creatingTime.day)
+        return creatingTime.isocalendar()[:2]
+
+    def __eq__(self, other):
+        return isinstance(other, RetentionPolicy) and (self.keep, self.counts, self.maxDeletesPerTick) == (other.keep, other.counts, other.maxDeletesPerTick)
+
+    def __ne__(self, other):
+        return not self.__eq__(other)
+
+    def __str__(self):
+        return "keep %d, hourly %d, daily %d, weekly %d, max deletes per tick %d" % (self.keep,
+                                                                                  self.counts['hourly'],
+                                                                                  self.counts['daily'],
+                                                                                  self.counts['weekly'],
+                                                                                  self.maxDeletesPerTick)
+
+# Incremental retention state of a single snapshot level.
+# Snapshots are added oldest first. Each rule holds references to the snapshots it retains, a snapshot
+# is expired when the last reference is dropped. Adding a snapshot costs O(number of rules), no list
+# of snapshots is ever sorted or scanned.
+class RetentionState:
+
+    def __init__(self, policy):
+        self.policy = policy
+        self.recent = collections.deque()
+        # rule -> deque of (bucket, snapshot name), first snapshot of each bucket.
+        self.buckets = dict((rule, collections.deque()) for rule in policy.rules if policy.counts[rule] > 0)
+        self.references = {}
+        # Expired snapshots not deleted yet, oldest first.
+        self.expired = collections.deque()
+
+    def addReference(self, snapshotName):
+        self.references[snapshotName] = self.references.get(snapshotName, 0) + 1
+
+    def dropReference(self, snapshotName):
+        count = self.references.get(snapshotName, 0) - 1
+        if count > 0:
+            self.references[snapshotName] = count
+        else:
+            self.references.pop(snapshotName, None)
+            self.expired.append(snapshotName)
+
+    # Adds a new (latest) snapshot.
+    def add(self, snapshotName, creatingTime):
+        self.recent.append(snapshotName)
+        self.addReference(snapshotName)
+        if len(self.recent) > self.policy.keep:
+            self.dropReference(self.recent.popleft())
+
+        for rule, buckets in self.buckets.items():
+            bucket = self.policy.getBucket(rule, creatingTime)
+            if len(buckets) > 0 and buckets[-1][0] == bucket:
+                continue
+
+            buckets.append((bucket, snapshotName))
+            self.addReference(snapshotName)
+            if len(buckets) > self.policy.counts[rule]:
+                self.dropReference(buckets.popleft()[1])
+
+    # Returns expired snapshots to be deleted by this tick, bounded by max_deletes_per_tick.
+    def takeExpired(self):
+        count = len(self.expired)
+        if self.policy.maxDeletesPerTick > 0:
+            count = min(count, self.policy.maxDeletesPerTick)
+
+        return [self.expired.popleft() for idx in range(count)]
+
+    def getExpiredCount(self):
+        return len(self.expired)
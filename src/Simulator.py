@@ -0,0 +1,417 @@
+#!/usr/bin/python
+
+import copy
+import heapq
+import itertools
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+from datetime import datetime
+
+import BtrfsStorage
+import SpaceMonitor
+import TimerQueue
+
+# Virtual clock of the simulation, epoch seconds.
+class VirtualClock:
+
+    def __init__(self, now):
+        self.now = now
+
+    # time module functions used by conf_snapper.
+    def time(self):
+        return self.now
+
+    def ctime(self, seconds = None):
+        return time.ctime(self.now if seconds == None else seconds)
+
+# In-memory stand-in for BtrfsStorage, snapshots are names in sets and time is the virtual clock.
+# Index, retention and pruning logic of BtrfsStorage is used as is.
+class SimulatedStorage(BtrfsStorage.BtrfsStorage):
+
+    useNativeBackend = False
+
+    def __init__(self, clock):
+        BtrfsStorage.BtrfsStorage.__init__(self)
+        self.clock = clock
+        # snapshot folder -> snapshot names
+        self.folders = {}
+        self.operations = {'create': 0, 'delete': 0, 'export': 0}
+
+    def checkRepository(self, path):
+        return True
+
+    def getCurrentTime(self):
+        return datetime.fromtimestamp(self.clock.now)
+
+    def getSnapshotFolder(self, snapshot):
+        snapshotFolder = snapshot.repositoryPath + self.genSnapshotPathSubFolder + snapshot.snapshotName
+        self.folders.setdefault(snapshotFolder, set())
+        return snapshotFolder
+
+    def listSnapshotFolder(self, snapshot_folder):
+        return list(self.folders.get(snapshot_folder, ()))
+
+    def createSnapshotSubvolume(self, snapshot, snapshot_folder, snapshotName):
+        self.folders.setdefault(snapshot_folder, set()).add(snapshotName)
+        self.operations['create'] += 1
+        return True
+
+    def deleteSubvolumes(self, snapshot_folder, snapshotNames):
+        self.folders.get(snapshot_folder, set()).difference_update(snapshotNames)
+        self.operations['delete'] += len(snapshotNames)
+        return list(snapshotNames)
+
+    def isRepositoryUnchanged(self, snapshot):
+        return False
+
+    def getCleanerBacklog(self, path):
+        return 0
+
+class SimulatedExporter:
+
+    def __init__(self, storage):
+        self.storage = storage
+
+    def export(self, snapshot, snapshotName):
+        self.storage.operations['export'] += 1
+        return True
+
+    def getMetrics(self):
+        return {}
+
+    def forgetSnapshotLevel(self, snapshot):
+        pass
+
+    def restartExport(self, snapshot):
+        pass
+
+class SimulatedStatusPublisher:
+
+    def publish(self, status, immediate = False):
+        pass
+
+class SimulatedSpaceMonitor(SpaceMonitor.SpaceMonitor):
+
+    def getUsage(self, path):
+        return None
+
+# Stand-in for APScheduler: jobs keep the real CronTrigger created from the same fields
+# Snapper passes to add_job, their fire times drive the simulation.
+class SimulatedScheduler:
+
+    def __init__(self):
+        # job id -> (trigger, func, args)
+        self.jobs = {}
+
+    def add_job(self, func, trigger, args = None, name = None, id = None, **fields):
+        from apscheduler.triggers.cron import CronTrigger
+        self.jobs[id] = (CronTrigger(**fields), func, args or [])
+
+    def get_job(self, id):
+        return self.jobs.get(id)
+
+    def remove_job(self, id):
+        del self.jobs[id]
+
+    def remove_all_jobs(self):
+        self.jobs = {}
+
+    def shutdown(self):
+        pass
+
+# Stand-in for FilesystemExecutor: jobs of a filesystem run 'width' at a time in virtual time,
+# a job of a snapshot level already in flight is skipped as by FilesystemExecutor.
+# Each repository is assumed to have its own filesystem (as install_fs.sh creates them).
+class SimulatedExecutor:
+
+    def __init__(self, simulation, width):
+        self.simulation = simulation
+        self.width = width
+        self.inFlight = set()
+        self.levelLocks = {}
+        # filesystem -> number of running jobs, queued jobs
+        self.running = {}
+        self.queued = {}
+        self.skipped = 0
+
+    def getLevelLock(self, snapshot):
+        return self.levelLocks.setdefault(snapshot.getFullName(), threading.Lock())
+
+    def submit(self, snapshot, fn, *args):
+        if snapshot.getFullName() in self.inFlight:
+            self.skipped += 1
+            return None
+
+        self.inFlight.add(snapshot.getFullName())
+        filesystem = snapshot.repositoryPath
+        job = (snapshot, fn, args)
+        if self.running.get(filesystem, 0) < self.width:
+            self.running[filesystem] = self.running.get(filesystem, 0) + 1
+            self.simulation.push(self.simulation.clock.now, 'start', job)
+        else:
+            self.queued.setdefault(filesystem, []).append(job)
+        return True
+
+    # Called when a job has finished, starts next queued job of the filesystem.
+    def finish(self, snapshot):
+        self.inFlight.discard(snapshot.getFullName())
+        filesystem = snapshot.repositoryPath
+        queue = self.queued.get(filesystem)
+        if queue:
+            self.simulation.push(self.simulation.clock.now, 'start', queue.pop(0))
+        else:
+            self.running[filesystem] -= 1
+
+    def getInFlightCount(self):
+        return len(self.inFlight)
+
+    def shutdown(self, wait = False):
+        pass
+
+# Replays the schedule of a configuration on a virtual clock, using the real scheduling, snapshot
+# and link logic of conf_snapper, and reports scheduler overhead, job store size, peak concurrency
+# and link promotion lag.
+class Simulation:
+
+    # Virtual cost of storage operations in seconds, defines how long a job runs.
+    createCost = 0.05
+    deleteCost = 0.02
+    exportCost = 0.5
+    linkCost = 0.001
+    # Job store and queues are sampled once per sampleInterval virtual seconds.
+    sampleInterval = 60 * 60
+
+    def __init__(self, snapperModule, snapper, startTime):
+        self.module = snapperModule
+        self.snapper = snapper
+        self.clock = VirtualClock(startTime)
+        self.events = []
+        self.sequence = itertools.count()
+
+        self.storage = SimulatedStorage(self.clock)
+        self.link_promoter = TimerQueue.TimerQueue("simulated_link_promoter")
+        self.tick_delayer = TimerQueue.TimerQueue("simulated_tick_delayer")
+        self.links = {}
+        self.linkUpdates = 0
+        # snapshot level -> virtual time of the tick of its latest scheduled snapshot
+        self.tickTimes = {}
+        self.takeSnapshotFunction = None
+        self.promotionLags = []
+        self.tickOverheads = []
+        self.samples = []
+        self.runningJobs = 0
+        self.peakRunningJobs = 0
+        self.jobs = 0
+
+    def push(self, due, kind, data):
+        heapq.heappush(self.events, (due, next(self.sequence), kind, data))
+
+    # Replaces storage, executor, scheduler, links and status of conf_snapper by the simulated ones.
+    def install(self):
+        module = self.module
+        module.btrfs = self.storage
+        module.link_promoter = self.link_promoter
+        module.tick_delayer = self.tick_delayer
+        module.status_publisher = SimulatedStatusPublisher()
+        module.space_monitor = SimulatedSpaceMonitor(self.storage.mountTable)
+        module.snapshot_exporter = SimulatedExporter(self.storage)
+        module.createSymbolicLink = self.createSymbolicLink
+        self.takeSnapshotFunction = module.takeSnapshot
+        module.takeSnapshot = self.takeSnapshot
+        module.time = self.clock
+
+        self.snapper.sched = SimulatedScheduler()
+        self.snapper.executor = SimulatedExecutor(self, self.snapper.filesystemConcurrency)
+
+    # Records the tick time of scheduled snapshots, the link promotion is planned from it.
+    def takeSnapshot(self, snapper, snapshot, isManualCall = False, tickTime = None):
+        if tickTime != None:
+            self.tickTimes[snapshot.getFullName()] = tickTime
+        self.takeSnapshotFunction(snapper, snapshot, isManualCall, tickTime)
+
+    # Records link updates instead of touching the filesystem, measures link promotion lag.
+    def createSymbolicLink(self, snapshot, snapshotPath):
+        if snapshotPath == None:
+            return
+
+        self.linkUpdates += 1
+        self.links[snapshot.snapshotLink] = snapshotPath
+
+        snapshots = self.storage.getSnapshots(snapshot)
+        tick_time = self.tickTimes.get(snapshot.getFullName())
+        if len(snapshots) > 1 and snapshotPath == snapshots[-1] and tick_time != None:
+            # Promotion is planned in half of the interval after the tick.
+            self.promotionLags.append(self.clock.now - (tick_time + snapshot.getIntervalSeconds() / 2.0))
+
+    def scheduleNextFire(self, jobId, previousFireTime):
+        trigger = self.snapper.sched.jobs[jobId][0]
+        now = datetime.fromtimestamp(self.clock.now, trigger.timezone)
+        next_fire_time = trigger.get_next_fire_time(previousFireTime, now)
+        if next_fire_time != None:
+            self.push(time.mktime(next_fire_time.timetuple()), 'fire', (jobId, next_fire_time))
+
+    def fire(self, jobId, fireTime):
+        start_time = time.time()
+        job = self.snapper.sched.jobs.get(jobId)
+        if job == None:
+            return
+
+        trigger, func, args = job
+        func(*args)
+        self.scheduleNextFire(jobId, fireTime)
+        self.tickOverheads.append(time.time() - start_time)
+
+    def startJob(self, job):
+        snapshot, fn, args = job
+        level_lock = self.snapper.executor.getLevelLock(snapshot)
+        level_lock.acquire()
+
+        operations = dict(self.storage.operations)
+        links = self.linkUpdates
+        fn(*args)
+
+        duration = (self.createCost * (self.storage.operations['create'] - operations['create']) +
+                    self.deleteCost * (self.storage.operations['delete'] - operations['delete']) +
+                    self.exportCost * (self.storage.operations['export'] - operations['export']) +
+                    self.linkCost * (self.linkUpdates - links))
+
+        self.jobs += 1
+        self.runningJobs += 1
+        self.peakRunningJobs = max(self.peakRunningJobs, self.runningJobs)
+        self.push(self.clock.now + duration, 'end', (snapshot, level_lock))
+
+    def endJob(self, snapshot, levelLock):
+        self.runningJobs -= 1
+        levelLock.release()
+        self.snapper.executor.finish(snapshot)
+
+    def sample(self):
+        with self.link_promoter.condition:
+            pending_promotions = len(self.link_promoter.entries)
+        self.samples.append({'time': self.clock.now,
+                             'jobStoreSize': len(self.snapper.sched.jobs),
+                             'pendingEvents': len(self.events),
+                             'pendingPromotions': pending_promotions,
+                             'jobsInFlight': self.snapper.executor.getInFlightCount()})
+        self.push(self.clock.now + self.sampleInterval, 'sample', None)
+
+    def run(self, hours):
+        end_time = self.clock.now + hours * 60 * 60
+        wall_start_time = time.time()
+
+        for snapshotConf in self.snapper.configuration:
+            self.snapper.addSnapshotJob(snapshotConf)
+        for jobId in self.snapper.sched.jobs:
+            self.scheduleNextFire(jobId, None)
+        self.push(self.clock.now, 'sample', None)
+
+        promotions = 0
+        while True:
+            # Timer queue with the earliest pending timer: (due, queue).
+            timer_due, timer_queue = end_time + 1, None
+            for queue in (self.link_promoter, self.tick_delayer):
+                with queue.condition:
+                    due = queue.getNextDue()
+                if due != None and due < timer_due:
+                    timer_due, timer_queue = due, queue
+
+            event_due = self.events[0][0] if len(self.events) > 0 else end_time + 1
+            if min(timer_due, event_due) > end_time:
+                break
+
+            if timer_queue != None and timer_due <= event_due:
+                self.clock.now = max(self.clock.now, timer_due)
+                with timer_queue.condition:
+                    key, callback, args = timer_queue.popDue(self.clock.now)
+                callback(*args)
+                if timer_queue == self.link_promoter:
+                    promotions += 1
+                continue
+
+            due, sequence, kind, data = heapq.heappop(self.events)
+            self.clock.now = max(self.clock.now, due)
+            if kind == 'fire':
+                self.fire(*data)
+            elif kind == 'start':
+                self.startJob(data)
+            elif kind == 'end':
+                self.endJob(*data)
+            elif kind == 'sample':
+                self.sample()
+
+        return self.getReport(hours, time.time() - wall_start_time, promotions)
+
+    @staticmethod
+    def getStatistics(values):
+        if len(values) == 0:
+            return None
+        values = sorted(values)
+        return {'count': len(values),
+                'mean': sum(values) / len(values),
+                'p50': values[len(values) // 2],
+                'p99': values[min(len(values) - 1, int(len(values) * 0.99))],
+                'max': values[-1]}
+
+    def getReport(self, hours, wallTime, promotions):
+        state = self.module.state
+        with state.lock:
+            counters = {'taken': 0, 'skipped': 0, 'failed': 0}
+            for levelCounters in state.snapshotCounters.values():
+                for result, count in levelCounters.items():
+                    counters[result] += count
+
+        return {'snapshotLevels': len(self.snapper.configuration),
+                'virtualHours': hours,
+                'wallTimeSeconds': wallTime,
+                'ticks': len(self.tickOverheads),
+                'jobs': self.jobs,
+                'jobsSkippedInFlight': self.snapper.executor.skipped,
+                'snapshots': counters,
+                'storageOperations': self.storage.operations,
+                'linkUpdates': self.linkUpdates,
+                'linkPromotions': promotions,
+                'schedulerOverheadPerTickSeconds': self.getStatistics(self.tickOverheads),
+                'peakConcurrentJobs': self.peakRunningJobs,
+                'promotionLagSeconds': self.getStatistics(self.promotionLags),
+                'jobStoreSize': {'min': min(sample['jobStoreSize'] for sample in self.samples),
+                                 'max': max(sample['jobStoreSize'] for sample in self.samples)},
+                'samples': self.samples}
+
+# Makes scale copies of every repository of the configuration (names and paths get a -<n> suffix).
+def scaleConfiguration(configuration, scale):
+    if scale <= 1:
+        return configuration
+
+    scaled_configuration = []
+    for idx in range(scale):
+        for snapshotConf in configuration:
+            scaledConf = copy.copy(snapshotConf)
+            scaledConf.repositoryName = "%s-%d" % (snapshotConf.repositoryName, idx)
+            scaledConf.repositoryPath = "%s-%d" % (snapshotConf.repositoryPath, idx)
+            scaledConf.snapshotLink = "%s-%d" % (snapshotConf.snapshotLink, idx)
+            scaled_configuration.append(scaledConf)
+    return scaled_configuration
+
+# Runs the simulation of conf_snapper (the module, as run by __main__) for the parsed command line arguments,
+# prints the report as JSON.
+def run(snapperModule, args):
+    # Simulation needs neither root nor the service log folder.
+    snapperModule.log_file = os.path.join(tempfile.gettempdir(), 'conf_snapper_simulation.log')
+
+    snapper = snapperModule.Snapper()
+    snapper.logger.setLevel(logging.WARNING)
+
+    start_time = time.mktime((datetime.now().replace(hour=0, minute=0, second=0, microsecond=0)).timetuple())
+    simulation = Simulation(snapperModule, snapper, start_time)
+    simulation.install()
+
+    snapper.config(args.configuration_file.name if args.configuration_file != None else None)
+    snapper.configuration = scaleConfiguration(snapper.configuration, args.simulate_scale)
+
+    report = simulation.run(args.simulate_hours)
+    print json.dumps(report, indent=1, sort_keys=True)
+    return report
@@ -1,5 +1,7 @@
 #!/usr/bin/python
 
+import RetentionPolicy
+
 class TimeUnit(object):
     sec = 1
     min = 2
@@ -23,16 +25,46 @@ class SnapshotConfiguration:
     snapshotFrequency = 0;
     snapshotUnits = TimeUnit.sec;
     snapshotLink = "";
+    # Stopper files suspending this snapshot level only (repository and level stoppers).
+    stoppers = [];
+    # RetentionPolicy of the snapshot level.
+    retention = None;
+    # Directory or pipe incremental send streams of new snapshots are written to, None when not exported.
+    exportTarget = None;
+    # Configured shift of the ticks from the start of the interval in seconds, None when not configured.
+    phaseOffset = None;
     
-    def __init__(self, repositoryName, repositoryPath, snapshotName, snapshotFrequency, snapshotLink, snapshotUnit = TimeUnit.min):
+    def __init__(self, repositoryName, repositoryPath, snapshotName, snapshotFrequency, snapshotLink, snapshotUnit = TimeUnit.min, stoppers = None, retention = None, exportTarget = None, phaseOffset = None):
         self.repositoryName = repositoryName
         self.repositoryPath = repositoryPath
         self.snapshotName = snapshotName
         self.snapshotFrequency = snapshotFrequency
         self.snapshotLink = snapshotLink
         self.snapshotUnits = snapshotUnit
+        self.stoppers = stoppers if stoppers != None else []
+        self.retention = retention if retention != None else RetentionPolicy.RetentionPolicy()
+        self.exportTarget = exportTarget
+        self.phaseOffset = phaseOffset
         
     
+    # Returns snapshot interval in seconds.
+    def getIntervalSeconds(self):
+        unitSeconds = {
+            TimeUnit.sec: 1,
+            TimeUnit.min: 60,
+            TimeUnit.hour: 60*60,
+            TimeUnit.day: 60*60*24,
+        }
+        return self.snapshotFrequency * unitSeconds.get(self.snapshotUnits, 60)
+    
+    # True when both configurations produce the same snapshots and links (stoppers are not compared).
+    def isSameSchedule(self, other):
+        return (self.repositoryPath == other.repositoryPath and
+                self.snapshotFrequency == other.snapshotFrequency and
+                self.snapshotUnits == other.snapshotUnits and
+                self.phaseOffset == other.phaseOffset and
+                self.snapshotLink == other.snapshotLink)
+    
     def getFullName(self):
         return self.repositoryName + ":" + self.snapshotName
     
@@ -42,10 +74,18 @@ class SnapshotConfiguration:
                             "\t Snapshot Name: %s \n" \
                             "\t Snapshot Frequency: %s \n" \
                             "\t Snapshot Time Unit: %s \n" \
-                            "\t Snapshot Link: %s \n" % (self.getFullName(),
+                            "\t Snapshot Link: %s \n" \
+                            "\t Snapshot Stoppers: %s \n" \
+                            "\t Snapshot Retention: %s \n" \
+                            "\t Snapshot Export: %s \n" \
+                            "\t Snapshot Phase Offset: %s \n" % (self.getFullName(),
                                                          self.repositoryName, 
                                                          self.repositoryPath, 
                                                          self.snapshotName,
                                                          self.snapshotFrequency,
                                                          TimeUnit.tostring(self.snapshotUnits),
-                                                         self.snapshotLink)
\ No newline at end of file
+                                                         self.snapshotLink,
+                                                         self.stoppers,
+                                                         self.retention,
+                                                         self.exportTarget,
+                                                         self.phaseOffset)
\ No newline at end of file
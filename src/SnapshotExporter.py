@@ -0,0 +1,156 @@
+#!/usr/bin/python
+
+import errno
+import fcntl
+import logging
+import os
+import stat
+import subprocess
+import tempfile
+import threading
+import time
+
+import BtrfsIoctl
+
+# Exports new snapshots of a snapshot level as 'btrfs send' streams, incremental to the last exported
+# snapshot, so a replica ('btrfs receive') gets only the changes.
+# The target is a directory (a <snapshot name>.btrfs file per stream, renamed into place when complete)
+# or a named pipe. The stream is copied in chunks of chunkSize bytes, it is never held in memory.
+class SnapshotExporter:
+
+    chunkSize = 64 * 1024
+
+    def __init__(self, storage):
+        self.storage = storage
+        # Last snapshot exported per snapshot level, parent of the next stream (None sends a full stream).
+        self.lastExported = {}
+        # Per snapshot level: streams, failures, bytes, last stream bytes and duration.
+        self.metrics = {}
+        self.lock = threading.Lock()
+
+    # Returns parent of the new snapshot: the last exported snapshot, or the previous snapshot when nothing
+    # was exported since start. None means a full stream is sent.
+    def getParentSnapshot(self, snapshot, snapshotFolder, snapshotName):
+        logger = logging.getLogger();
+
+        snapshots = [name for name in self.storage.getSnapshots(snapshot) if name < snapshotName]
+        with self.lock:
+            if snapshot.getFullName() in self.lastExported:
+                parent = self.lastExported[snapshot.getFullName()]
+            else:
+                parent = snapshots[-1] if len(snapshots) > 0 else None
+
+        if parent != None and parent not in snapshots:
+            logger.info("Last exported snapshot %s of %s does not exist anymore, full stream is sent.", parent, snapshot.getFullName())
+            parent = None
+
+        if parent == None:
+            return None
+
+        try:
+            if BtrfsIoctl.isSubvolumeReadOnly(snapshotFolder + '/' + parent) == False:
+                logger.info("Snapshot %s of %s is not read-only, full stream is sent.", parent, snapshot.getFullName())
+                return None
+        except EnvironmentError, err:
+            logger.debug("Failed to get flags of %s/%s: [errno %d] %s", snapshotFolder, parent, err.errno, os.strerror(err.errno))
+
+        return parent
+
+    # Opens the target, returns (file object, temporary path to be renamed or None).
+    def openTarget(self, snapshot, snapshotName):
+        target = snapshot.exportTarget
+        if os.path.exists(target) and stat.S_ISFIFO(os.stat(target).st_mode):
+            # A pipe without reader fails right away (ENXIO) instead of blocking the job.
+            fd = os.open(target, os.O_WRONLY | os.O_NONBLOCK)
+            fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) & ~os.O_NONBLOCK)
+            return os.fdopen(fd, 'wb'), None
+
+        try:
+            os.makedirs(target)
+        except OSError, err:
+            if err.errno != errno.EEXIST:
+                raise
+
+        temporaryPath = os.path.join(target, snapshotName + '.btrfs.part')
+        return open(temporaryPath, 'wb'), temporaryPath
+
+    # Sends the new snapshot snapshotName of the level to its export target, returns False on failure.
+    def export(self, snapshot, snapshotName):
+        logger = logging.getLogger();
+
+        snapshot_folder = self.storage.getSnapshotFolder(snapshot)
+        parent = self.getParentSnapshot(snapshot, snapshot_folder, snapshotName)
+
+        send_command = ['btrfs', 'send']
+        if parent != None:
+            send_command += ['-p', snapshot_folder + '/' + parent]
+        send_command.append(snapshot_folder + '/' + snapshotName)
+        logger.debug("command is '%s' ", ' '.join(send_command))
+
+        start_time = time.time()
+        stream_bytes = 0
+        temporaryPath = None
+        try:
+            outfile, temporaryPath = self.openTarget(snapshot, snapshotName)
+            try:
+                #Errors go to a file, a pipe not read while streaming would block 'btrfs send' once full.
+                with tempfile.TemporaryFile() as errfile:
+                    process = subprocess.Popen(send_command, stdout=subprocess.PIPE, stderr=errfile)
+                    while True:
+                        chunk = process.stdout.read(self.chunkSize)
+                        if len(chunk) == 0:
+                            break
+                        outfile.write(chunk)
+                        stream_bytes += len(chunk)
+                    return_code = process.wait()
+                    errfile.seek(0)
+                    error_output = errfile.read()
+            finally:
+                outfile.close()
+
+            if return_code != 0:
+                raise OSError(errno.EIO, "btrfs send has failed (%d): %s" % (return_code, error_output.strip()[-1024:]))
+
+            if temporaryPath != None:
+                os.rename(temporaryPath, temporaryPath[:-len('.part')])
+        except EnvironmentError, err:
+            logger.error("Failed to export %s/%s to %s: %s", snapshot_folder, snapshotName, snapshot.exportTarget, err)
+            if temporaryPath != None and os.path.exists(temporaryPath):
+                os.unlink(temporaryPath)
+            self.addMetrics(snapshot, False, 0, time.time() - start_time)
+            return False
+
+        duration = time.time() - start_time
+        with self.lock:
+            self.lastExported[snapshot.getFullName()] = snapshotName
+        self.addMetrics(snapshot, True, stream_bytes, duration)
+
+        logger.info("Exported %s of %s (%s) to %s: %d bytes in %.3f sec.", snapshotName, snapshot.getFullName(),
+                    "incremental from " + parent if parent != None else "full", snapshot.exportTarget, stream_bytes, duration)
+        return True
+
+    def addMetrics(self, snapshot, isExported, streamBytes, duration):
+        with self.lock:
+            metrics = self.metrics.setdefault(snapshot.getFullName(), {'streams': 0, 'failures': 0, 'bytes': 0, 'lastBytes': 0, 'lastDuration': 0.0})
+            if isExported:
+                metrics['streams'] += 1
+                metrics['bytes'] += streamBytes
+                metrics['lastBytes'] = streamBytes
+            else:
+                metrics['failures'] += 1
+            metrics['lastDuration'] = duration
+
+    # Returns copy of the per level metrics.
+    def getMetrics(self):
+        with self.lock:
+            return dict((name, dict(metrics)) for name, metrics in self.metrics.items())
+
+    # Forgets the export history of the level (it was removed or changed).
+    def forgetSnapshotLevel(self, snapshot):
+        with self.lock:
+            self.lastExported.pop(snapshot.getFullName(), None)
+
+    # Next stream of the level is a full one (export target was changed).
+    def restartExport(self, snapshot):
+        with self.lock:
+            self.lastExported[snapshot.getFullName()] = None
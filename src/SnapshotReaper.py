@@ -0,0 +1,157 @@
+#!/usr/bin/python
+
+import logging
+import Queue
+import threading
+import time
+
+from Profiler import profiler
+
+# Background deleter of expired snapshots.
+# BtrfsStorage hands expired snapshot names over to the reaper so a slow delete never delays
+# link updates or other snapshot levels. Queued subvolumes are deleted in batches, and the reaper
+# backs off while the Btrfs cleaner has too many deleted subvolumes waiting for it, and after
+# a failed delete. Repeated failures of a level are reported as the runtime error of the state.
+class SnapshotReaper(threading.Thread):
+
+    # Max number of subvolumes deleted by a single storage operation.
+    batchSize = 16
+    # Cleaner backlog (deleted, not cleaned subvolumes) at which the reaper starts to back off.
+    cleanerBacklogLimit = 64
+    minBackoff = 1
+    maxBackoff = 60
+    # Number of failed deletes in a row after which the failure of the level is reported.
+    failureLimit = 3
+
+    # state (optional) has setRuntimeError(reason) and clearRuntimeError(reasonPrefix).
+    def __init__(self, storage, state = None):
+        threading.Thread.__init__(self, name="reaper_thread")
+        self.daemon = True
+        self.storage = storage
+        self.state = state
+        self.queue = Queue.Queue()
+        self.running = True
+        self.backoff = 0
+        # Total number of snapshots that failed to be deleted.
+        self.failedCount = 0
+        # snapshot level full name -> number of failed deletes in a row
+        self.levelFailures = {}
+
+    def enqueue(self, snapshot, snapshot_folder, snapshotNames):
+        logger = logging.getLogger();
+
+        for snapshotName in snapshotNames:
+            self.queue.put((snapshot, snapshot_folder, snapshotName))
+
+        if len(snapshotNames) > 0:
+            logger.debug("%d snapshots of %s queued for deletion, queue depth is %d.", len(snapshotNames), snapshot.getFullName(), self.getQueueDepth())
+
+    def getQueueDepth(self):
+        return self.queue.qsize()
+
+    def getFailedCount(self):
+        return self.failedCount
+
+    def stop(self):
+        self.running = False
+        self.queue.put(None)
+
+    def run(self):
+        logger = logging.getLogger();
+        logger.info("Snapshot reaper started.")
+
+        try:
+            while self.running:
+                batch = self.takeBatch()
+                if len(batch) > 0:
+                    self.deleteBatch(batch)
+                    self.waitForCleaner(batch[-1][1])
+        except Exception:
+            # A bug, not a failed delete: nothing would be deleted anymore, so it is made visible.
+            logger.exception("Snapshot reaper has failed.")
+            if self.state != None:
+                self.state.setRuntimeError("Snapshot reaper has failed, expired snapshots are not deleted.")
+            raise
+
+        logger.info("Snapshot reaper stopped, %d snapshots left in queue.", self.getQueueDepth())
+
+    # Blocks for the first item, then takes whatever is already queued up to batchSize.
+    def takeBatch(self):
+        batch = []
+        item = self.queue.get()
+        while item != None:
+            batch.append(item)
+            if len(batch) >= self.batchSize:
+                break
+            try:
+                item = self.queue.get_nowait()
+            except Queue.Empty:
+                break
+
+        if item == None:
+            self.running = False
+
+        return batch
+
+    def deleteBatch(self, batch):
+        logger = logging.getLogger();
+
+        # Group by snapshot level, a level has a single snapshot folder.
+        levels = {}
+        for snapshot, snapshot_folder, snapshotName in batch:
+            level = levels.setdefault(snapshot.getFullName(), (snapshot, snapshot_folder, []))
+            level[2].append(snapshotName)
+
+        is_failed = False
+        for snapshot, snapshot_folder, snapshotNames in levels.values():
+            try:
+                with profiler.span('reap', snapshot.getFullName()):
+                    deleted_snapshot_list = self.storage.deleteSubvolumes(snapshot_folder, snapshotNames)
+            except EnvironmentError, err:
+                logger.error("Failed to delete snapshots %s of %s: %s", snapshotNames, snapshot.getFullName(), err)
+                deleted_snapshot_list = []
+
+            self.storage.completeSnapshotDelete(snapshot, snapshotNames, deleted_snapshot_list)
+            if len(deleted_snapshot_list) < len(snapshotNames):
+                is_failed = True
+                self.countFailure(snapshot, len(snapshotNames) - len(deleted_snapshot_list))
+            else:
+                self.countSuccess(snapshot)
+
+        logger.debug("Deleted batch of %d snapshots, queue depth is %d.", len(batch), self.getQueueDepth())
+
+        if is_failed == False:
+            self.backoff = 0
+            return
+
+        # Failed snapshots are queued again by the next tick of their level, retrying at once would fail as well.
+        self.backoff = min(max(self.backoff * 2, self.minBackoff), self.maxBackoff)
+        logger.info("Reaper backs off for %d sec after a failed delete, queue depth is %d.", self.backoff, self.getQueueDepth())
+        time.sleep(self.backoff)
+
+    def getFailureReason(self, snapshot):
+        return "Snapshot reaper fails to delete snapshots of " + snapshot.getFullName()
+
+    def countFailure(self, snapshot, failedCount):
+        self.failedCount += failedCount
+        failures = self.levelFailures[snapshot.getFullName()] = self.levelFailures.get(snapshot.getFullName(), 0) + 1
+        if failures >= self.failureLimit and self.state != None:
+            self.state.setRuntimeError(self.getFailureReason(snapshot) + " (%d failed deletes in a row)." % failures)
+
+    def countSuccess(self, snapshot):
+        if self.levelFailures.pop(snapshot.getFullName(), 0) >= self.failureLimit and self.state != None:
+            self.state.clearRuntimeError(self.getFailureReason(snapshot))
+
+    # Sleeps while the cleaner of the filesystem is behind. Checked only when more work is queued.
+    def waitForCleaner(self, snapshot_folder):
+        logger = logging.getLogger();
+
+        while self.running and self.getQueueDepth() > 0:
+            backlog = self.storage.getCleanerBacklog(snapshot_folder)
+            if backlog < self.cleanerBacklogLimit:
+                self.backoff = 0
+                return
+
+            self.backoff = min(max(self.backoff * 2, self.minBackoff), self.maxBackoff)
+            logger.info("Btrfs cleaner is behind (%d subvolumes), reaper backs off for %d sec, queue depth is %d.", backlog, self.backoff, self.getQueueDepth())
+            time.sleep(self.backoff)
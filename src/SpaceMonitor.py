@@ -0,0 +1,125 @@
+#!/usr/bin/python
+
+import logging
+import os
+import threading
+import time
+
+import BtrfsIoctl
+
+class SpacePressure(object):
+    ok = "ok"
+    warning = "warning"
+    critical = "critical"
+
+# Tracks used data and metadata space of repository filesystems.
+# A filesystem is sampled at most once per sampleInterval seconds, repositories of the same
+# filesystem share the sample. Data usage comes from statvfs, metadata usage from the Btrfs
+# space info ioctl (metadata can run out while statvfs still reports free space).
+class SpaceMonitor:
+
+    # Thresholds in percent of used space, configured by the optional "space_pressure" section.
+    warningPercent = 85
+    criticalPercent = 95
+    sampleInterval = 30
+    # Snapshot interval is stretched up to this factor as usage goes from warning to critical.
+    maxIntervalFactor = 4
+
+    def __init__(self, mountTable):
+        self.mountTable = mountTable
+        # filesystem id -> (sample time, data usage percent, metadata usage percent)
+        self.samples = {}
+        self.lock = threading.Lock()
+
+    def configure(self, spacePressure):
+        if spacePressure == None:
+            spacePressure = {}
+
+        self.warningPercent = spacePressure.get('warning_percent', SpaceMonitor.warningPercent)
+        self.criticalPercent = spacePressure.get('critical_percent', SpaceMonitor.criticalPercent)
+        self.sampleInterval = spacePressure.get('sample_interval', SpaceMonitor.sampleInterval)
+        self.maxIntervalFactor = spacePressure.get('max_interval_factor', SpaceMonitor.maxIntervalFactor)
+
+    def sample(self, path):
+        logger = logging.getLogger();
+
+        st = os.statvfs(path)
+        filesystem_bytes = st.f_blocks * st.f_frsize
+        data_usage = 0.0
+        if st.f_blocks > 0:
+            data_usage = 100.0 * (st.f_blocks - st.f_bavail) / st.f_blocks
+
+        metadata_usage = 0.0
+        try:
+            space_info = BtrfsIoctl.getSpaceInfo(path)
+        except EnvironmentError, err:
+            logger.debug("Failed to get space info of %s: [errno %d] %s", path, err.errno, os.strerror(err.errno))
+            space_info = []
+
+        # Space not allocated to any block group yet, metadata can still grow into it
+        # (profiles storing more copies are not accounted).
+        unallocated = max(0, filesystem_bytes - sum(total for flags, total, used in space_info))
+        metadata_total = sum(total for flags, total, used in space_info if flags & BtrfsIoctl.BTRFS_BLOCK_GROUP_METADATA)
+        metadata_used = sum(used for flags, total, used in space_info if flags & BtrfsIoctl.BTRFS_BLOCK_GROUP_METADATA)
+        if metadata_total > 0:
+            metadata_usage = 100.0 * metadata_used / (metadata_total + unallocated)
+
+        logger.debug("Space usage of %s: data %.1f%%, metadata %.1f%%", path, data_usage, metadata_usage)
+        return data_usage, metadata_usage
+
+    # Returns (data usage, metadata usage) in percent of the filesystem holding path, sampled at most
+    # once per sampleInterval. Returns None when the usage can not be read.
+    def getUsage(self, path):
+        logger = logging.getLogger();
+
+        try:
+            filesystem_id = self.mountTable.getFilesystemId(path)
+        except OSError, err:
+            logger.debug("Failed to get filesystem of %s: %s", path, err)
+            return None
+
+        now = time.time()
+        with self.lock:
+            cached = self.samples.get(filesystem_id)
+            if cached != None and now - cached[0] < self.sampleInterval:
+                return cached[1:]
+
+        try:
+            usage = self.sample(path)
+        except OSError, err:
+            logger.warning("Failed to sample space usage of %s: %s", path, err)
+            return None
+
+        with self.lock:
+            self.samples[filesystem_id] = (now,) + usage
+        return usage
+
+    # Forgets the sample of the filesystem holding path, it is taken again on next access.
+    def invalidate(self, path):
+        with self.lock:
+            self.samples.pop(self.mountTable.getFilesystemId(path), None)
+
+    def getPressure(self, usage):
+        if usage == None:
+            return SpacePressure.ok
+
+        used = max(usage)
+        if used >= self.criticalPercent:
+            return SpacePressure.critical
+        if used >= self.warningPercent:
+            return SpacePressure.warning
+        return SpacePressure.ok
+
+    # Returns factor the snapshot interval is stretched by, 1 below the warning threshold.
+    def getIntervalFactor(self, usage):
+        if usage == None:
+            return 1.0
+
+        used = max(usage)
+        if used < self.warningPercent:
+            return 1.0
+        if used >= self.criticalPercent or self.criticalPercent <= self.warningPercent:
+            return float(self.maxIntervalFactor)
+
+        progress = (used - self.warningPercent) / float(self.criticalPercent - self.warningPercent)
+        return 1.0 + progress * (self.maxIntervalFactor - 1)
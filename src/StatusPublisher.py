@@ -0,0 +1,69 @@
+#!/usr/bin/python
+
+import json
+import logging
+import os
+import threading
+
+from Profiler import profiler
+
+# Writer of the service status file.
+# The file is written only when the status really changes, always through a temporary file
+# renamed over the old one, so readers never see a truncated file. Updates arriving within
+# coalesceDelay seconds are written once.
+class StatusPublisher:
+
+    coalesceDelay = 0.5
+
+    def __init__(self, path):
+        self.path = path
+        self.lastWritten = None
+        self.pending = None
+        self.timer = None
+        self.lock = threading.Lock()
+
+    # Publishes status dictionary, immediate=True writes it before returning (used before exit).
+    def publish(self, status, immediate = False):
+        with self.lock:
+            latest = self.pending if self.pending != None else self.lastWritten
+            if status == latest and immediate == False:
+                return
+
+            self.pending = dict(status)
+
+            if immediate == True:
+                self.writePending()
+            elif self.timer == None:
+                self.timer = threading.Timer(self.coalesceDelay, self.flush)
+                self.timer.daemon = True
+                self.timer.start()
+
+    def flush(self):
+        with self.lock:
+            self.writePending()
+
+    # Expects self.lock to be held.
+    def writePending(self):
+        logger = logging.getLogger();
+
+        if self.timer != None:
+            self.timer.cancel()
+            self.timer = None
+
+        status = self.pending
+        self.pending = None
+        if status == None or status == self.lastWritten:
+            return
+
+        temporaryPath = self.path + '.tmp'
+        try:
+            with profiler.span('write_status'):
+                with open(temporaryPath, 'w') as outfile:
+                    json.dump(status, outfile)
+                os.rename(temporaryPath, self.path)
+        except EnvironmentError, err:
+            logger.error("Failed to write status file %s: %s", self.path, err)
+            return
+
+        self.lastWritten = status
+        logger.info("Writing current status...")
@@ -0,0 +1,207 @@
+#!/usr/bin/python
+
+import ctypes
+import ctypes.util
+import errno
+import logging
+import os
+import select
+import struct
+import threading
+import time
+
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_CLOEXEC = 0x00080000
+
+WATCH_MASK = IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR
+
+# struct inotify_event { int wd; uint32_t mask; uint32_t cookie; uint32_t len; char name[]; }
+EVENT_FORMAT = 'iIII'
+EVENT_SIZE = struct.calcsize(EVENT_FORMAT)
+
+# Keeps track of stopper files with inotify watches on their parent folders, so checking
+# a stopper is a set lookup instead of a stat call on every tick.
+# Stoppers whose folder can not be watched (no inotify, folder does not exist) are checked
+# with os.path.exists as before.
+class StopperWatcher(threading.Thread):
+
+    # How often folders which could not be watched are retried, in seconds.
+    retryInterval = 30
+
+    def __init__(self):
+        threading.Thread.__init__(self, name="stopper_watcher_thread")
+        self.daemon = True
+        self.lock = threading.Lock()
+        self.fd = None
+        # watch descriptor -> folder, folder -> watch descriptor
+        self.watchFolders = {}
+        self.folderWatches = {}
+        # folder -> stopper paths in it
+        self.folderStoppers = {}
+        # existing stoppers of watched folders
+        self.existingStoppers = set()
+        self.libc = None
+
+    # inotify is opened on first watch() only, checking configuration does not need it.
+    def openInotify(self):
+        try:
+            try:
+                self.libc = ctypes.CDLL('libc.so.6', use_errno=True)
+            except OSError:
+                self.libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+            fd = self.libc.inotify_init1(IN_CLOEXEC)
+            if fd < 0:
+                raise OSError(ctypes.get_errno(), os.strerror(ctypes.get_errno()))
+            self.fd = fd
+        except (OSError, AttributeError), err:
+            logging.getLogger().warning("inotify is not available (%s), stoppers will be polled.", err)
+
+    # Adds stopper paths to be watched.
+    def watch(self, stoppers):
+        if self.libc == None:
+            self.openInotify()
+
+        for stopper in stoppers:
+            stopper = os.path.abspath(stopper)
+            folder = os.path.dirname(stopper)
+            with self.lock:
+                self.folderStoppers.setdefault(folder, set()).add(stopper)
+            self.addFolderWatch(folder)
+
+    def addFolderWatch(self, folder):
+        logger = logging.getLogger();
+
+        if self.fd == None:
+            return
+
+        with self.lock:
+            if folder in self.folderWatches:
+                # New stopper in already watched folder, only its current state is needed.
+                self.rescanFolder(folder)
+                return
+
+            wd = self.libc.inotify_add_watch(self.fd, folder, WATCH_MASK)
+            if wd < 0:
+                err = ctypes.get_errno()
+                logger.debug("Can not watch folder %s ([errno %d] %s), its stoppers will be polled.", folder, err, os.strerror(err))
+                return
+
+            self.watchFolders[wd] = folder
+            self.folderWatches[folder] = wd
+            # Checked after the watch exists, so no change can be missed in between.
+            self.rescanFolder(folder)
+
+        logger.debug("Watching stoppers in %s", folder)
+
+    # Expects self.lock to be held.
+    def rescanFolder(self, folder):
+        for stopper in self.folderStoppers.get(folder, ()):
+            if os.path.exists(stopper):
+                self.existingStoppers.add(stopper)
+            else:
+                self.existingStoppers.discard(stopper)
+
+    def isStopperActive(self, stopper):
+        stopper = os.path.abspath(stopper)
+        folder = os.path.dirname(stopper)
+        with self.lock:
+            if folder in self.folderWatches:
+                return stopper in self.existingStoppers
+
+        return os.path.exists(stopper)
+
+    # Returns the first active stopper of the list, None if none is active.
+    def getActiveStopper(self, stoppers):
+        for stopper in stoppers:
+            if self.isStopperActive(stopper):
+                return stopper
+        return None
+
+    def run(self):
+        logger = logging.getLogger();
+
+        if self.fd == None:
+            return
+
+        lastRetry = time.time()
+        while True:
+            if time.time() - lastRetry >= self.retryInterval:
+                lastRetry = time.time()
+                self.retryUnwatchedFolders()
+
+            try:
+                readable = select.select([self.fd], [], [], self.retryInterval)[0]
+            except select.error, err:
+                if err.args[0] == errno.EINTR:
+                    continue
+                raise
+
+            if len(readable) == 0:
+                continue
+
+            self.readEvents()
+
+    # Reads and handles pending inotify events, called by run() or by an EventEngine when the fd is readable.
+    def readEvents(self):
+        logger = logging.getLogger();
+
+        try:
+            self.handleEvents(os.read(self.fd, 64 * 1024))
+        except Exception:
+            logger.exception("Failed to handle stopper events.")
+
+    def retryUnwatchedFolders(self):
+        with self.lock:
+            folders = [folder for folder in self.folderStoppers if folder not in self.folderWatches]
+
+        for folder in folders:
+            if os.path.isdir(folder):
+                self.addFolderWatch(folder)
+
+    def handleEvents(self, data):
+        logger = logging.getLogger();
+
+        offset = 0
+        with self.lock:
+            while offset + EVENT_SIZE <= len(data):
+                wd, mask, cookie, length = struct.unpack_from(EVENT_FORMAT, data, offset)
+                name = data[offset + EVENT_SIZE:offset + EVENT_SIZE + length].rstrip('\0')
+                offset += EVENT_SIZE + length
+
+                if mask & IN_Q_OVERFLOW:
+                    logger.warning("Stopper events were lost, rescanning all stoppers.")
+                    for folder in self.folderWatches:
+                        self.rescanFolder(folder)
+                    continue
+
+                folder = self.watchFolders.get(wd)
+                if folder == None:
+                    continue
+
+                if mask & (IN_IGNORED | IN_DELETE_SELF | IN_MOVE_SELF):
+                    # Folder is gone, its stoppers are polled until it can be watched again.
+                    logger.debug("Stopper folder %s is not watched anymore.", folder)
+                    del self.watchFolders[wd]
+                    self.folderWatches.pop(folder, None)
+                    if not mask & IN_IGNORED:
+                        self.libc.inotify_rm_watch(self.fd, wd)
+                    continue
+
+                stopper = os.path.join(folder, name)
+                if stopper not in self.folderStoppers.get(folder, ()):
+                    continue
+
+                if mask & (IN_CREATE | IN_MOVED_TO):
+                    logger.info("Stopper %s has been created.", stopper)
+                    self.existingStoppers.add(stopper)
+                elif mask & (IN_DELETE | IN_MOVED_FROM):
+                    logger.info("Stopper %s has been removed.", stopper)
+                    self.existingStoppers.discard(stopper)
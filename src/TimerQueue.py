@@ -0,0 +1,106 @@
+#!/usr/bin/python
+
+import heapq
+import itertools
+import logging
+import threading
+import time
+
+# Keyed one-shot timers served by a single thread from a heap.
+# A key has at most one pending timer: scheduling it again replaces the pending one
+# (the old heap entry is dropped lazily when it reaches the top).
+class TimerQueue(threading.Thread):
+
+    def __init__(self, name = "timer_thread"):
+        threading.Thread.__init__(self, name=name)
+        self.daemon = True
+        # (due time, sequence, key)
+        self.heap = []
+        # key -> (due time, sequence, callback, args)
+        self.entries = {}
+        self.sequence = itertools.count()
+        self.condition = threading.Condition()
+        self.running = True
+        # Called when a timer is scheduled, set when the queue is served by an EventEngine instead of its thread.
+        self.wakeup = None
+
+    # Schedules callback(*args) at due time (epoch seconds), replacing pending timer of the key.
+    def schedule(self, key, due, callback, *args):
+        with self.condition:
+            sequence = next(self.sequence)
+            self.entries[key] = (due, sequence, callback, args)
+            heapq.heappush(self.heap, (due, sequence, key))
+            self.condition.notify()
+            if self.wakeup != None:
+                self.wakeup()
+
+    def cancel(self, key):
+        with self.condition:
+            self.entries.pop(key, None)
+
+    def isPending(self, key):
+        with self.condition:
+            return key in self.entries
+
+    def getPendingCount(self):
+        with self.condition:
+            return len(self.entries)
+
+    def stop(self):
+        with self.condition:
+            self.running = False
+            self.condition.notify()
+
+    # Removes and returns the first expired timer as (key, callback, args), None when nothing is due.
+    # Expects self.condition to be held.
+    def popDue(self, now):
+        while len(self.heap) > 0:
+            due, sequence, key = self.heap[0]
+            entry = self.entries.get(key)
+            if entry == None or entry[1] != sequence:
+                # Cancelled or replaced.
+                heapq.heappop(self.heap)
+                continue
+
+            if due > now:
+                return None
+
+            heapq.heappop(self.heap)
+            del self.entries[key]
+            return (key, entry[2], entry[3])
+
+        return None
+
+    # Returns due time of the next pending timer or None. Expects self.condition to be held.
+    def getNextDue(self):
+        while len(self.heap) > 0:
+            due, sequence, key = self.heap[0]
+            entry = self.entries.get(key)
+            if entry != None and entry[1] == sequence:
+                return due
+            heapq.heappop(self.heap)
+        return None
+
+    def run(self):
+        logger = logging.getLogger();
+
+        while True:
+            with self.condition:
+                timer = None
+                while self.running and timer == None:
+                    now = time.time()
+                    timer = self.popDue(now)
+                    if timer != None:
+                        break
+
+                    next_due = self.getNextDue()
+                    self.condition.wait(None if next_due == None else next_due - now)
+
+                if self.running == False:
+                    return
+
+            key, callback, args = timer
+            try:
+                callback(*args)
+            except Exception:
+                logger.exception("Timer %s has failed.", key)
@@ -5,32 +5,51 @@
     in a file. 
 """
 
-import argparse
-import datetime
+import hashlib
 import json
 import logging
 import os
+import random
 import signal
 import socket
 import sys
 import threading
 import time
 import traceback
-# requires installation of schedule
-# sudo apt-get -y install python-pip
-# sudo pip install apscheduler
-from apscheduler.schedulers.blocking import BlockingScheduler
 from logging.handlers import RotatingFileHandler
 
+process_start_time = time.time()
+
 import BtrfsStorage
+import Heartbeat
+import MetricsServer
+import RepositoryTemplate
 import SnapshotConfiguration
+import SnapshotExporter
+import SnapshotReaper
+import SpaceMonitor
+import StatusPublisher
+import StopperWatcher
+import TimerQueue
+from Profiler import profiler
+from RetentionPolicy import RetentionPolicy
 from SnapshotConfiguration import TimeUnit
+from SpaceMonitor import SpacePressure
 
 log_file_name = 'conf_snapper.log';
 log_file = '/var/log/conf_snapper/' + log_file_name;
 
 global_stopper_list = [];
 
+#Watches stopper files, so a job does not stat them on every tick.
+stopper_watcher = StopperWatcher.StopperWatcher()
+
+#Pending promotions of snapshot links to the latest snapshot, at most one per snapshot level.
+link_promoter = TimerQueue.TimerQueue("link_promoter_thread")
+
+#Jittered submissions of snapshot levels, at most one per snapshot level.
+tick_delayer = TimerQueue.TimerQueue("tick_delayer_thread")
+
 #TODO: change DEBUG to INFO (before full production deployment) 
 log_level = logging.DEBUG
 
@@ -39,6 +58,19 @@ btrfs = BtrfsStorage.BtrfsStorage()
 
 snapper_status_file = "/var/log/conf_snapper/snapper_status.json"
 
+status_publisher = StatusPublisher.StatusPublisher(snapper_status_file)
+
+#Sends new snapshots of exported levels to their export targets.
+snapshot_exporter = SnapshotExporter.SnapshotExporter(btrfs)
+
+#Cached space usage of repository filesystems.
+space_monitor = SpaceMonitor.SpaceMonitor(btrfs.mountTable)
+
+snapper_heartbeat_file = "/var/log/conf_snapper/snapper_heartbeat.json"
+
+#Liveness file checked by service_watcher.sh, tracks completed ticks of every snapshot level.
+heartbeat = Heartbeat.Heartbeat(snapper_heartbeat_file)
+
 class StateStatus(object):
     up = "up"
     down = "down"
@@ -51,18 +83,48 @@ class State:
     configurationErrorReason = ""
     hasRuntimeError = False;
     runtimeErrorReason = ""
+    # Number of snapshots taken, skipped (unchanged repository, low space) and failed per snapshot level.
+    snapshotCounters = {}
+    # Jobs of different filesystems update the state concurrently.
+    lock = threading.RLock()
 
-    def writeStatusJson(self):
-        logger = logging.getLogger();
-        json_data_string = {}
-        json_data_string["status"] = self.status        
-        json_data_string["hasConfigurationError"] = self.hasConfigurationError
-        json_data_string["hasRuntimeError"] = self.hasRuntimeError
-        json_data_string["configurationErrorReason"] = self.configurationErrorReason
-        json_data_string["runtimeErrorReason"] = self.runtimeErrorReason
-        with open(snapper_status_file, 'w') as outfile:
-            json.dump(json_data_string, outfile)
-        logger.info("Writing current status...")    
+    # Publishes the status, it is written only if changed. Bursts of updates are coalesced 
+    # unless immediate is set (used right before exit).
+    def writeStatusJson(self, immediate = False):
+        with self.lock:
+            json_data_string = {}
+            json_data_string["status"] = self.status        
+            json_data_string["hasConfigurationError"] = self.hasConfigurationError
+            json_data_string["hasRuntimeError"] = self.hasRuntimeError
+            json_data_string["configurationErrorReason"] = self.configurationErrorReason
+            json_data_string["runtimeErrorReason"] = self.runtimeErrorReason
+            status_publisher.publish(json_data_string, immediate)
+
+    def setStatus(self, status):
+        with self.lock:
+            self.status = status
+            self.writeStatusJson()
+
+    def setRuntimeError(self, reason):
+        with self.lock:
+            self.hasRuntimeError = True
+            self.runtimeErrorReason = reason
+            self.writeStatusJson()
+
+    # Clears the runtime error if it is the one starting with reasonPrefix (the cause is gone).
+    def clearRuntimeError(self, reasonPrefix):
+        with self.lock:
+            if self.hasRuntimeError == True and self.runtimeErrorReason.startswith(reasonPrefix):
+                self.hasRuntimeError = False
+                self.runtimeErrorReason = ""
+                self.writeStatusJson()
+
+    # Counts snapshot result ('taken', 'skipped' or 'failed') of the level, returns the updated count.
+    def countSnapshot(self, snapshot, result):
+        with self.lock:
+            counters = self.snapshotCounters.setdefault(snapshot.getFullName(), {'taken': 0, 'skipped': 0, 'failed': 0})
+            counters[result] += 1
+            return counters[result]
 
     def reset(self):
         self.status = StateStatus.down;
@@ -84,20 +146,15 @@ def getPreviousPathToSnapshot(snapshots, snappshot):
     logger.debug(snapshots)
     
     if(snapshot_len == 0) :
-        logger.error("Wrong number of snapshots (%d), 2 is expected, returns None", snapshot_len);
-        state.hasRuntimeError = True;
-        state.hasRuntimeError = "Wrong number of snapshots " + snapshot_len + " 2 is expected. Snapshot: " + snappshot.snapshotName;
-        state.writeStatusJson();
+        logger.error("Wrong number of snapshots (%d), at least 1 is expected, returns None", snapshot_len);
+        state.setRuntimeError("Wrong number of snapshots " + str(snapshot_len) + " at least 1 is expected. Snapshot: " + snappshot.snapshotName);
         return None
     
-    if(snapshot_len > 2) :
-        logger.error("Wrong number of snapshots (%d), 2 is expected, takes the last %s", snapshot_len, snapshots[-1]);
-        state.hasRuntimeError = True;
-        state.hasRuntimeError = "Wrong number of snapshots " + snapshot_len + " 2 is expected, takes the last " + snapshots[-1] + ".Snapshot: " + snappshot.snapshotName;
-        state.writeStatusJson();        
+    # Retention policy may keep a deeper history, the previous snapshot is the one before the last.
+    if(snapshot_len == 1) :
         return snapshots[-1]
     
-    return snapshots[0]
+    return snapshots[-2]
 
 # Function returns last snapshot. Expects time sorted list in snapshots.
 def getLastPathToSnapshot(snapshots, snappshot):
@@ -112,7 +169,7 @@ def getLastPathToSnapshot(snapshots, snappshot):
     
     return snapshots[-1]
     
-#Function creates or updates (remove->create) symbolic link for given snapshot.         
+#Function creates or atomically updates (create temporary->rename) symbolic link for given snapshot.         
 def createSymbolicLink(snapshot, snapshotPath):
     logger = logging.getLogger();
     
@@ -131,105 +188,276 @@ def createSymbolicLink(snapshot, snapshotPath):
         logger.error("The script was run without root privileges. Symbolic link will not be created.")
     else:
         if os.path.islink(symbolicLinkPath):
-            logger.debug("The path %s exist, removing it.", symbolicLinkPath)
-            os.unlink(symbolicLinkPath)
+            if os.readlink(symbolicLinkPath) == fullName:
+                logger.debug("The path %s already points to %s, nothing to do.", symbolicLinkPath, fullName)
+                return
+            logger.debug("The path %s exist, replacing it.", symbolicLinkPath)
         else:
             logger.debug("The path %s does not exist.", symbolicLinkPath)
-        os.symlink(fullName, symbolicLinkPath)
+        
+        #rename() replaces the link in one step, readers never see a missing link.
+        temporaryLinkPath = "%s.%d.tmp" % (symbolicLinkPath, threading.current_thread().ident)
+        if os.path.lexists(temporaryLinkPath):
+            os.unlink(temporaryLinkPath)
+        os.symlink(fullName, temporaryLinkPath)
+        try:
+            os.rename(temporaryLinkPath, symbolicLinkPath)
+        except OSError:
+            os.unlink(temporaryLinkPath)
+            raise
     
 
-def isServiceDisabled():
+# Global stoppers suspend the whole service, stoppers of the snapshot level suspend that level only.
+def isServiceDisabled(snapshot = None):
     logger = logging.getLogger();
     logger.debug("Checking if snapshot should be taken.")
     
-    for stopper in global_stopper_list:
-        if os.path.exists(stopper) == True:
-            logger.debug("File %s exists!", stopper)
-            state.status = StateStatus.suspended;
-            state.writeStatusJson();
-            return False;
+    stopper = stopper_watcher.getActiveStopper(global_stopper_list)
+    if stopper != None:
+        logger.debug("File %s exists!", stopper)
+        state.setStatus(StateStatus.suspended);
+        return False;
         
-    state.status = StateStatus.up
-    state.writeStatusJson();
+    state.setStatus(StateStatus.up);
+    
+    if snapshot != None:
+        stopper = stopper_watcher.getActiveStopper(snapshot.stoppers)
+        if stopper != None:
+            logger.debug("File %s exists, %s is suspended.", stopper, snapshot.getFullName())
+            return False;
+    
     return True;
     
 
 # Creates snapshot according to snapshot configuration. 
 # Mainly, this function is used by scheduler, but also can be used directly from code.
 # The difference between sched and manual call is future link updates which are not created in manual creation. 
-def takeSnapshot(snapper, snapshot, isManualCall = False):
+# tickTime is the time the scheduler fired the tick (before jitter and queueing), the link promotion is planned from it.
+def takeSnapshot(snapper, snapshot, isManualCall = False, tickTime = None):
 #         self.logger.info("I'm working....")
     snapper.logger.info("Snapshot %s will be taken", snapshot.getFullName())
-    if isServiceDisabled() == False:
+    if isServiceDisabled(snapshot) == False:
         snapper.logger.info("Service is disabled, ignoring...");
         return;
     
-    if btrfs.takeSnapshot(snapshot) == False:
-        state.hasRuntimeError = True;
-        state.runtimeErrorReason = "Failed to create snapshot for " + snapshot.getFullName() + " repository";
+    if isManualCall == False and snapper.skipUnchangedSnapshots == True and btrfs.isRepositoryUnchanged(snapshot):
+        #Nothing to snapshot, the latest snapshot and the link stay as they are.
+        skipped_count = state.countSnapshot(snapshot, 'skipped')
+        snapper.logger.info("Repository of %s has not changed, snapshot is skipped (%d skipped so far).", snapshot.getFullName(), skipped_count)
+        return;
+    
+    if isSpaceLow(snapper, snapshot, isManualCall) == True:
+        state.countSnapshot(snapshot, 'skipped')
+        return;
     
-    current_snapshots = btrfs.deleteSnapshot(snapshot)
+    with profiler.span('create', snapshot.getFullName()):
+        is_created = btrfs.takeSnapshot(snapshot)
+    
+    state.countSnapshot(snapshot, 'taken' if is_created == True else 'failed')
+    
+    if is_created == False:
+        state.setRuntimeError("Failed to create snapshot for " + snapshot.getFullName() + " repository");
+    elif snapshot.exportTarget != None:
+        #Exported before pruning, so the parent of the stream still exists.
+        with profiler.span('export', snapshot.getFullName()):
+            is_exported = snapshot_exporter.export(snapshot, btrfs.getSnapshots(snapshot)[-1])
+        if is_exported == False:
+            state.setRuntimeError("Failed to export snapshot of " + snapshot.getFullName() + " to " + snapshot.exportTarget);
+    
+    with profiler.span('prune', snapshot.getFullName()):
+        current_snapshots = btrfs.deleteSnapshot(snapshot)
     #assuming all file names are sorted according to creation time.
     
-    createSymbolicLink(snapshot, getPreviousPathToSnapshot(current_snapshots, snapshot));
+    with profiler.span('link', snapshot.getFullName()):
+        createSymbolicLink(snapshot, getPreviousPathToSnapshot(current_snapshots, snapshot));
     
     if isManualCall == False:
-        #add new job for replacing symbolic link to latest one
-        time_now = int(time.time())
-        
-        if snapshot.snapshotUnits == TimeUnit.sec:
-            time_now += (snapshot.snapshotFrequency/2)
-        elif snapshot.snapshotUnits == TimeUnit.min:
-            time_now += ((snapshot.snapshotFrequency*60)/2)
-        elif snapshot.snapshotUnits == TimeUnit.hour:
-            time_now += ((snapshot.snapshotFrequency*60*60)/2)
-        elif snapshot.snapshotUnits == TimeUnit.day:
-            time_now += ((snapshot.snapshotFrequency*60*60*24)/2)
-        else:
-            snapper.logger.error("Wrong time unit.")
-        
-        nextTimeStr = datetime.datetime.fromtimestamp(time_now).strftime("%Y-%m-%d %H:%M:%S")
-        snapper.logger.debug('nextTimeStr: ' + nextTimeStr)
+        #replace symbolic link by the latest one in half of the interval, it replaces a pending promotion of this level.
+        promotion_time = (tickTime if tickTime != None else time.time()) + snapshot.getIntervalSeconds() / 2.0
+        snapper.logger.debug("Link of %s will be promoted at %s", snapshot.getFullName(), time.ctime(promotion_time))
         
-        snapper.sched.add_job(updateSnapshotLink, 'date', run_date=nextTimeStr, args=[current_snapshots, snapshot])
+        link_promoter.schedule(snapshot.getFullName(), promotion_time, updateSnapshotLink, snapper, snapshot)
     
 
-# Updates snapshot link scheduled by scheduler. 
-def updateSnapshotLink(current_snapshots, snapshot):
+# Checks space usage of the snapshot's filesystem. Under pressure the level is pruned to its retention 
+# minimum first and scheduled snapshots are taken less often, returns True when the snapshot should not be taken.
+def isSpaceLow(snapper, snapshot, isManualCall):
+    space_error = "Filesystem of " + snapshot.repositoryPath + " is almost full"
+    
+    usage = space_monitor.getUsage(snapshot.repositoryPath)
+    pressure = space_monitor.getPressure(usage)
+    if pressure != SpacePressure.ok:
+        snapper.logger.warning("Filesystem of %s is low on space (data %.1f%%, metadata %.1f%% used).", snapshot.getFullName(), usage[0], usage[1])
+        snapshot_count = len(btrfs.getSnapshots(snapshot))
+        with profiler.span('prune', snapshot.getFullName()):
+            if len(btrfs.deleteSnapshotsToMinimum(snapshot)) < snapshot_count:
+                #Usage is sampled again, the deleted snapshots may have freed enough.
+                space_monitor.invalidate(snapshot.repositoryPath)
+                usage = space_monitor.getUsage(snapshot.repositoryPath)
+                pressure = space_monitor.getPressure(usage)
+    
+    if pressure == SpacePressure.ok:
+        state.clearRuntimeError(space_error)
+        return False
+    
+    if pressure == SpacePressure.critical:
+        state.setRuntimeError(space_error + " (data %.1f%%, metadata %.1f%% used), snapshot of %s is skipped." % (usage[0], usage[1], snapshot.getFullName()));
+        return True
+    
+    if isManualCall == True:
+        return False
+    
+    #Takes the tick closest to the stretched interval.
+    interval = snapshot.getIntervalSeconds()
+    stretched_interval = interval * space_monitor.getIntervalFactor(usage)
+    latest_snapshot_age = btrfs.getLatestSnapshotAge(snapshot)
+    if latest_snapshot_age != None and latest_snapshot_age + interval / 2.0 < stretched_interval:
+        snapper.logger.info("Snapshot of %s is postponed, interval is stretched to %d sec.", snapshot.getFullName(), stretched_interval)
+        return True
+    
+    return False
+
+# Hands takeSnapshot over to the executor of the snapshot's filesystem. 
+def submitSnapshot(snapper, snapshot, tickTime = None):
+    snapper.executor.submit(snapshot, runScheduledSnapshot, snapper, snapshot, tickTime)
+
+# Executor job of a scheduled tick, the completed tick is recorded by the heartbeat. 
+def runScheduledSnapshot(snapper, snapshot, tickTime):
+    try:
+        takeSnapshot(snapper, snapshot, False, tickTime)
+    finally:
+        heartbeat.recordTick(snapshot)
+
+# Scheduler job of a schedule bucket, submits every snapshot level of the bucket, 
+# each after its random jitter when max_jitter is set. 
+def submitBucket(snapper, bucketId):
+    tick_time = time.time()
+    for snapshot in snapper.getBucketMembers(bucketId):
+        jitter = snapper.getJitter(snapshot)
+        if jitter > 0:
+            tick_delayer.schedule(snapshot.getFullName(), tick_time + jitter, submitSnapshot, snapper, snapshot, tick_time)
+        else:
+            submitSnapshot(snapper, snapshot, tick_time)
+
+# Updates snapshot link to the latest snapshot, scheduled by link promoter. 
+def updateSnapshotLink(snapper, snapshot):
     logger = logging.getLogger();
     logger.debug("Going to update symbolic link to latest snapshot.\n")
     
-    if isServiceDisabled() == False:
+    if isServiceDisabled(snapshot) == False:
         snapper.logger.info("Service is disabled, ignoring...");
         return;
 
-    createSymbolicLink(snapshot, getLastPathToSnapshot(current_snapshots, snapshot));
+    level_lock = snapper.executor.getLevelLock(snapshot)
+    if level_lock.acquire(False) == False:
+        #A job of this level is running, try again shortly unless it has scheduled a newer promotion.
+        logger.debug("%s is busy, postponing link update.", snapshot.getFullName())
+        if link_promoter.isPending(snapshot.getFullName()) == False:
+            link_promoter.schedule(snapshot.getFullName(), time.time() + 1, updateSnapshotLink, snapper, snapshot)
+        return;
+    
+    try:
+        #Latest snapshot is taken from current state, not from the time the promotion was scheduled.
+        with profiler.span('promote_link', snapshot.getFullName()):
+            createSymbolicLink(snapshot, getLastPathToSnapshot(btrfs.getSnapshots(snapshot), snapshot));
+    finally:
+        level_lock.release()
     
 # Cleans all jobs and terminates a scheduler. 
 def shutdown(snapper):
     snapper.sched.remove_all_jobs();
     snapper.sched.shutdown();
+    
+    if snapper.executor != None:
+        snapper.executor.shutdown();
+    
+    link_promoter.stop();
+    tick_delayer.stop();
+    heartbeat.stop();
+    
+    if btrfs.reaper != None:
+        btrfs.reaper.stop();
+    
+    profiler.logSummary();
+    profiler.closeTrace();
 
 # Global helper for all snapshots cleaning.
 # Can be used for manual cleaning as well as Btrfs uninstal. 
-def detele_all_snapshots_for_all_repositories(snapper):
+# Filesystems are cleaned in parallel, snapshot levels of a filesystem one after another. With waitForCleaner 
+# it returns when the Btrfs cleaner of every filesystem has removed the deleted subvolumes.
+def detele_all_snapshots_for_all_repositories(snapper, waitForCleaner = False):
+    from concurrent.futures import ThreadPoolExecutor
+    
     logger = logging.getLogger();
     logger.info("Going to delete all snapshots for all repositories.")
     print "Going to delete all snapshots for all repositories.\n";
+    
+    #filesystem id -> snapshot levels of its repositories
+    filesystems = {}
     for snapshot in snapper.configuration:
+        filesystems.setdefault(btrfs.mountTable.getFilesystemId(snapshot.repositoryPath), []).append(snapshot)
+    
+    progress = DeleteProgress(len(snapper.configuration))
+    with ThreadPoolExecutor(max_workers=max(1, len(filesystems))) as pool:
+        futures = [pool.submit(deleteFilesystemSnapshots, snapshots, waitForCleaner, progress) for snapshots in filesystems.values()]
+    
+    for future in futures:
+        if future.exception() != None:
+            logger.error("Failed to delete snapshots of a filesystem: %s", future.exception())
+            print "Failed to delete snapshots of a filesystem: %s" % future.exception()
+    
+    print "Deletion has been finished in %.1f sec, %d snapshots of %d snapshot levels on %d filesystems deleted. For more information please check %s" % (
+        time.time() - progress.startTime, progress.deletedCount, progress.levelCount, len(filesystems), log_file)
+    logger.info("Deletion has been finished. Please check '" + log_file + "' for more information")
+
+# Deletes all snapshots and links of the snapshot levels of a single filesystem, run by --delete-all.
+def deleteFilesystemSnapshots(snapshots, waitForCleaner, progress):
+    logger = logging.getLogger();
+    
+    for snapshot in snapshots:
         logger.info("Deleting all snapshots for snapshot %s.\n", snapshot.getFullName())
-        print "Deleting all snapshots for snapshot " +  snapshot.getFullName();
-        btrfs.deleteSnapshot(snapshot, True);
+        snapshot_count = len(btrfs.getSnapshots(snapshot))
+        remaining_count = len(btrfs.deleteSnapshot(snapshot, True))
         
         symbolicLinkPath = snapshot.snapshotLink;
-        
         if os.path.islink(symbolicLinkPath):
-            print "Deleting link " + symbolicLinkPath 
             logger.info("Deleting link " + symbolicLinkPath)
             os.unlink(symbolicLinkPath)
-            
-    print "Deletion has been finished. For more information please check " + log_file 
-    logger.info("Deletion has been finished. Please check '" + log_file + "' for more information")
+        
+        progress.report(snapshot, snapshot_count - remaining_count, remaining_count)
+    
+    if waitForCleaner == True and len(snapshots) > 0:
+        sync_start_time = time.time()
+        if btrfs.syncDeletedSubvolumes(snapshots[0].repositoryPath) == True:
+            progress.printLine("Btrfs cleaner of %s has finished in %.1f sec." % (snapshots[0].repositoryPath, time.time() - sync_start_time))
+        else:
+            progress.printLine("Failed to wait for Btrfs cleaner of %s." % snapshots[0].repositoryPath)
+
+# Progress of --delete-all, printed as snapshot levels are done.
+class DeleteProgress:
+    
+    def __init__(self, levelCount):
+        self.levelCount = levelCount
+        self.doneCount = 0
+        self.deletedCount = 0
+        self.startTime = time.time()
+        self.lock = threading.Lock()
+    
+    def report(self, snapshot, deletedCount, remainingCount):
+        with self.lock:
+            self.doneCount += 1
+            self.deletedCount += deletedCount
+            line = "[%d/%d] %s: %d snapshots deleted" % (self.doneCount, self.levelCount, snapshot.getFullName(), deletedCount)
+            if remainingCount > 0:
+                line += ", %d failed" % remainingCount
+            line += " (%d in total, %.1f sec)" % (self.deletedCount, time.time() - self.startTime)
+        self.printLine(line)
+    
+    def printLine(self, line):
+        logging.getLogger().info(line)
+        with self.lock:
+            print line
+            sys.stdout.flush()
     
 #helper function for single process execution.
 def get_lock(process_name):
@@ -246,11 +474,82 @@ def get_lock(process_name):
         print "There is an another instance of '" +  process_name + "' is  running.", process_name
         sys.exit(10)
 
+# Returns current metrics of the service, served by the metrics endpoint.
+def collectMetrics(snapper):
+    MetricFamily = MetricsServer.MetricFamily
+    
+    with state.lock:
+        service_status = state.status
+        has_runtime_error = state.hasRuntimeError
+        snapshot_counters = dict((name, dict(counters)) for name, counters in state.snapshotCounters.items())
+    
+    families = [MetricFamily('conf_snapper_up', 'gauge', 'Service status (1 up, 0 otherwise).').add({'status': service_status}, 1 if service_status == StateStatus.up else 0),
+                MetricFamily('conf_snapper_runtime_error', 'gauge', 'Whether a runtime error was reported.').add({}, 1 if has_runtime_error else 0)]
+    
+    snapshots = MetricFamily('conf_snapper_snapshots_total', 'counter', 'Snapshot ticks by result per snapshot level.')
+    for name in sorted(snapshot_counters):
+        for result, count in sorted(snapshot_counters[name].items()):
+            snapshots.add({'level': name, 'result': result}, count)
+    families.append(snapshots)
+    
+    tick_durations = MetricFamily('conf_snapper_last_tick_duration_seconds', 'gauge', 'Duration of the last snapshot job per snapshot level.')
+    for name, duration in sorted(profiler.getLastDurations('job').items()):
+        tick_durations.add({'level': name}, duration)
+    families.append(tick_durations)
+    
+    stage_durations = MetricFamily('conf_snapper_stage_duration_seconds', 'histogram', 'Latency of snapshot operations per stage.')
+    for stage, (counts, count, total) in sorted(profiler.getHistograms().items()):
+        stage_durations.addHistogram({'stage': stage}, profiler.buckets, counts, count, total)
+    families.append(stage_durations)
+    
+    families.append(MetricFamily('conf_snapper_pending_link_promotions', 'gauge', 'Links waiting for promotion to the latest snapshot.').add({}, link_promoter.getPendingCount()))
+    families.append(MetricFamily('conf_snapper_reaper_queue_depth', 'gauge', 'Expired snapshots waiting for background deletion.').add({}, btrfs.reaper.getQueueDepth() if btrfs.reaper != None else 0))
+    families.append(MetricFamily('conf_snapper_reaper_failed_deletes_total', 'counter', 'Expired snapshots the background deletion failed to delete.').add({}, btrfs.reaper.getFailedCount() if btrfs.reaper != None else 0))
+    heartbeat_status = heartbeat.getHeartbeat()
+    families.append(MetricFamily('conf_snapper_max_tick_lag_seconds', 'gauge', 'Longest time a tick of a snapshot level is overdue.').add({}, heartbeat_status['maxLag']))
+    families.append(MetricFamily('conf_snapper_oldest_in_flight_seconds', 'gauge', 'Age of the oldest snapshot operation in flight.').add({}, heartbeat_status['oldestInFlight']['age'] if heartbeat_status['oldestInFlight'] != None else 0))
+    families.append(MetricFamily('conf_snapper_schedule_buckets', 'gauge', 'Scheduler jobs, one per distinct schedule of snapshot levels.').add({}, len(snapper.scheduleBuckets)))
+    if snapper.executor != None:
+        families.append(MetricFamily('conf_snapper_jobs_in_flight', 'gauge', 'Snapshot jobs submitted and not finished.').add({}, snapper.executor.getInFlightCount()))
+    
+    stoppers = MetricFamily('conf_snapper_stopper_active', 'gauge', 'Whether a stopper file exists, per stopper and scope.')
+    for stopper in global_stopper_list:
+        stoppers.add({'stopper': stopper, 'scope': 'global'}, 1 if stopper_watcher.isStopperActive(stopper) else 0)
+    for snapshotConf in snapper.configuration:
+        for stopper in snapshotConf.stoppers:
+            stoppers.add({'stopper': stopper, 'scope': snapshotConf.getFullName()}, 1 if stopper_watcher.isStopperActive(stopper) else 0)
+    families.append(stoppers)
+    
+    exported = MetricFamily('conf_snapper_export_bytes_total', 'counter', 'Bytes of send streams exported per snapshot level.')
+    export_failures = MetricFamily('conf_snapper_export_failures_total', 'counter', 'Failed exports per snapshot level.')
+    for name, metrics in sorted(snapshot_exporter.getMetrics().items()):
+        exported.add({'level': name}, metrics['bytes'])
+        export_failures.add({'level': name}, metrics['failures'])
+    families += [exported, export_failures]
+    
+    return families
 
 # --------------------- Snapper section -----------------------------
 class Snapper:
     configuration = [];
     sched = None;
+    executor = None;
+    # Max number of jobs running at once on a single filesystem.
+    filesystemConcurrency = 1;
+    # Scheduled ticks are skipped while the repository has not changed since the latest snapshot.
+    skipUnchangedSnapshots = False;
+    # Name of the abstract socket metrics are served on, empty disables the endpoint.
+    metricsSocket = "conf_snapper_metrics";
+    # Repository templates of the configuration, their directories are rescanned every templateRescanInterval seconds.
+    templates = [];
+    templateRescanInterval = 60;
+    # Ticks of a schedule are spread over phaseSlots offsets within the interval, hashed from the snapshot level
+    # and host name (0 disables spreading, levels without configured phase_offset fire at the start of the interval).
+    phaseSlots = 0;
+    # Max random delay of a snapshot level's submission after its tick, in seconds (at most half of the interval).
+    maxJitter = 0;
+    # EventEngine running scheduler, timers and signals on the main thread, None for the threaded mode.
+    engine = None;
 
     def __init__(self):
 
@@ -273,30 +572,98 @@ class Snapper:
         # default configuration file.
         self.conf_file = '/etc/conf_snapper/snapper_conf.json'
         self.running = True
+        self.configuration = []
+        # Set by SIGHUP, the main loop reloads configuration file.
+        self.reloadRequested = False
+        # Startup snapshots run concurrently (per filesystem) while the scheduler is already running.
+        self.fastStartup = False
+        self.timeToFirstSnapshot = None
+        self.timeToReady = None
+        self.templates = []
+        self.hostname = socket.gethostname()
+        # schedule bucket id -> {full name: snapshot configuration} of the snapshot levels sharing the schedule,
+        # a bucket has a single scheduler job.
+        self.scheduleBuckets = {}
+        self.bucketLock = threading.Lock()
         
-    #Validation for first time run
+    #Validation for first time run, returns True if a snapshot was taken.
     def checkSnapsotOnStartUp(self, snapshot):
         symbolicLinkPath = snapshot.snapshotLink;
         
         if os.path.islink(symbolicLinkPath):
             logger.debug("The path %s exist. Noting to do.", symbolicLinkPath)
-            return;
+            return False;
         
         logger.debug("The path %s does not exist on startup, creating first snapshot.", symbolicLinkPath)
         takeSnapshot(self, snapshot, True)
+        return True;
+    
+    #Startup work of a single snapshot level, run on the executor in fast startup mode.
+    def startUpSnapshotLevel(self, snapshot):
+        #Snapshot index is built once, it is updated in place by create/delete afterwards.
+        btrfs.loadSnapshotIndex(snapshot);
+        
+        if self.checkSnapsotOnStartUp(snapshot) == True:
+            with state.lock:
+                if self.timeToFirstSnapshot == None:
+                    self.timeToFirstSnapshot = time.time() - process_start_time
+                    self.logger.info("Time to first snapshot: %.3f sec", self.timeToFirstSnapshot)
+    
+    #Waits for startup snapshots of fast startup mode and reports time to ready.
+    def waitForStartUp(self, futures):
+        import concurrent.futures
+        concurrent.futures.wait(futures)
+        
+        self.timeToReady = time.time() - process_start_time
+        self.logger.info("Time to ready: %.3f sec, %d snapshot levels checked on startup.", self.timeToReady, len(futures))
     
     # Configuration loader
     def config(self, alt_path):
         if alt_path != None:
             self.conf_file = alt_path
-        self.logger.info("Using configuration file %s", self.conf_file)
         
-        with open(self.conf_file) as fh:
+        configuration, stoppers, templates, json_snapper_configuration = self.loadConfiguration(self.conf_file)
+        
+        self.configuration = configuration
+        self.templates = templates
+        self.templateRescanInterval = json_snapper_configuration.get('template_rescan_interval', self.templateRescanInterval)
+        global_stopper_list[:] = stoppers
+        self.filesystemConcurrency = json_snapper_configuration.get('filesystem_concurrency', self.filesystemConcurrency)
+        self.skipUnchangedSnapshots = json_snapper_configuration.get('skip_unchanged_snapshots', False)
+        space_monitor.configure(json_snapper_configuration.get('space_pressure'))
+        self.metricsSocket = json_snapper_configuration.get('metrics_socket', self.metricsSocket)
+        self.phaseSlots = json_snapper_configuration.get('phase_slots', self.phaseSlots)
+        self.maxJitter = json_snapper_configuration.get('max_jitter', self.maxJitter)
+        heartbeat.interval = json_snapper_configuration.get('heartbeat_interval', heartbeat.interval)
+    
+    # Parses configuration file. Returns snapshot configurations, global stoppers, repository templates
+    # and the raw snapper_configuration section.
+    def loadConfiguration(self, conf_file):
+        self.logger.info("Using configuration file %s", conf_file)
+        
+        configuration = []
+        stopper_list = []
+        with open(conf_file) as fh:
             self.logger.debug("Loaded conf file.")
             
             json_snapper_configuration = json.load(fh)['snapper_configuration']
             
-            repositories = json_snapper_configuration['repositories']
+            repositories = list(json_snapper_configuration.get('repositories', []))
+            templates = [RepositoryTemplate.RepositoryTemplate.fromConfiguration(section)
+                         for section in json_snapper_configuration.get('repository_templates', [])]
+            
+            #Repositories listed explicitly take precedence over the ones expanded from templates.
+            repository_names = set(repository.get('name') for repository in repositories)
+            for template in templates:
+                template_repositories = template.expand()
+                self.logger.debug("Template %s expanded to %d repositories.", template.name, len(template_repositories))
+                for repository in template_repositories:
+                    if repository['name'] in repository_names:
+                        self.logger.debug("Repository %s (%s) is already configured, ignoring.", repository['name'], repository['path'])
+                        continue
+                    repository_names.add(repository['name'])
+                    repositories.append(repository)
+            
             for repository in repositories:
                 
                 if not repository.get('name'):
@@ -305,18 +672,25 @@ class Snapper:
                     state.configurationErrorReason = "Name parameter was not fount...";
                     continue
                 
+                #Filesystem is checked once per repository, not per snapshot level.
+                is_btrfs_repository = btrfs.checkRepository(repository['path'])
+                
                 for snapshot in repository['snapshot_levels']:
                     snapshotConf = SnapshotConfiguration.SnapshotConfiguration(repository['name'],
                                                                                repository['path'],
                                                                                snapshot['name'],
                                                                                snapshot['frequency'],
                                                                                snapshot['link'],
-                                                                               TimeUnit.fromstring(snapshot['unit'])
+                                                                               TimeUnit.fromstring(snapshot['unit']),
+                                                                               repository.get('stoppers', []) + snapshot.get('stoppers', []),
+                                                                               RetentionPolicy.fromConfiguration(snapshot.get('retention')),
+                                                                               snapshot.get('export', {}).get('target'),
+                                                                               snapshot.get('phase_offset')
                                                                                );
                     self.logger.debug("%s loaded", snapshotConf.getFullName());    
                     self.logger.debug(snapshotConf); 
                     
-                    if btrfs.checkRepository(snapshotConf.repositoryPath) == False:
+                    if is_btrfs_repository == False:
                         self.logger.error("Repository path (%s) is not valid Btrfs folder", snapshotConf.repositoryPath)
                         state.hasConfigurationError = True;
                         state.configurationErrorReason = "Repository path " + snapshotConf.repositoryPath + " is not valid Btrfs folder";
@@ -329,52 +703,250 @@ class Snapper:
                         state.hasConfigurationError = True;
                         state.configurationErrorReason = "Repository link is empty.";
                     else:
-                        self.configuration.append(snapshotConf);
+                        configuration.append(snapshotConf);
             
             try:
                 stoppers = json_snapper_configuration['stoppers']
                 for stopper in stoppers:
-                    global_stopper_list.append(stopper)
+                    stopper_list.append(stopper)
             except Exception, err:
                 state.hasConfigurationError = True;
                 state.configurationErrorReason = "Stopper section does not exist. - " + traceback.format_exc();
                 logger.error("\n Stopper section does not exist. - %s\n" % traceback.format_exc())
+        
+        return configuration, stopper_list, templates, json_snapper_configuration
+    
+    # Reloads configuration file (on SIGHUP). Only jobs of added, removed or changed snapshot levels
+    # are touched, unchanged levels keep their schedule and pending link updates.
+    def reload(self):
+        self.logger.info("Reloading configuration file %s", self.conf_file)
+        reload_start_time = time.time()
+        
+        with state.lock:
+            state.hasConfigurationError = False;
+            state.configurationErrorReason = "";
+        
+        #Repositories might have been mounted since the last check.
+        btrfs.mountTable.invalidate()
+        
+        try:
+            configuration, stoppers, templates, json_snapper_configuration = self.loadConfiguration(self.conf_file)
+        except Exception, err:
+            self.logger.error("Failed to reload configuration, keeping the current one - %s" % traceback.format_exc())
+            with state.lock:
+                state.hasConfigurationError = True;
+                state.configurationErrorReason = "Failed to reload configuration - " + traceback.format_exc();
+            state.writeStatusJson();
+            return
+        
+        current_configuration = dict((snapshotConf.getFullName(), snapshotConf) for snapshotConf in self.configuration)
+        new_names = set(snapshotConf.getFullName() for snapshotConf in configuration)
+        
+        for name, snapshotConf in current_configuration.items():
+            if name not in new_names:
+                self.logger.info("%s was removed.", name)
+                self.removeSnapshotJob(snapshotConf)
+                btrfs.forgetSnapshotLevel(snapshotConf)
+                snapshot_exporter.forgetSnapshotLevel(snapshotConf)
+        
+        reloaded_configuration = []
+        unchanged_count = 0
+        for snapshotConf in configuration:
+            current_snapshotConf = current_configuration.get(snapshotConf.getFullName())
+            
+            if current_snapshotConf != None and current_snapshotConf.isSameSchedule(snapshotConf):
+                #Jobs keep the current object, only stoppers, retention and export are refreshed.
+                current_snapshotConf.stoppers = snapshotConf.stoppers
+                if current_snapshotConf.retention != snapshotConf.retention:
+                    self.logger.info("Retention of %s was changed: %s", snapshotConf.getFullName(), snapshotConf.retention)
+                    current_snapshotConf.retention = snapshotConf.retention
+                    #Retention state is rebuilt with the new policy on next tick.
+                    btrfs.invalidateSnapshotIndex(current_snapshotConf)
+                if current_snapshotConf.exportTarget != snapshotConf.exportTarget:
+                    self.logger.info("Export target of %s was changed: %s", snapshotConf.getFullName(), snapshotConf.exportTarget)
+                    current_snapshotConf.exportTarget = snapshotConf.exportTarget
+                    #Next stream to the new target is a full one.
+                    snapshot_exporter.restartExport(current_snapshotConf)
+                reloaded_configuration.append(current_snapshotConf)
+                unchanged_count += 1
+                continue
+            
+            if current_snapshotConf != None:
+                self.logger.info("%s was changed.", snapshotConf.getFullName())
+                self.removeSnapshotJob(current_snapshotConf)
+                btrfs.forgetSnapshotLevel(current_snapshotConf)
+                snapshot_exporter.forgetSnapshotLevel(current_snapshotConf)
+            else:
+                self.logger.info("%s was added.", snapshotConf.getFullName())
             
+            if self.engine != None:
+                #Reload runs on the loop, which must not block: Btrfs work of the level goes to the executor.
+                self.executor.submit(snapshotConf, self.startUpSnapshotLevel, snapshotConf)
+            else:
+                btrfs.loadSnapshotIndex(snapshotConf);
+                self.checkSnapsotOnStartUp(snapshotConf);
+            self.addSnapshotJob(snapshotConf);
+            reloaded_configuration.append(snapshotConf)
+        
+        self.configuration = reloaded_configuration
+        self.templates = templates
+        self.templateRescanInterval = json_snapper_configuration.get('template_rescan_interval', self.templateRescanInterval)
+        global_stopper_list[:] = stoppers
+        stopper_watcher.watch(global_stopper_list)
+        for snapshotConf in self.configuration:
+            stopper_watcher.watch(snapshotConf.stoppers)
+        
+        self.skipUnchangedSnapshots = json_snapper_configuration.get('skip_unchanged_snapshots', False)
+        space_monitor.configure(json_snapper_configuration.get('space_pressure'))
+        self.maxJitter = json_snapper_configuration.get('max_jitter', self.maxJitter)
+        if json_snapper_configuration.get('filesystem_concurrency', self.filesystemConcurrency) != self.filesystemConcurrency:
+            self.logger.warning("filesystem_concurrency change requires restart of the service.")
+        if json_snapper_configuration.get('phase_slots', self.phaseSlots) != self.phaseSlots:
+            self.logger.warning("phase_slots change requires restart of the service.")
+        
+        state.writeStatusJson();
+        self.logger.info("Configuration reloaded in %.3f sec, %d of %d snapshot levels unchanged.", time.time() - reload_start_time, unchanged_count, len(self.configuration))
+    
+    # True when a repository template matches other directories than at the last (re)load.
+    def isTemplateExpansionChanged(self):
+        for template in self.templates:
+            if template.isExpansionChanged():
+                self.logger.info("Directories matching template %s (%s) have changed.", template.name, template.pathGlob)
+                return True
+        return False
+    
+    # New or removed repository directories are picked up by a reload.
+    def rescanTemplates(self):
+        if self.isTemplateExpansionChanged() == True:
+            self.reload()
  
-    def startSecJob(self, cbFunction, expression, snapshotConfig):
-        self.sched.add_job(cbFunction, 'cron', second=expression, args=[self, snapshotConfig], name=snapshotConfig.getFullName())
+    # Returns shift of the snapshot level's ticks from the start of the interval in seconds: the configured
+    # phase_offset, or one of phaseSlots evenly spaced offsets chosen by a hash of the level and host names, so
+    # levels of a host and hosts of a fleet do not all fire at the same second.
+    def getPhaseOffset(self, snapshotConf):
+        unitSeconds, unitRange = {
+            TimeUnit.sec: (1, 60),
+            TimeUnit.min: (60, 60),
+            TimeUnit.hour: (60*60, 24),
+            TimeUnit.day: (60*60*24, 31),
+        }.get(snapshotConf.snapshotUnits, (60, 60))
+        #A cron field cycles within its range (e.g. minutes of an hour), so must the offset.
+        period = min(snapshotConf.snapshotFrequency, unitRange) * unitSeconds
         
-    def startMinJob(self, cbFunction, expression, snapshotConfig):
-        self.sched.add_job(cbFunction, 'cron', minute=expression, args=[self, snapshotConfig], name=snapshotConfig.getFullName() )
+        if snapshotConf.phaseOffset != None:
+            return int(snapshotConf.phaseOffset) % period
+        if self.phaseSlots <= 0:
+            return 0
+        
+        #Names come from the configuration file as unicode, md5 takes bytes.
+        digest = hashlib.md5((self.hostname + ":" + snapshotConf.getFullName()).encode('utf-8')).hexdigest()
+        return (int(digest, 16) % self.phaseSlots) * period // self.phaseSlots
     
-    def startHourJob(self, cbFunction, expression, snapshotConfig):
-        self.sched.add_job(cbFunction, 'cron', hour=expression, args=[self, snapshotConfig], name=snapshotConfig.getFullName() )
-
-    def startDayJob(self, cbFunction, expression, snapshotConfig):
-        self.sched.add_job(cbFunction, 'cron', day=expression, args=[self, snapshotConfig], name=snapshotConfig.getFullName() )
+    # Returns cron fields of the snapshot level: every snapshotFrequency units, shifted by offset seconds.
+    def getCronFields(self, snapshotConf, offset):
+        frequency = snapshotConf.snapshotFrequency
+        days, remainder = divmod(offset, 60*60*24)
+        hours, remainder = divmod(remainder, 60*60)
+        minutes, seconds = divmod(remainder, 60)
         
+        switcher = {
+            TimeUnit.sec: lambda: {'second': '%d-59/%d' % (seconds, frequency)},
+            TimeUnit.min: lambda: {'minute': '%d-59/%d' % (minutes, frequency), 'second': seconds},
+            TimeUnit.hour: lambda: {'hour': '%d-23/%d' % (hours, frequency), 'minute': minutes, 'second': seconds},
+            TimeUnit.day: lambda: {'day': '%d-31/%d' % (days + 1, frequency), 'hour': hours, 'minute': minutes, 'second': seconds},
+        }
+        return switcher.get(snapshotConf.snapshotUnits, switcher[TimeUnit.min])()
+    
+    # Returns random delay of the snapshot level's submission after a tick.
+    def getJitter(self, snapshotConf):
+        if self.maxJitter <= 0:
+            return 0
+        return random.uniform(0, min(self.maxJitter, snapshotConf.getIntervalSeconds() / 2.0))
+    
+    # Snapshot levels with the same schedule share a bucket, e.g. 'min/10' for every 10 minutes or
+    # 'min/10+150' for every 10 minutes shifted by 150 seconds.
+    def getScheduleBucketId(self, snapshotConf):
+        bucket_id = "%s/%d" % (TimeUnit.tostring(snapshotConf.snapshotUnits), snapshotConf.snapshotFrequency)
+        offset = self.getPhaseOffset(snapshotConf)
+        if offset > 0:
+            bucket_id += "+%d" % offset
+        return bucket_id
+    
+    # Returns snapshot levels of the schedule bucket.
+    def getBucketMembers(self, bucketId):
+        with self.bucketLock:
+            return self.scheduleBuckets.get(bucketId, {}).values()
+        
+    # Adds the snapshot level to the scheduler job of its schedule bucket, the job is created for the first member.
+    def addSnapshotJob(self, snapshotConf):
+        bucket_id = self.getScheduleBucketId(snapshotConf)
+        with self.bucketLock:
+            members = self.scheduleBuckets.get(bucket_id)
+            if members == None:
+                members = self.scheduleBuckets[bucket_id] = {}
+                fields = self.getCronFields(snapshotConf, self.getPhaseOffset(snapshotConf))
+                
+                #add bucket job, takeSnapshot of every member runs on the executor of its repository filesystem.
+                self.sched.add_job(submitBucket, 'cron', args=[self, bucket_id], name=bucket_id, id=bucket_id, **fields)
+                self.logger.debug("Scheduler job of bucket %s was added: %s", bucket_id, fields)
+            members[snapshotConf.getFullName()] = snapshotConf
+        heartbeat.addLevel(snapshotConf)
+    
+    # Removes the snapshot level from its schedule bucket and its pending link update, the job of
+    # the bucket is removed with the last member.
+    def removeSnapshotJob(self, snapshotConf):
+        bucket_id = self.getScheduleBucketId(snapshotConf)
+        with self.bucketLock:
+            members = self.scheduleBuckets.get(bucket_id, {})
+            members.pop(snapshotConf.getFullName(), None)
+            if len(members) == 0 and bucket_id in self.scheduleBuckets:
+                del self.scheduleBuckets[bucket_id]
+                if self.sched.get_job(bucket_id) != None:
+                    self.sched.remove_job(bucket_id)
+                self.logger.debug("Scheduler job of bucket %s was removed.", bucket_id)
+        tick_delayer.cancel(snapshotConf.getFullName())
+        link_promoter.cancel(snapshotConf.getFullName())
+        heartbeat.removeLevel(snapshotConf)
+    
     def start(self):
         try:
-            # apscheduler::BlockingScheduler initialization. 
-            self.sched = BlockingScheduler();
+            # Imported here, checking configuration does not need them.
+            # requires installation of schedule
+            # sudo apt-get -y install python-pip
+            # sudo pip install apscheduler
+            import FilesystemExecutor
             
-            for snapshotConf in self.configuration:
-                
-                #Take snapshots on startup
-                self.checkSnapsotOnStartUp(snapshotConf);
+            if self.engine != None:
+                import EventEngine
+                self.sched = EventEngine.EngineScheduler(self.engine)
+            else:
+                from apscheduler.schedulers.blocking import BlockingScheduler
                 
-                switcher = {
-                    TimeUnit.sec: self.startSecJob,
-                    TimeUnit.min: self.startMinJob,
-                    TimeUnit.hour: self.startHourJob,
-                    TimeUnit.day: self.startDayJob,
-                }
+                # apscheduler::BlockingScheduler initialization. 
+                self.sched = BlockingScheduler();
+            self.executor = FilesystemExecutor.FilesystemExecutor(btrfs.mountTable, self.filesystemConcurrency);
+            
+            #The event loop must not block and beats the heartbeat only while it runs, its startup is always fast.
+            fast_startup = self.fastStartup == True or self.engine != None
+            
+            startup_futures = []
+            for snapshotConf in self.configuration:
                 
-                expression = '*/' + str(snapshotConf.snapshotFrequency)
-                func = switcher.get(snapshotConf.snapshotUnits)
+                if fast_startup == True:
+                    future = self.executor.submit(snapshotConf, self.startUpSnapshotLevel, snapshotConf)
+                    if future != None:
+                        startup_futures.append(future)
+                else:
+                    #Build snapshot index once and take snapshots on startup
+                    self.startUpSnapshotLevel(snapshotConf);
                 
-                #add takeSnapshot job.
-                func(takeSnapshot, expression, snapshotConf)
+                self.addSnapshotJob(snapshotConf);
+            
+            if fast_startup == True:
+                threading.Thread(target=self.waitForStartUp, args=[startup_futures], name="startup_thread").start()
+            else:
+                self.timeToReady = time.time() - process_start_time
+                self.logger.info("Time to ready: %.3f sec", self.timeToReady)
                 
             self.sched.start()
         
@@ -382,7 +954,7 @@ class Snapper:
             state.status = StateStatus.down;
             state.hasRuntimeError = True;
             state.configurationErrorReason = "Failed to start with exception: " + traceback.format_exc();
-            state.writeStatusJson();
+            state.writeStatusJson(True);
             sys.exit("\nFailed to start - %s\n" % traceback.format_exc())
 
 
@@ -403,15 +975,25 @@ class Snapper:
                 
             state.status = StateStatus.stopped;
             state.runtimeErrorReason = "Got a termination signal.";
-            state.writeStatusJson();
+            state.writeStatusJson(True);
+        
+        #SIGHUP for configuration reload, done by the main loop.
+        elif sig == signal.SIGHUP:
+            self.logger.info("Got a reload signal")
+            self.reloadRequested = True
             
     def printConfiguration(self):
         print "Snapper configuration:"
+        for template in self.templates:
+            print "Repository template: %s" % template
         for conf in self.configuration:
             print conf
 
 # -------------------- Main Section ------------------------
 if __name__ == '__main__':
+    # Imported here, only the command line needs it.
+    import argparse
+    
     parser = argparse.ArgumentParser(description='Snapshot manager for Btrfs')
     parser.add_argument('-c','--check', 
                         help='Check configuration file.',
@@ -421,6 +1003,36 @@ if __name__ == '__main__':
                         help='Deletes all snapshots.',
                         action='store_true',
                         dest='is_delete')
+    parser.add_argument('-f','--fast-startup', 
+                        help='Take startup snapshots concurrently while the scheduler is already running.',
+                        action='store_true',
+                        dest='is_fast_startup')
+    parser.add_argument('-w','--wait-cleaner', 
+                        help='With --delete-all, wait until the Btrfs cleaner has removed the deleted snapshots (btrfs subvolume sync).',
+                        action='store_true',
+                        dest='is_wait_cleaner')
+    parser.add_argument('-e','--event-engine', 
+                        help='Run scheduler, timers and signal handling in a single-threaded event loop.',
+                        action='store_true',
+                        dest='is_event_engine')
+    parser.add_argument('-p','--profile', 
+                        help='Write timing of every snapshot operation to the file as JSON lines.',
+                        metavar='<trace_file_path>',
+                        dest='profile_file')
+    parser.add_argument('-s','--simulate', 
+                        help='Replay the schedule of the configuration on a virtual clock against in-memory storage and print a report.',
+                        action='store_true',
+                        dest='is_simulate')
+    parser.add_argument('--simulate-hours', 
+                        help='Virtual hours replayed by --simulate (default 24).',
+                        type=float,
+                        default=24,
+                        dest='simulate_hours')
+    parser.add_argument('--simulate-scale', 
+                        help='Number of copies of every repository simulated by --simulate (default 1).',
+                        type=int,
+                        default=1,
+                        dest='simulate_scale')
     parser.add_argument('configuration_file', 
                         metavar='<configuration_file_path>', 
                         type=argparse.FileType('r'),
@@ -432,6 +1044,11 @@ if __name__ == '__main__':
     is_check_configuration = args.is_check
     is_snapshots_delete = args.is_delete
     
+    if args.is_simulate:
+        import Simulator
+        Simulator.run(sys.modules[__name__], args)
+        sys.exit(0)
+    
     try:
         
         # user root validation.
@@ -444,6 +1061,9 @@ if __name__ == '__main__':
         
         get_lock('conf_snapper')
         
+        if args.profile_file != None:
+            profiler.enableTrace(args.profile_file)
+        
         try:
             if condiguration_file != None:
                 snapper.config(condiguration_file.name)
@@ -461,16 +1081,72 @@ if __name__ == '__main__':
             state.status = StateStatus.down;
             state.hasConfigurationError = True;
             state.configurationErrorReason = "Failed to parse configuration - " + traceback.format_exc();
-            state.writeStatusJson();
+            state.writeStatusJson(True);
             
             sys.exit("\nFailed to parse configuration - %s\n" % traceback.format_exc())
             
         if is_snapshots_delete == True:
-            detele_all_snapshots_for_all_repositories(snapper);
+            detele_all_snapshots_for_all_repositories(snapper, args.is_wait_cleaner);
             sys.exit(0);
         
+        snapper.fastStartup = args.is_fast_startup
+        
+        #Expired snapshots are deleted in background, off the scheduling path.
+        btrfs.reaper = SnapshotReaper.SnapshotReaper(btrfs, state)
+        btrfs.reaper.start()
+        
+        #Stoppers are tracked by inotify watches from now on.
+        stopper_watcher.watch(global_stopper_list)
+        for snapshotConf in snapper.configuration:
+            stopper_watcher.watch(snapshotConf.stoppers)
+        
+        if args.is_event_engine == True:
+            import EventEngine
+            
+            #Timers, stopper events and signals are served by the loop instead of their own threads.
+            engine = snapper.engine = EventEngine.EventEngine()
+            engine.addTimerQueue(link_promoter)
+            engine.addTimerQueue(tick_delayer)
+            if stopper_watcher.fd != None:
+                engine.addReader(stopper_watcher.fd, stopper_watcher.readEvents)
+                engine.callEvery(stopper_watcher.retryInterval, stopper_watcher.retryUnwatchedFolders)
+            if heartbeat.interval > 0:
+                #Beats only while the loop runs, a stuck loop leaves the heartbeat stale.
+                heartbeat.beat()
+                engine.callEvery(heartbeat.interval, heartbeat.beat)
+        else:
+            stopper_watcher.start()
+            link_promoter.start()
+            tick_delayer.start()
+            if heartbeat.interval > 0:
+                heartbeat.start()
+        
+        if snapper.metricsSocket != "":
+            metrics_server = MetricsServer.MetricsServer(snapper.metricsSocket, lambda: collectMetrics(snapper))
+            try:
+                metrics_server.bind()
+                metrics_server.start()
+            except socket.error, err:
+                logger.error("Failed to serve metrics on @%s: %s", snapper.metricsSocket, err)
+        
+        if snapper.engine != None:
+            engine.addSignalHandler(signal.SIGTERM, snapper.set_signal_handling)
+            engine.addSignalHandler(signal.SIGINT, snapper.set_signal_handling)
+            engine.addSignalHandler(signal.SIGHUP, lambda sig, frame: snapper.reload())
+            if len(snapper.templates) > 0:
+                engine.callEvery(snapper.templateRescanInterval, snapper.rescanTemplates)
+            
+            state.status = StateStatus.up;
+            state.writeStatusJson();
+            
+            #Runs the loop until a termination signal.
+            snapper.start()
+            engine.close()
+            sys.exit(0)
+        
         signal.signal(signal.SIGTERM, snapper.set_signal_handling)
         signal.signal(signal.SIGINT, snapper.set_signal_handling)
+        signal.signal(signal.SIGHUP, snapper.set_signal_handling)
         
         process_thread = threading.Thread(target=snapper.start, name="process_thread")
         process_thread.start()
@@ -478,7 +1154,14 @@ if __name__ == '__main__':
         state.status = StateStatus.up;
         state.writeStatusJson();
         
+        next_template_check = time.time() + snapper.templateRescanInterval
         while process_thread.is_alive():
+            if snapper.reloadRequested == True:
+                snapper.reloadRequested = False
+                snapper.reload()
+            elif len(snapper.templates) > 0 and time.time() >= next_template_check:
+                next_template_check = time.time() + snapper.templateRescanInterval
+                snapper.rescanTemplates()
             time.sleep(1)
         process_thread.join()
     
@@ -486,7 +1169,7 @@ if __name__ == '__main__':
         state.status = StateStatus.down;
         state.hasRuntimeError = True;
         state.configurationErrorReason = "Failed to start with exception: " + traceback.format_exc();
-        state.writeStatusJson();
+        state.writeStatusJson(True);
         
         sys.exit("\nFailed to start - %s\n" % traceback.format_exc())
         
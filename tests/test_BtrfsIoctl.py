@@ -0,0 +1,73 @@
+#!/usr/bin/python
+
+"""
+    Tests of the argument structures passed to Btrfs ioctls. The ioctl call itself is replaced,
+    it records the arguments and acts on a scratch directory.
+"""
+
+import os
+import shutil
+import struct
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+import BtrfsIoctl
+import BtrfsStorage
+import SnapshotConfiguration
+
+# Stands for the fcntl module of BtrfsIoctl, SNAP_DESTROY removes the named folder.
+class RecordingFcntl:
+
+    def __init__(self):
+        self.names = []
+
+    def ioctl(self, fd, request, args, mutate):
+        if request == BtrfsIoctl.BTRFS_IOC_SNAP_DESTROY:
+            name = struct.unpack(BtrfsIoctl.VOL_ARGS_FORMAT, args.tostring())[1].rstrip('\0')
+            self.names.append(name)
+            os.rmdir(os.path.join(os.readlink('/proc/self/fd/%d' % fd), name))
+        elif request == BtrfsIoctl.BTRFS_IOC_SNAP_CREATE_V2:
+            name = struct.unpack(BtrfsIoctl.VOL_ARGS_V2_FORMAT, args.tostring())[3].rstrip('\0')
+            self.names.append(name)
+            os.mkdir(os.path.join(os.readlink('/proc/self/fd/%d' % fd), name))
+        return 0
+
+class UnicodeNameTest(unittest.TestCase):
+
+    def setUp(self):
+        # Paths of the configuration file are unicode (json.load).
+        self.repository = unicode(tempfile.mkdtemp())
+        self.snapshot = SnapshotConfiguration.SnapshotConfiguration(u'repo', self.repository, u'ShortTerm', 10, self.repository + u'/ShortTerm')
+        self.storage = BtrfsStorage.BtrfsStorage()
+        self.snapshot_folder = self.storage.getSnapshotFolder(self.snapshot)
+        for snapshotName in ('snapshot-2020-01-01_00-00-00', 'snapshot-2020-01-01_00-10-00', 'snapshot-2020-01-01_00-20-00'):
+            os.mkdir(os.path.join(self.snapshot_folder, snapshotName))
+
+        self.fcntl = RecordingFcntl()
+        self.original_fcntl = BtrfsIoctl.fcntl
+        BtrfsIoctl.fcntl = self.fcntl
+
+    def tearDown(self):
+        BtrfsIoctl.fcntl = self.original_fcntl
+        shutil.rmtree(self.repository)
+
+    def test_delete_of_listed_snapshot(self):
+        snapshots = self.storage.loadSnapshotIndex(self.snapshot)
+        self.assertTrue(isinstance(snapshots[0], unicode))
+
+        deleted_snapshot_list = self.storage.deleteSubvolumes(self.snapshot_folder, snapshots[:1])
+
+        self.assertEqual(deleted_snapshot_list, snapshots[:1])
+        self.assertEqual(self.fcntl.names, ['snapshot-2020-01-01_00-00-00'])
+        self.assertEqual(sorted(os.listdir(self.snapshot_folder)), snapshots[1:])
+
+    def test_create_with_unicode_name(self):
+        BtrfsIoctl.snapshotCreate(self.repository, self.snapshot_folder, u'snapshot-2020-01-01_00-30-00')
+
+        self.assertEqual(self.fcntl.names, ['snapshot-2020-01-01_00-30-00'])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,154 @@
+#!/usr/bin/python
+
+"""
+    Tests of skip_unchanged_snapshots: writes of the service itself (snapshots, link promotions)
+    do not count as repository changes. Btrfs tree searches are emulated on a scratch directory,
+    the inode change time plays the role of the transaction id.
+"""
+
+import datetime
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+import BtrfsIoctl
+import BtrfsStorage
+import SnapshotConfiguration
+import conf_snapper
+
+# Copies the repository as a snapshot, nested snapshots are left out as Btrfs does.
+class DirectoryStorage(BtrfsStorage.BtrfsStorage):
+
+    def __init__(self):
+        BtrfsStorage.BtrfsStorage.__init__(self)
+        self.now = datetime.datetime(2020, 1, 1)
+
+    def getCurrentTime(self):
+        return self.now
+
+    def checkRepository(self, path):
+        return True
+
+    def createSnapshotSubvolume(self, snapshot, snapshot_folder, snapshotName):
+        snapshot_root_folder = snapshot.repositoryPath + self.genSnapshotPathSubFolder
+        shutil.copytree(snapshot.repositoryPath, snapshot_folder + '/' + snapshotName, symlinks=True,
+                        ignore=lambda folder, names: names if folder + '/' == snapshot_root_folder else [])
+        return True
+
+    def deleteSubvolumes(self, snapshot_folder, snapshotNames):
+        for snapshotName in snapshotNames:
+            shutil.rmtree(snapshot_folder + '/' + snapshotName)
+        return list(snapshotNames)
+
+    def getCleanerBacklog(self, path):
+        return 0
+
+    # Size of a Btrfs directory, twice the total length of its entry names.
+    def getFolderSize(self, path):
+        return 2 * sum(len(name) for name in os.listdir(path))
+
+def getCreationTime(path):
+    return os.lstat(path).st_ctime
+
+# Inodes of the repository changed after the time, snapshots in the snapshot folders are other subvolumes.
+def getChangedInodes(path, since):
+    snapshot_root_folder = path + BtrfsStorage.BtrfsStorage.genSnapshotPathSubFolder
+    for folder, folder_names, file_names in os.walk(path):
+        if folder + '/' == snapshot_root_folder:
+            for name in folder_names:
+                yield os.lstat(os.path.join(folder, name)).st_ino
+            del folder_names[:]
+        for name in [folder] + [os.path.join(folder, name) for name in folder_names + file_names]:
+            stat = os.lstat(name)
+            if stat.st_ctime > since:
+                yield stat.st_ino
+
+class Snapper:
+
+    def __init__(self):
+        self.logger = logging.getLogger()
+        self.skipUnchangedSnapshots = True
+
+    def getLevelLock(self, snapshot):
+        return threading.Lock()
+
+@unittest.skipIf(os.geteuid() != 0, "links are created by root only")
+class SkipUnchangedSnapshotTest(unittest.TestCase):
+
+    def setUp(self):
+        self.repository = tempfile.mkdtemp()
+        with open(self.repository + '/data', 'w') as outfile:
+            outfile.write('data')
+
+        self.storage = DirectoryStorage()
+        self.snapshot = SnapshotConfiguration.SnapshotConfiguration('repo', self.repository, 'ShortTerm', 10, self.repository + '/ShortTerm')
+        self.snapper = Snapper()
+
+        self.patched = [(BtrfsIoctl, 'getSubvolumeCreationTransid', getCreationTime),
+                        (BtrfsIoctl, 'getChangedInodes', getChangedInodes),
+                        (conf_snapper, 'btrfs', self.storage)]
+        self.originals = [(module, name, getattr(module, name)) for module, name, value in self.patched]
+        for module, name, value in self.patched:
+            setattr(module, name, value)
+
+        self.storage.loadSnapshotIndex(self.snapshot)
+
+    def tearDown(self):
+        for module, name, value in self.originals:
+            setattr(module, name, value)
+        conf_snapper.link_promoter.cancel(self.snapshot.getFullName())
+        shutil.rmtree(self.repository)
+
+    # Scheduled tick of the level, returns True when a snapshot was taken.
+    def tick(self):
+        self.storage.now += datetime.timedelta(minutes=10)
+        snapshots = self.storage.getSnapshots(self.snapshot)
+        conf_snapper.takeSnapshot(self.snapper, self.snapshot, False, time.time())
+        # Older snapshots are pruned by the retention, the latest one tells if a snapshot was taken.
+        return self.storage.getSnapshots(self.snapshot)[-1:] != snapshots[-1:]
+
+    def promoteLink(self):
+        conf_snapper.createSymbolicLink(self.snapshot, conf_snapper.getLastPathToSnapshot(self.storage.getSnapshots(self.snapshot), self.snapshot))
+
+    def change(self):
+        # Change time of the write must be later than the one of the latest snapshot.
+        time.sleep(0.05)
+        with open(self.repository + '/data', 'a') as outfile:
+            outfile.write('data')
+
+    # Takes two snapshots and promotes the link to the latest one, as the scheduler does.
+    def startLevel(self):
+        self.assertTrue(self.tick())
+        self.change()
+        self.assertTrue(self.tick())
+        self.promoteLink()
+        self.assertEqual(os.readlink(self.snapshot.snapshotLink), self.storage.getSnapshotFolder(self.snapshot) + '/' + self.storage.getSnapshots(self.snapshot)[-1])
+
+    def test_tick_after_link_promotion_is_skipped(self):
+        self.startLevel()
+
+        self.assertFalse(self.tick())
+        self.assertFalse(self.tick())
+
+    def test_tick_after_change_is_taken(self):
+        self.startLevel()
+        self.change()
+
+        self.assertTrue(self.tick())
+
+    def test_removed_file_is_a_change(self):
+        self.startLevel()
+        time.sleep(0.05)
+        os.unlink(self.repository + '/data')
+
+        self.assertTrue(self.tick())
+
+if __name__ == '__main__':
+    unittest.main()